@@ -0,0 +1,64 @@
+"""Benchmark of the 2D augmentation path of the BatchProvider
+
+Measures augmented batches per second for different numbers of augmentation worker processes and batch sizes, and
+for the batched torch backend. Run from the repository root with
+
+    python -m benchmarks.bench_augmentation --workers 0 2 4 8 --batch_sizes 12 32 64 --torch_devices cpu cuda
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from data.batch_provider import BatchProvider
+
+
+augmentation_options = {'do_fliplr': True,
+                        'do_flipud': True,
+                        'do_rotations': True,
+                        'do_scaleaug': True,
+                        'do_elasticaug': True,
+                        'nlabels': 2,
+                        'augment_every_nth': 1}
+
+
+def benchmark(images, labels, workers, batch_size, repetitions, options=augmentation_options):
+    provider = BatchProvider(images, labels, np.arange(images.shape[0]),
+                             do_augmentations=True, augmentation_options=options,
+                             augmentation_workers=workers)
+    try:
+        provider.next_batch(batch_size)  # warm up, starts the worker processes
+        time_ = time.time()
+        for _ in range(repetitions):
+            provider.next_batch(batch_size)
+        return repetitions / (time.time() - time_)
+    finally:
+        provider.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the augmentation workers")
+    parser.add_argument("--workers", type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument("--batch_sizes", type=int, nargs='+', default=[12, 32, 64])
+    parser.add_argument("--torch_devices", type=str, nargs='*', default=['cpu'])
+    parser.add_argument("--image_size", type=int, default=128)
+    parser.add_argument("--repetitions", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    n = 2 * max(args.batch_sizes)
+    images = rng.rand(n, args.image_size, args.image_size).astype(np.float32)
+    labels = (rng.rand(n, args.image_size, args.image_size) > 0.5).astype(np.uint8)
+
+    print('{} cpu cores available'.format(os.cpu_count()))
+    print('{:>10} {:>14} {:>12}'.format('batch size', 'backend', 'batches/s'))
+    for batch_size in args.batch_sizes:
+        for workers in args.workers:
+            batches_per_second = benchmark(images, labels, workers, batch_size, args.repetitions)
+            print('{:>10} {:>14} {:>12.2f}'.format(batch_size, 'opencv/%d' % workers, batches_per_second))
+        for device in args.torch_devices:
+            options = dict(augmentation_options, backend='torch', device=device)
+            batches_per_second = benchmark(images, labels, 0, batch_size, args.repetitions, options)
+            print('{:>10} {:>14} {:>12.2f}'.format(batch_size, 'torch/' + device, batches_per_second))
@@ -0,0 +1,55 @@
+"""Benchmark of drawing the indices of the training batches
+
+Compares the previous sampling without replacement in BatchProvider.next_batch (np.random.choice on the pool of unused
+indices followed by np.setdiff1d) with the per epoch permutation. Only the indices are drawn, no data is read. Run from
+the repository root with
+
+    python -m benchmarks.bench_batch_indices
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from data.batch_provider import BatchProvider
+
+
+class ReferenceSampler():
+    """Index sampling of BatchProvider.next_batch as it was implemented before the epoch permutation"""
+
+    def __init__(self, indices):
+        self.indices = indices
+        self.unused_indices = indices.copy()
+
+    def next_batch_indices(self, batch_size):
+        if len(self.unused_indices) < batch_size:
+            self.unused_indices = self.indices
+        batch_indices = np.random.choice(self.unused_indices, batch_size, replace=False)
+        self.unused_indices = np.setdiff1d(self.unused_indices, batch_indices)
+        return np.sort(batch_indices)
+
+
+def batches_per_second(fct, batch_size, n_batches):
+    time_ = time.time()
+    for _ in range(n_batches):
+        fct(batch_size)
+    return n_batches / (time.time() - time_)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the sampling of batch indices")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[15000, 1000000])
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--n_batches", type=int, default=100)
+    args = parser.parse_args()
+
+    print('{:>10} {:>16} {:>16} {:>8}'.format('indices', 'before batches/s', 'after batches/s', 'speedup'))
+    for n in args.sizes:
+        indices = np.arange(n)
+        # the index arrays stand in for the data, so reading a batch costs next to nothing
+        provider = BatchProvider(indices, indices, indices, seed=0)
+
+        reference = batches_per_second(ReferenceSampler(indices).next_batch_indices, args.batch_size, args.n_batches)
+        permutation = batches_per_second(provider.read_next_batch, args.batch_size, args.n_batches)
+        print('{:>10} {:>16.0f} {:>16.0f} {:>7.0f}x'.format(n, reference, permutation, permutation / reference))
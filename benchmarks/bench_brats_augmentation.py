@@ -0,0 +1,44 @@
+"""Benchmark of the 3D augmentation of the BraTS volumes
+
+Compares the slice-wise OpenCV augmentation (augment3DImage) with the vectorized one (augment3DImageVectorized) on
+random volumes, with all augmentations enabled. Run from the repository root with
+
+    python -m benchmarks.bench_brats_augmentation --size 128 --devices cpu cuda
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from data.BratsProcessing import augmentation as aug
+
+
+def benchmark(function, image, labels, nn_augmentation, repetitions, **kwargs):
+    default_label_values = np.zeros(labels.shape[-1], dtype=np.float32)
+    function(image.copy(), labels.copy(), default_label_values, nn_augmentation, **kwargs)  # warm up
+    time_ = time.time()
+    for _ in range(repetitions):
+        function(image.copy(), labels.copy(), default_label_values, nn_augmentation, **kwargs)
+    return (time.time() - time_) / repetitions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the 3D augmentation")
+    parser.add_argument("--size", type=int, default=128)
+    parser.add_argument("--devices", type=str, nargs='*', default=['cpu'])
+    parser.add_argument("--repetitions", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shape = (args.size, args.size, args.size)
+    image = rng.rand(*shape, 4).astype(np.float32)
+    # hard augmentation on the 5 original classes
+    labels = np.eye(5, dtype=np.float32)[rng.randint(0, 5, shape)]
+
+    print('{:>24} {:>14}'.format('implementation', 's/volume'))
+    print('{:>24} {:>14.3f}'.format('opencv (slice-wise)',
+                                    benchmark(aug.augment3DImage, image, labels, False, args.repetitions)))
+    for device in args.devices:
+        seconds = benchmark(aug.augment3DImageVectorized, image, labels, False, args.repetitions, device=device)
+        print('{:>24} {:>14.3f}'.format('vectorized/' + device, seconds))
@@ -0,0 +1,82 @@
+"""Benchmark of activation checkpointing
+
+Trains PHISeg with the filters of the phiseg_7_5_* experiments for a few steps on random images, once without
+checkpointing and once per given set of checkpointed resolution levels, and reports the time per training step (the
+recompute overhead) and the peak memory. Every mode runs in a fresh process. Run from the repository root with
+
+    python -m benchmarks.bench_checkpointing --image_size 256 --batch_size 12 --levels 0 0,1 0,1,2
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+import torch
+
+from models.phiseg import PHISeg
+from benchmarks.bench_lidc_ingestion import peak_memory_mb
+
+
+def run_mode(args, levels):
+    torch.manual_seed(0)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    net = PHISeg(input_channels=1, num_classes=2, num_filters=args.filters,
+                 image_size=(1, args.image_size, args.image_size), checkpoint_levels=levels).to(device)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+
+    patch = torch.randn(args.batch_size, 1, args.image_size, args.image_size, device=device)
+    mask = (torch.rand(args.batch_size, 1, args.image_size, args.image_size, device=device) > 0.5).float()
+
+    def step():
+        optimizer.zero_grad()
+        net.forward(patch, mask, training=True)
+        net.loss(mask).backward()
+        optimizer.step()
+
+    # the first step allocates the optimizer state and is not timed
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+
+    time_ = time.time()
+    for _ in range(args.steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    seconds_per_step = (time.time() - time_) / args.steps
+
+    peak_mb = torch.cuda.max_memory_allocated(device) / 1024 ** 2 if device.type == 'cuda' else peak_memory_mb()
+    print('%s %f %f' % (device.type, seconds_per_step, peak_mb))
+
+
+def parse_levels(levels):
+    return [int(level) for level in levels.split(',') if level]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark activation checkpointing")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--image_size", type=int, default=256)
+    parser.add_argument("--filters", type=int, nargs='+', default=[32, 64, 128, 192, 192, 192, 192])
+    parser.add_argument("--levels", type=str, nargs='+', default=['0', '0,1', '0,1,2,3,4,5,6'],
+                        help="comma separated resolution levels to checkpoint, one set per mode")
+    parser.add_argument("--mode", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args, parse_levels(args.mode))
+        sys.exit()
+
+    print('{:>16} {:>8} {:>10} {:>10} {:>16}'.format('levels', 'device', 's/step', 'overhead', 'peak memory MB'))
+    baseline = None
+    for mode in [''] + args.levels:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_checkpointing', '--mode', mode] + sys.argv[1:],
+                                stdout=subprocess.PIPE, check=True).stdout.decode().split()
+        device, seconds, peak_mb = output[-3], float(output[-2]), float(output[-1])
+        baseline = seconds if baseline is None else baseline
+        print('{:>16} {:>8} {:>10.3f} {:>9.0f}% {:>16.0f}'.format(mode or 'none', device, seconds,
+                                                                 100 * (seconds / baseline - 1), peak_mb))
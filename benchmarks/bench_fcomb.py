@@ -0,0 +1,86 @@
+"""Micro-benchmark of the latent injection in Fcomb
+
+Compares the previous implementation, which tiled z with repeat/index_select and concatenated it to the feature map,
+with the split first convolution in Fcomb.forward. Run from the repository root with
+
+    python -m benchmarks.bench_fcomb
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from models.probabilistic_unet import Fcomb
+
+
+def tile(a, dim, n_tile):
+    init_dim = a.size(dim)
+    repeat_idx = [1] * a.dim()
+    repeat_idx[dim] = n_tile
+    a = a.repeat(*(repeat_idx))
+    order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(
+        a.device)
+    return torch.index_select(a, dim, order_index)
+
+
+def tiled_forward(fcomb, feature_map, z):
+    """Fcomb.forward as it was implemented with tiling"""
+    z = torch.unsqueeze(z, 2)
+    z = tile(z, 2, feature_map.shape[2])
+    z = torch.unsqueeze(z, 3)
+    z = tile(z, 3, feature_map.shape[3])
+
+    feature_map = torch.cat((feature_map, z), dim=1)
+    output = fcomb.layers(feature_map)
+    return fcomb.last_layer(output)
+
+
+def measure(fct, repetitions, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_before = torch.cuda.memory_allocated(device)
+    time_ = time.time()
+    with torch.no_grad():
+        for _ in range(repetitions):
+            output = fct()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated(device) - memory_before
+    else:
+        peak_memory = None
+    return (time.time() - time_) / repetitions, peak_memory, output
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the latent injection of Fcomb")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--repetitions", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    num_filters = [32, 64, 128, 192]
+    latent_dim = 6
+
+    fcomb = Fcomb(num_filters, latent_dim, 1, 2, no_convs_fcomb=3,
+                  initializers={'w': 'orthogonal', 'b': 'normal'}).to(device).eval()
+
+    for size in [128, 256]:
+        feature_map = torch.randn((args.batch_size, num_filters[0], size, size), device=device)
+        z = torch.randn((args.batch_size, latent_dim), device=device)
+
+        t_tiled, m_tiled, out_tiled = measure(lambda: tiled_forward(fcomb, feature_map, z), args.repetitions, device)
+        t_split, m_split, out_split = measure(lambda: fcomb.forward(feature_map, z), args.repetitions, device)
+
+        # full size repeat and index_select of z and the concatenated input, in float32
+        tiled_bytes = 4 * args.batch_size * size * size * (2 * latent_dim + num_filters[0] + latent_dim)
+
+        print('{}x{}: tiled {:7.2f} ms, split {:7.2f} ms ({:.2f}x), materialized tiling tensors avoided: '
+              '{:.1f} MB, max |diff| {:.2e}'.format(size, size, 1000 * t_tiled, 1000 * t_split, t_tiled / t_split,
+                                                    tiled_bytes / 2 ** 20,
+                                                    (out_tiled - out_split).abs().max().item()))
+        if m_tiled is not None:
+            print('        peak memory: tiled {:.1f} MB, split {:.1f} MB'.format(m_tiled / 2 ** 20, m_split / 2 ** 20))
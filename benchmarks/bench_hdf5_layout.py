@@ -0,0 +1,102 @@
+"""Benchmark of the HDF5 layouts written by lidc_data_loader.prepare_data
+
+Writes a LIDC-like training set (smooth 128x128 crops with 4 masks) with every layout option and reports the file size
+and the latency of reading single random samples and random batches (as BatchProvider reads them). The legacy layout is the one prepare_data wrote
+before layout version 2 (float64 images, no chunking, no compression). The blosc and lz4 filters are skipped if
+hdf5plugin is not installed. Run from the repository root with
+
+    python -m benchmarks.bench_hdf5_layout --folder /tmp
+"""
+
+import os
+import time
+import argparse
+
+import h5py
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from data import lidc_data_loader
+from data.batch_provider import read_rows
+
+LAYOUTS = [('legacy', 'float64', None),
+           ('float32', 'float32', None),
+           ('float32 gzip', 'float32', 'gzip'),
+           ('float32 lzf', 'float32', 'lzf'),
+           ('float32 blosc', 'float32', 'blosc'),
+           ('float32 lz4', 'float32', 'lz4'),
+           ('float16', 'float16', None),
+           ('float16 lzf', 'float16', 'lzf')]
+
+
+def lidc_like_data(n, size):
+    rng = np.random.RandomState(0)
+    images = gaussian_filter(rng.rand(n, size, size), sigma=(0, 3, 3))
+    images = np.round((images - images.min()) / (images.max() - images.min()) * 4095) / 4095 - 0.5  # 12 bit CT
+    yy, xx = np.mgrid[:size, :size]
+    labels = np.zeros((n, size, size, 4), dtype=np.uint8)
+    for ii in range(n):
+        for aa in range(4):
+            radius = rng.uniform(5, 20)
+            labels[ii, ..., aa] = (yy - size / 2) ** 2 + (xx - size / 2) ** 2 < radius ** 2
+    return images, labels
+
+
+def write_layout(path, images, labels, image_dtype, compression):
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('train')
+        if image_dtype == 'float64':
+            group.create_dataset('labels', data=labels)
+            group.create_dataset('images', data=images)
+        else:
+            lidc_data_loader.write_subset(group, images, labels, np.arange(images.shape[0]),
+                                          image_dtype=image_dtype, compression=compression)
+
+
+def read_latency(path, batch_size, repetitions):
+    rng = np.random.RandomState(1)
+    with h5py.File(path, 'r') as f:
+        images, labels = f['train']['images'], f['train']['labels']
+        n = images.shape[0]
+
+        time_ = time.time()
+        for ii in rng.randint(n, size=repetitions):
+            images[ii]
+            labels[ii]
+        sample_latency = (time.time() - time_) / repetitions
+
+        time_ = time.time()
+        for _ in range(repetitions):
+            indices = np.sort(rng.choice(n, batch_size, replace=False))
+            read_rows(images, indices)
+            read_rows(labels, indices)
+        batch_latency = (time.time() - time_) / repetitions
+
+    return sample_latency, batch_latency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the HDF5 layouts of the LIDC data")
+    parser.add_argument("--folder", type=str, default='/tmp')
+    parser.add_argument("--n", type=int, default=2000)
+    parser.add_argument("--image_size", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--repetitions", type=int, default=200)
+    args = parser.parse_args()
+
+    images, labels = lidc_like_data(args.n, args.image_size)
+
+    print('{:>14} {:>10} {:>12} {:>12}'.format('layout', 'size MB', 'sample ms', 'batch ms'))
+    for name, image_dtype, compression in LAYOUTS:
+        path = os.path.join(args.folder, 'bench_hdf5_layout.hdf5')
+        try:
+            write_layout(path, images, labels, image_dtype, compression)
+        except ImportError as e:
+            print('{:>14} skipped: {}'.format(name, e))
+            continue
+        try:
+            size = os.path.getsize(path) / 1e6
+            sample_latency, batch_latency = read_latency(path, args.batch_size, args.repetitions)
+            print('{:>14} {:>10.1f} {:>12.3f} {:>12.3f}'.format(name, size, 1e3 * sample_latency, 1e3 * batch_latency))
+        finally:
+            os.remove(path)
@@ -0,0 +1,79 @@
+"""Benchmark of reading training batches from HDF5
+
+Compares the read throughput of the sorted fancy indexing of BatchProvider (sampler='permutation') with the chunk aware
+ChunkShuffleSampler (sampler='chunks') on a LIDC-like file, with a contiguous layout (as written by lidc_data_loader),
+chunked, and exported to memory mapped .npy files (data_format = 'npy'). The file is written to --folder, point it to a network file system to measure the
+setting the sampler was written for. Run from the repository root with
+
+    python -m benchmarks.bench_hdf5_sampling --folder /tmp
+"""
+
+import os
+import time
+import argparse
+
+import shutil
+
+import h5py
+import numpy as np
+
+from data import mmap_dataset
+from data.batch_provider import BatchProvider
+
+
+def write_file(path, n, size, chunks):
+    with h5py.File(path, 'w') as f:
+        images = f.create_dataset('images', (n, size, size), dtype=np.float32,
+                                  chunks=(chunks, size, size) if chunks else None)
+        labels = f.create_dataset('labels', (n, size, size, 4), dtype=np.uint8,
+                                  chunks=(chunks, size, size, 4) if chunks else None)
+        for start in range(0, n, 500):
+            stop = min(n, start + 500)
+            images[start:stop] = np.random.rand(stop - start, size, size)
+            labels[start:stop] = np.random.rand(stop - start, size, size, 4) > 0.5
+
+
+def megabytes_per_second(path, batch_size, n_batches, **kwargs):
+    if os.path.isdir(path):
+        return _megabytes_per_second(mmap_dataset.load_npy_dataset(path), batch_size, n_batches, **kwargs)
+    with h5py.File(path, 'r') as f:
+        return _megabytes_per_second(f, batch_size, n_batches, **kwargs)
+
+
+def _megabytes_per_second(data, batch_size, n_batches, **kwargs):
+    images, labels = data['images'], data['labels']
+    provider = BatchProvider(images, labels, np.arange(images.shape[0]), seed=0, **kwargs)
+    batch_bytes = batch_size * (images[0].nbytes + labels[0].nbytes)
+    time_ = time.time()
+    for _ in range(n_batches):
+        provider.read_next_batch(batch_size)
+    return n_batches * batch_bytes / (time.time() - time_) / 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the HDF5 batch samplers")
+    parser.add_argument("--folder", type=str, default='/tmp')
+    parser.add_argument("--n", type=int, default=4000)
+    parser.add_argument("--image_size", type=int, default=128)
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--n_batches", type=int, default=300)
+    parser.add_argument("--shuffle_buffer_size", type=int, default=512)
+    args = parser.parse_args()
+
+    print('{:>12} {:>22} {:>10}'.format('layout', 'sampler', 'MB/s'))
+    for layout, chunks in (('contiguous', None), ('chunks of 1', 1), ('chunks of 16', 16), ('npy', None)):
+        path = os.path.join(args.folder, 'bench_hdf5_sampling.hdf5')
+        write_file(path, args.n, args.image_size, chunks)
+        if layout == 'npy':
+            npy_folder = os.path.join(args.folder, 'bench_hdf5_sampling_npy')
+            mmap_dataset.export_hdf5_to_npy(path, npy_folder)
+            os.remove(path)
+            path = npy_folder
+        try:
+            throughput = megabytes_per_second(path, args.batch_size, args.n_batches)
+            print('{:>12} {:>22} {:>10.1f}'.format(layout, 'permutation', throughput))
+            throughput = megabytes_per_second(path, args.batch_size, args.n_batches, sampler='chunks',
+                                              shuffle_buffer_size=args.shuffle_buffer_size)
+            print('{:>12} {:>22} {:>10.1f}'.format(layout, 'chunks', throughput))
+        finally:
+            shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
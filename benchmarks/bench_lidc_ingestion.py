@@ -0,0 +1,120 @@
+"""Benchmark of the peak memory of the LIDC preprocessing
+
+Writes a synthetic LIDC pickle (a dict of samples with a 128x128 image, 4 masks and a series uid) and measures the peak
+resident memory of
+- the previous prepare_data, which read the whole pickle into a bytearray, unpickled it and collected all samples in
+  lists before writing,
+- the one time conversion of the pickle into a record stream,
+- the streaming prepare_data reading the record stream.
+Every step runs in a fresh process. Run from the repository root with
+
+    python -m benchmarks.bench_lidc_ingestion --folder /tmp --sizes 1000 2000 4000
+"""
+
+import os
+import sys
+import time
+import pickle
+import argparse
+import resource
+import subprocess
+
+import h5py
+import numpy as np
+from sklearn.model_selection import train_test_split
+
+from data import lidc_data_loader
+from data import record_stream
+
+
+def write_pickle(path, n, size=128):
+    rng = np.random.RandomState(0)
+    data = {}
+    for ii in range(n):
+        data['sample_%d' % ii] = {'image': rng.rand(size, size).astype(np.float32),
+                                  'masks': [(rng.rand(size, size) > 0.5).astype(np.uint8) for _ in range(4)],
+                                  'series_uid': 'series_%d' % (ii // 10)}
+    with open(path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def reference_prepare_data(input_file, output_file):
+    """prepare_data as it was implemented before the record stream (writing the current layout)"""
+
+    max_bytes = 2 ** 31 - 1
+    bytes_in = bytearray(0)
+    input_size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f_in:
+        for _ in range(0, input_size, max_bytes):
+            bytes_in += f_in.read(max_bytes)
+    data = pickle.loads(bytes_in)
+
+    series_uid = [value['series_uid'] for value in data.values()]
+    split_ids = {}
+    train_and_val_ids, split_ids['test'] = train_test_split(np.unique(series_uid), test_size=0.2)
+    split_ids['train'], split_ids['val'] = train_test_split(train_and_val_ids, test_size=0.2)
+
+    images, labels, uids = {}, {}, {}
+    for tt in ['train', 'test', 'val']:
+        images[tt], labels[tt], uids[tt] = [], [], []
+    for key, value in data.items():
+        tt = lidc_data_loader.find_subset_for_id(split_ids, value['series_uid'])
+        images[tt].append(value['image'].astype(float) - 0.5)
+        labels[tt].append(np.asarray(value['masks']).transpose((1, 2, 0)))
+        uids[tt].append(hash(value['series_uid']))
+
+    with h5py.File(output_file, 'w') as hdf5_file:
+        for tt in ['test', 'train', 'val']:
+            lidc_data_loader.write_subset(hdf5_file.create_group(tt), images[tt], labels[tt], uids[tt])
+
+
+def peak_memory_mb():
+    # VmHWM starts from zero in the new process, unlike ru_maxrss which Linux carries over from the parent on exec
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_step(step, pickle_file, folder):
+    time_ = time.time()
+    if step == 'reference':
+        reference_prepare_data(pickle_file, os.path.join(folder, 'reference.hdf5'))
+    elif step == 'convert':
+        record_stream.convert_pickle_to_record_stream(pickle_file, os.path.join(folder, 'stream.records'))
+    elif step == 'stream':
+        lidc_data_loader.prepare_data(pickle_file, os.path.join(folder, 'stream.hdf5'),
+                                      stream_file=os.path.join(folder, 'stream.records'))
+    peak_mb = peak_memory_mb()
+    print('%f %f' % (peak_mb, time.time() - time_))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the memory of the LIDC preprocessing")
+    parser.add_argument("--folder", type=str, default='/tmp')
+    parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 2000, 4000])
+    parser.add_argument("--step", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--pickle_file", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step is not None:
+        run_step(args.step, args.pickle_file, args.folder)
+        sys.exit()
+
+    folder = os.path.join(args.folder, 'bench_lidc_ingestion')
+    os.makedirs(folder, exist_ok=True)
+    pickle_file = os.path.join(folder, 'data_lidc.pickle')
+
+    print('{:>8} {:>10} {:>12} {:>16} {:>16}'.format('samples', 'pickle MB', 'step', 'peak memory MB', 'seconds'))
+    for n in args.sizes:
+        write_pickle(pickle_file, n)
+        for step in ['reference', 'convert', 'stream']:
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_lidc_ingestion', '--step', step,
+                                     '--pickle_file', pickle_file, '--folder', folder],
+                                    stdout=subprocess.PIPE, check=True).stdout.decode().split()
+            print('{:>8} {:>10.0f} {:>12} {:>16.0f} {:>16.1f}'.format(n, os.path.getsize(pickle_file) / 1e6, step,
+                                                                       float(output[-2]), float(output[-1])))
+        for file_name in os.listdir(folder):
+            os.remove(os.path.join(folder, file_name))
+    os.rmdir(folder)
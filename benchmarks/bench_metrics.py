@@ -0,0 +1,80 @@
+"""Benchmarks for the evaluation metrics in utils.py
+
+Run from the repository root with
+
+    python -m benchmarks.bench_metrics
+"""
+
+import time
+import argparse
+
+import numpy as np
+import torch
+
+import utils
+from benchmarks.metric_references import random_blobs, random_softmax, reference_generalised_energy_distance, \
+    reference_variance_ncc_dist
+
+
+def time_function(fct, repetitions, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    time_ = time.time()
+    for _ in range(repetitions):
+        result = fct()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - time_) / repetitions, result
+
+
+def benchmark_ged(n_samples, n_annotators, image_size, nlabels, repetitions, device):
+    samples = random_blobs(n_samples, image_size, device, nlabels)
+    annotations = random_blobs(n_annotators, image_size, device, nlabels).float()
+    kwargs = dict(nlabels=nlabels - 1, label_range=range(1, nlabels))
+
+    t_ref, ged_ref = time_function(
+        lambda: reference_generalised_energy_distance(samples, annotations, **kwargs), 1, device)
+    t_new, ged_new = time_function(
+        lambda: utils.generalised_energy_distance(samples, annotations, **kwargs), repetitions, device)
+
+    print('GED  N={:3d} M={} {}x{} labels={}: reference {:8.2f} ms, batched {:7.2f} ms, '
+          'speedup {:6.1f}x, |diff| {:.2e}'.format(n_samples, n_annotators, image_size, image_size, nlabels,
+                                                     1000 * t_ref, 1000 * t_new, t_ref / t_new,
+                                                     abs(ged_ref - ged_new)))
+
+
+def benchmark_ncc(n_images, n_samples, n_annotators, image_size, n_classes, repetitions, device):
+    samples = random_softmax(n_images * n_samples, n_classes, image_size, device)
+    samples = samples.view(n_images, n_samples, n_classes, image_size, image_size)
+    annotations = random_blobs(n_images * n_annotators, image_size, device, n_classes)
+    annotations = utils.convert_batch_to_onehot(annotations.unsqueeze(1).cpu(), n_classes).to(device)
+    annotations = annotations.view(n_images, n_annotators, n_classes, image_size, image_size)
+
+    def reference():
+        return [reference_variance_ncc_dist(samples[ii], annotations[ii]) for ii in range(n_images)]
+
+    t_ref, ncc_ref = time_function(reference, 1, device)
+    t_new, ncc_new = time_function(lambda: utils.variance_ncc_dist(samples, annotations), repetitions, device)
+
+    max_diff = np.max(np.abs(np.asarray(ncc_ref).flatten() - ncc_new.cpu().numpy()))
+    print('NCC  B={:3d} N={:3d} M={} {}x{} classes={}: reference {:8.2f} ms, batched {:7.2f} ms, '
+          'speedup {:6.1f}x, max |diff| {:.2e}'.format(n_images, n_samples, n_annotators, image_size, image_size,
+                                                         n_classes, 1000 * t_ref, 1000 * t_new, t_ref / t_new,
+                                                         max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation metrics")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--repetitions", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    for n_samples in [10, 16, 100]:
+        benchmark_ged(n_samples, 4, 128, 2, args.repetitions, device)
+    benchmark_ged(16, 6, 192, 3, args.repetitions, device)
+
+    for n_images in [1, 10, 100]:
+        benchmark_ncc(n_images, 16, 4, 128, 2, args.repetitions, device)
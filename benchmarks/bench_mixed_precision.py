@@ -0,0 +1,100 @@
+"""Benchmark of mixed precision training
+
+Trains PHISeg with UNetModel.train on synthetic LIDC-like data in float32 and with use_mixed_precision (bfloat16 on the
+CPU, float16 and bfloat16 on the GPU) and reports the time per training step, the peak memory and the GED on a
+validation set after training. Every mode runs in a fresh process. Run from the repository root with
+
+    python -m benchmarks.bench_mixed_precision --steps 200 --batch_size 12
+"""
+
+import sys
+import time
+import types
+import logging
+import argparse
+import subprocess
+
+import numpy as np
+import torch
+
+from data.batch_provider import BatchProvider
+from models.phiseg import PHISeg
+from train_model import UNetModel
+from benchmarks.bench_lidc_ingestion import peak_memory_mb
+
+
+def synthetic_data(n, size, annotators=4, seed=0):
+    """Smooth random images, the annotations are thresholds of the image at slightly different levels"""
+    rng = np.random.RandomState(seed)
+    coarse = rng.randn(n, size // 16, size // 16)
+    images = np.kron(coarse, np.ones((16, 16))).astype(np.float32) + 0.1 * rng.randn(n, size, size).astype(np.float32)
+    levels = 0.5 + 0.1 * rng.randn(annotators)
+    labels = np.stack([images > level for level in levels], axis=-1).astype(np.uint8)
+    return images, labels
+
+
+def exp_config(args, mixed_precision, dtype):
+    return types.SimpleNamespace(model=PHISeg, input_channels=1, n_classes=2,
+                                 filter_channels=[int(f) for f in args.filters], latent_levels=5,
+                                 no_convs_fcomb=4, beta=10.0, image_size=(1, args.image_size, args.image_size),
+                                 use_reversible=False, batch_size=args.batch_size, pretrained_model=None,
+                                 iterations=args.steps + 1, validation_frequency=args.steps + 1,
+                                 logging_frequency=args.steps + 1, annotator_range=range(4),
+                                 use_mixed_precision=mixed_precision, mixed_precision_dtype=dtype)
+
+
+def run_mode(args, mode):
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    mixed_precision = mode != 'float32'
+    model = UNetModel(exp_config(args, mixed_precision, mode), logger=logging.getLogger('bench'), tensorboard=False)
+
+    images, labels = synthetic_data(4 * args.batch_size, args.image_size)
+    val_images, val_labels = synthetic_data(args.validation_images, args.image_size, seed=1)
+    data = types.SimpleNamespace(train=BatchProvider(images, labels, np.arange(images.shape[0]),
+                                                     add_dummy_dimension=True, num_labels_per_subject=4),
+                                 validation=types.SimpleNamespace(images=val_images, labels=val_labels))
+
+    if model.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(model.device)
+    time_ = time.time()
+    model.train(data)
+    if model.device.type == 'cuda':
+        torch.cuda.synchronize()
+    seconds_per_step = (time.time() - time_) / args.steps
+
+    model.net.eval()
+    with torch.no_grad():
+        ged = torch.cat([results['ged'] for _, _, results in
+                         model._evaluate_in_passes(data.validation, args.validation_images, 16)]).mean().item()
+
+    if model.device.type == 'cuda':
+        peak_mb = torch.cuda.max_memory_allocated(model.device) / 1024 ** 2
+    else:
+        peak_mb = peak_memory_mb()
+    print('%s %f %f %f' % (model.device.type, seconds_per_step, peak_mb, ged))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark mixed precision training")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=12)
+    parser.add_argument("--image_size", type=int, default=128)
+    parser.add_argument("--filters", type=int, nargs='+', default=[32, 64, 128, 192, 192, 192, 192])
+    parser.add_argument("--validation_images", type=int, default=32)
+    parser.add_argument("--mode", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        run_mode(args, args.mode)
+        sys.exit()
+
+    modes = ['float32', 'float16', 'bfloat16'] if torch.cuda.is_available() else ['float32', 'bfloat16']
+    print('{:>10} {:>8} {:>10} {:>16} {:>10}'.format('mode', 'device', 's/step', 'peak memory MB', 'GED'))
+    for mode in modes:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_mixed_precision', '--mode', mode] + sys.argv[1:],
+                                stdout=subprocess.PIPE, check=True).stdout.decode().split()
+        device, seconds, peak_mb, ged = output[-4], float(output[-3]), float(output[-2]), float(output[-1])
+        label = 'float32' if mode == 'float32' else 'amp ' + mode
+        print('{:>10} {:>8} {:>10.3f} {:>16.0f} {:>10.4f}'.format(label, device, seconds, peak_mb, ged))
@@ -0,0 +1,67 @@
+"""Benchmark multi-sample inference of the probabilistic models
+
+Compares repeating the input patch n times through forward() with sample_n(), which evaluates the deterministic
+parts of the network once per image. Run from the repository root with
+
+    python -m benchmarks.bench_sampling
+"""
+
+import time
+import argparse
+
+import torch
+
+from models.phiseg import PHISeg
+from models.probabilistic_unet import ProbabilisticUnet
+
+
+def repeated_forward(net, patch, n):
+    patch_arrangement = patch.repeat_interleave(n, dim=0)
+    if isinstance(net, ProbabilisticUnet):
+        net.forward(patch_arrangement, training=False)
+        return net.sample(testing=True)
+    return net.forward(patch_arrangement, torch.zeros_like(patch_arrangement), training=False)
+
+
+def samples_per_second(fct, n_images, n, repetitions, device):
+    with torch.no_grad():
+        fct()  # warm up
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        time_ = time.time()
+        for _ in range(repetitions):
+            fct()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    return repetitions * n_images * n / (time.time() - time_)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark multi-sample inference")
+    parser.add_argument("--device", type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument("--image_size", type=int, default=128)
+    parser.add_argument("--images", type=int, default=1)
+    parser.add_argument("--repetitions", type=int, default=3)
+    parser.add_argument("--samples", type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    image_size = (1, args.image_size, args.image_size)
+    filter_channels = [32, 64, 128, 192, 192, 192, 192]
+
+    nets = {
+        'ProbabilisticUnet': ProbabilisticUnet(input_channels=1, num_classes=2, num_filters=filter_channels,
+                                               latent_dim=6, no_convs_fcomb=3, image_size=image_size),
+        'PHISeg': PHISeg(input_channels=1, num_classes=2, num_filters=filter_channels, image_size=image_size),
+    }
+
+    patch = torch.randn((args.images,) + image_size, device=device)
+
+    for name, net in nets.items():
+        net.to(device).eval()
+        for n in args.samples:
+            repeated = samples_per_second(lambda: repeated_forward(net, patch, n), args.images, n,
+                                          args.repetitions, device)
+            sampled = samples_per_second(lambda: net.sample_n(patch, n), args.images, n, args.repetitions, device)
+            print('{:18s} n={:3d}: repeated forward {:8.1f} samples/sec, sample_n {:8.1f} samples/sec ({:.2f}x)'
+                  .format(name, n, repeated, sampled, sampled / repeated))
@@ -0,0 +1,94 @@
+"""Reference implementations of the evaluation metrics and random inputs for them, shared by the metric benchmarks
+and the tests"""
+
+import numpy as np
+import torch
+from medpy.metric import jc
+
+import utils
+
+
+def reference_generalised_energy_distance(sample_arr, gt_arr, nlabels=1, **kwargs):
+    """Per-pair implementation of the GED as it was used before the batched version"""
+
+    def dist_fct(m1, m2):
+
+        label_range = kwargs.get('label_range', range(nlabels))
+
+        per_label_iou = []
+        for lbl in label_range:
+
+            m1_bin = (m1 == lbl)*1
+            m2_bin = (m2 == lbl)*1
+
+            if torch.sum(m1_bin) == 0 and torch.sum(m2_bin) == 0:
+                per_label_iou.append(1)
+            elif torch.sum(m1_bin) > 0 and torch.sum(m2_bin) == 0 or torch.sum(m1_bin) == 0 and torch.sum(m2_bin) > 0:
+                per_label_iou.append(0)
+            else:
+                per_label_iou.append(jc(m1_bin.detach().cpu().numpy(), m2_bin.detach().cpu().numpy()))
+
+        return 1-(sum(per_label_iou) / nlabels)
+
+    N = sample_arr.shape[0]
+    M = gt_arr.shape[0]
+
+    d_sy = [dist_fct(sample_arr[i, ...], gt_arr[j, ...]) for i in range(N) for j in range(M)]
+    d_ss = [dist_fct(sample_arr[i, ...], sample_arr[j, ...]) for i in range(N) for j in range(N)]
+    d_yy = [dist_fct(gt_arr[i, ...], gt_arr[j, ...]) for i in range(M) for j in range(M)]
+
+    return (2./(N*M))*sum(d_sy) - (1./N**2)*sum(d_ss) - (1./M**2)*sum(d_yy)
+
+
+def reference_variance_ncc_dist(sample_arr, gt_arr):
+    """Numpy implementation of the variance NCC with per-sample loops as it was used before the torch version"""
+
+    def pixel_wise_xent(m_samp, m_gt, eps=1e-8):
+        log_samples = np.log(m_samp + eps)
+        return -1.0*np.sum(m_gt*log_samples, axis=0)
+
+    sample_arr = sample_arr.detach().cpu().numpy()
+    gt_arr = gt_arr.detach().cpu().numpy()
+
+    mean_seg = np.mean(sample_arr, axis=0)
+
+    N = sample_arr.shape[0]
+    M = gt_arr.shape[0]
+
+    sX = sample_arr.shape[2]
+    sY = sample_arr.shape[3]
+
+    E_ss_arr = np.zeros((N, sX, sY))
+    for i in range(N):
+        E_ss_arr[i, ...] = pixel_wise_xent(sample_arr[i, ...], mean_seg)
+
+    E_ss = np.mean(E_ss_arr, axis=0)
+
+    E_sy_arr = np.zeros((M, N, sX, sY))
+    for j in range(M):
+        for i in range(N):
+            E_sy_arr[j, i, ...] = pixel_wise_xent(sample_arr[i, ...], gt_arr[j, ...])
+
+    E_sy = np.mean(E_sy_arr, axis=1)
+
+    ncc_list = []
+    for j in range(M):
+        ncc_list.append(utils.ncc(E_ss, E_sy[j, ...]))
+
+    return (1/M)*sum(ncc_list)
+
+
+def random_blobs(n, size, device, nlabels=2):
+    """Label maps with a random rectangle per map, some of them empty"""
+    maps = torch.zeros((n, size, size), dtype=torch.long, device=device)
+    for ii in range(n):
+        if ii % 5 == 4:
+            continue  # keep some maps empty to cover the edge cases
+        x0, y0 = torch.randint(0, size // 2, (2,)).tolist()
+        x1, y1 = torch.randint(size // 2, size, (2,)).tolist()
+        maps[ii, x0:x1, y0:y1] = torch.randint(1, nlabels, (1,)).item()
+    return maps
+
+
+def random_softmax(n, n_classes, size, device):
+    return torch.softmax(3 * torch.randn((n, n_classes, size, size), device=device), dim=1)
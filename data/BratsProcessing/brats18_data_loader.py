@@ -7,16 +7,14 @@ import os
 import numpy as np
 import logging
 import string
-import gc
 import h5py
 from skimage import transform
 
 import utils
+from data import parallel_preprocessing
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-# Maximum number of data points that can be in memory at any time
-MAX_WRITE_BUFFER = 5
 alpha_dic = {ch: n for n, ch in enumerate(string.ascii_uppercase)}
 
 def test_train_val_split(patient_id):
@@ -95,9 +93,15 @@ def crop_or_pad_slice_to_size(image, target_size, channels=None, offset=None):
 
     return output_volume
 
-def prepare_data(input_folder, output_file, size, input_channels, target_resolution):
+def prepare_data(input_folder, output_file, size, input_channels, target_resolution, num_workers=0):
     '''
     Main function that prepares a dataset from the raw challenge data to an hdf5 dataset
+
+    Every patient is read once (see _process_patient), by num_workers worker processes or, with num_workers=0, in this
+    process, and written into its preallocated index of the datasets. The bounding box of the non-zero voxels and the
+    shape of every volume are stored in the file as well, the maximum extents are computed from these. An interrupted
+    run is resumed with the patients which are not written yet, see
+    data.parallel_preprocessing.preprocess_in_parallel.
     '''
 
     if len(size) != 3:
@@ -105,15 +109,13 @@ def prepare_data(input_folder, output_file, size, input_channels, target_resolut
     if len(target_resolution) != 3:
         raise AssertionError('Inadequate number of target resolution parameters')
 
-
-    hdf5_file = h5py.File(output_file, "w")
-
     file_list = {'test': [], 'train': [], 'validation': []}
 
     logging.info('Counting files and parsing meta data...')
 
+    folders = os.listdir(input_folder)
     pid = 0
-    for folder in os.listdir(input_folder):
+    for folder in folders:
         print(folder)
         train_test = test_train_val_split(pid)
         pid = pid + 1
@@ -127,150 +129,138 @@ def prepare_data(input_folder, output_file, size, input_channels, target_resolut
     print('Debug: Check if sets add up to correct value:')
     print(n_train, n_val, n_test, n_train + n_val + n_test)
 
-    # Create datasets for images and masks
-    data = {}
-    for tt, num_points in zip(['test', 'train', 'validation'], [n_test, n_train, n_val]):
-
-        if num_points > 0:
-            print([num_points] + list(size) + [input_channels])
-            data['images_%s' % tt] = hdf5_file.create_dataset("images_%s" % tt, [num_points] + list(size) + [input_channels],
-                                                              dtype=np.float32)
-            data['masks_%s' % tt] = hdf5_file.create_dataset("masks_%s" % tt, [num_points] + list(size), dtype=np.uint8)
-            data['pids_%s' % tt] = hdf5_file.create_dataset("pids_%s" % tt, [num_points] , dtype=h5py.special_dtype(vlen=str))
-
-    mask_list = {'test': [], 'train': [], 'validation': []}
-    img_list = {'test': [], 'train': [], 'validation': []}
-    pids_list = {'test': [], 'train': [], 'validation': []}
-
-    logging.info('Parsing image files')
-
-    #get max dimension in z-axis
-    maxX = 0
-    maxY = 0
-    maxZ = 0
-    maxXCropped = 0
-    maxYCropped = 0
-    maxZCropped = 0
-    i = 0
-    for train_test in ['test', 'train', 'validation']:
-        for folder in file_list[train_test]:
-            print("Doing file {}".format(i))
-            i += 1
-
-            baseFilePath = os.path.join(input_folder, folder, folder)
-            img_c1, _, img_header = utils.load_nii(baseFilePath + "_t1.nii.gz")
-            img_c2, _, _ = utils.load_nii(baseFilePath + "_t1ce.nii.gz")
-            img_c3, _, _ = utils.load_nii(baseFilePath + "_t2.nii.gz")
-            img_c4, _, _ = utils.load_nii(baseFilePath + "_flair.nii.gz")
-            img_dat = np.stack((img_c1, img_c2, img_c3, img_c4), 3)
-
-            maxX = max(maxX, img_dat.shape[0])
-            maxY = max(maxY, img_dat.shape[1])
-            maxZ = max(maxZ, img_dat.shape[2])
-            img_dat_cropped = crop_volume_allDim(img_dat)
-            maxXCropped = max(maxXCropped, img_dat_cropped.shape[0])
-            maxYCropped = max(maxYCropped, img_dat_cropped.shape[1])
-            maxZCropped = max(maxZCropped, img_dat_cropped.shape[2])
-    print("Max x: {}, y: {}, z: {}".format(maxX, maxY, maxZ))
-    print("Max cropped x: {}, y: {}, z: {}".format(maxXCropped, maxYCropped, maxZCropped))
-
+    # One job per patient with its index in the datasets of its subset
+    jobs = []
     for train_test in ['train', 'test', 'validation']:
+        for index, folder in enumerate(file_list[train_test]):
+            jobs.append({'train_test': train_test, 'index': index, 'folder': folder,
+                         'base_file_path': os.path.join(input_folder, folder, folder),
+                         'size': list(size), 'input_channels': input_channels,
+                         'target_resolution': list(target_resolution)})
+
+    def create_datasets(hdf5_file):
+
+        # Create datasets for images and masks
+        for tt, num_points in zip(['test', 'train', 'validation'], [n_test, n_train, n_val]):
+
+            if num_points > 0:
+                print([num_points] + list(size) + [input_channels])
+                hdf5_file.create_dataset("images_%s" % tt, [num_points] + list(size) + [input_channels], dtype=np.float32)
+                hdf5_file.create_dataset("masks_%s" % tt, [num_points] + list(size), dtype=np.uint8)
+                hdf5_file.create_dataset("pids_%s" % tt, [num_points], dtype=h5py.special_dtype(vlen=str))
+                # x0, y0, z0, x1, y1, z1 of the non-zero voxels, and the shape of the raw volume
+                hdf5_file.create_dataset("bounding_boxes_%s" % tt, [num_points, 6], dtype=np.int32)
+                hdf5_file.create_dataset("volume_shapes_%s" % tt, [num_points, 3], dtype=np.int32)
 
-        write_buffer = 0
-        counter_from = 0
-
-        for folder in file_list[train_test]:
-
-            logging.info('-----------------------------------------------------------')
-            logging.info('Doing: %s' % folder)
-
-            patient_id = folder
-
-            baseFilePath = os.path.join(input_folder, folder, folder)
-            img_c1, _, img_header = utils.load_nii(baseFilePath + "_t1.nii.gz")
-            img_c2, _, _ = utils.load_nii(baseFilePath + "_t1ce.nii.gz")
-            img_c3, _, _ = utils.load_nii(baseFilePath + "_t2.nii.gz")
-            img_c4, _, _ = utils.load_nii(baseFilePath + "_flair.nii.gz")
-            mask_dat, _, _ = utils.load_nii(baseFilePath + "_seg.nii.gz")
-
-            img_dat = np.stack((img_c1, img_c2, img_c3, img_c4), 3)
-
-            img, mask = crop_volume_allDim(img_dat.copy(), mask_dat.copy())
-
-            pixel_size = (img_header.structarr['pixdim'][1],
-                          img_header.structarr['pixdim'][2],
-                          img_header.structarr['pixdim'][3])
-
-            logging.info('Pixel size:')
-            logging.info(pixel_size)
-
-            ### PROCESSING LOOP FOR 3D DATA ################################
-
-            scale_vector = [pixel_size[0] / target_resolution[0],
-                            pixel_size[1] / target_resolution[1],
-                            pixel_size[2]/ target_resolution[2]]
-
-            if scale_vector != [1.0, 1.0, 1.0]:
-                img = transform.rescale(img, scale_vector, order=1, preserve_range=True, multichannel=True, mode='constant')
-                mask = transform.rescale(mask, scale_vector, order=0, preserve_range=True, multichannel=False, mode='constant')
-
-            img = crop_or_pad_slice_to_size(img, size, input_channels)
-            mask = crop_or_pad_slice_to_size(mask, size)
-
-            img = normalise_image(img)
-
-            img_list[train_test].append(img)
-            mask_list[train_test].append(mask)
-            pids_list[train_test].append(patient_id)
-
-            write_buffer += 1
-
-            if write_buffer >= MAX_WRITE_BUFFER:
-
-                counter_to = counter_from + write_buffer
-                _write_range_to_hdf5(data, train_test, img_list, mask_list, pids_list, counter_from, counter_to)
-                _release_tmp_memory(img_list, mask_list, pids_list, train_test)
+    logging.info('Parsing image files')
 
-                # reset stuff for next iteration
-                counter_from = counter_to
-                write_buffer = 0
+    # the folders in listing order, since the split is assigned by the index of a folder
+    fingerprint = {'input_folder': os.path.abspath(input_folder),
+                   'folders': folders,
+                   'size': list(size), 'input_channels': input_channels,
+                   'target_resolution': list(target_resolution)}
 
-        logging.info('Writing remaining data')
-        counter_to = counter_from + write_buffer
+    parallel_preprocessing.preprocess_in_parallel(output_file, fingerprint, jobs, _process_patient, create_datasets,
+                                                  _write_patient, num_workers=num_workers)
 
-        if len(file_list[train_test]) > 0:
-            _write_range_to_hdf5(data, train_test, img_list, mask_list, pids_list, counter_from, counter_to)
-        _release_tmp_memory(img_list, mask_list, pids_list, train_test)
+    with h5py.File(output_file, 'r') as hdf5_file:
+        boxes = [hdf5_file['bounding_boxes_%s' % tt][()] for tt in ['test', 'train', 'validation']
+                 if 'bounding_boxes_%s' % tt in hdf5_file]
+        shapes = [hdf5_file['volume_shapes_%s' % tt][()] for tt in ['test', 'train', 'validation']
+                  if 'volume_shapes_%s' % tt in hdf5_file]
 
-    # After test train loop:
-    hdf5_file.close()
+    if len(boxes) > 0:
+        maxX, maxY, maxZ = np.concatenate(shapes).max(axis=0)
+        boxes = np.concatenate(boxes)
+        maxXCropped, maxYCropped, maxZCropped = (boxes[:, 3:] - boxes[:, :3]).max(axis=0)
+        print("Max x: {}, y: {}, z: {}".format(maxX, maxY, maxZ))
+        print("Max cropped x: {}, y: {}, z: {}".format(maxXCropped, maxYCropped, maxZCropped))
 
 
-def _write_range_to_hdf5(hdf5_data, train_test, img_list, mask_list, pids_list, counter_from, counter_to):
+def _process_patient(job):
     '''
-    Helper function to write a range of data to the hdf5 datasets
+    Loads the four modalities and the segmentation of one patient, crops them to the bounding box of the non-zero
+    voxels, rescales, pads and normalises them. Runs in the worker processes.
+    :return: The volume, mask, bounding box and raw shape, and the time spent per stage
     '''
 
-    logging.info('Writing data from %d to %d' % (counter_from, counter_to))
-
-    img_arr = np.asarray(img_list[train_test], dtype=np.float32)
-    mask_arr = np.asarray(mask_list[train_test], dtype=np.uint8)
-
-    hdf5_data['images_%s' % train_test][counter_from:counter_to, ...] = img_arr
-    hdf5_data['masks_%s' % train_test][counter_from:counter_to, ...] = mask_arr
-    hdf5_data['pids_%s' % train_test][counter_from:counter_to, ...] = pids_list[train_test]
-
-
-def _release_tmp_memory(img_list, mask_list, pids_list, train_test):
+    timer = parallel_preprocessing.StageTimer()
+    size = job['size']
+    input_channels = job['input_channels']
+    target_resolution = job['target_resolution']
+
+    logging.info('-----------------------------------------------------------')
+    logging.info('Doing: %s' % job['folder'])
+
+    baseFilePath = job['base_file_path']
+    with timer.stage('load'):
+        img_c1, _, img_header = utils.load_nii(baseFilePath + "_t1.nii.gz")
+        img_c2, _, _ = utils.load_nii(baseFilePath + "_t1ce.nii.gz")
+        img_c3, _, _ = utils.load_nii(baseFilePath + "_t2.nii.gz")
+        img_c4, _, _ = utils.load_nii(baseFilePath + "_flair.nii.gz")
+        mask_dat, _, _ = utils.load_nii(baseFilePath + "_seg.nii.gz")
+
+        img_dat = np.stack((img_c1, img_c2, img_c3, img_c4), 3)
+        del img_c1, img_c2, img_c3, img_c4
+
+    with timer.stage('crop'):
+        # Same bounding box as crop_volume_allDim, from the projections instead of the coordinates of every voxel
+        foreground = np.any(img_dat > 0, axis=3)
+        bounding_box = []
+        for axis in range(3):
+            extent = np.flatnonzero(np.any(foreground, axis=tuple(a for a in range(3) if a != axis)))
+            bounding_box.append((extent[0], extent[-1] + 1))
+        bounding_box = np.asarray(bounding_box).T.ravel()
+        x0, y0, z0, x1, y1, z1 = bounding_box
+        img = img_dat[x0:x1, y0:y1, z0:z1, :]
+        mask = mask_dat[x0:x1, y0:y1, z0:z1]
+
+    pixel_size = (img_header.structarr['pixdim'][1],
+                  img_header.structarr['pixdim'][2],
+                  img_header.structarr['pixdim'][3])
+
+    logging.info('Pixel size:')
+    logging.info(pixel_size)
+
+    ### PROCESSING LOOP FOR 3D DATA ################################
+
+    scale_vector = [pixel_size[0] / target_resolution[0],
+                    pixel_size[1] / target_resolution[1],
+                    pixel_size[2]/ target_resolution[2]]
+
+    if scale_vector != [1.0, 1.0, 1.0]:
+        with timer.stage('rescale'):
+            img = transform.rescale(img, scale_vector, order=1, preserve_range=True, multichannel=True, mode='constant')
+            mask = transform.rescale(mask, scale_vector, order=0, preserve_range=True, multichannel=False, mode='constant')
+
+    with timer.stage('pad'):
+        img = crop_or_pad_slice_to_size(img, size, input_channels)
+        mask = crop_or_pad_slice_to_size(mask, size)
+
+    with timer.stage('normalise'):
+        img = normalise_image(img)
+
+    result = {'image': np.asarray(img, dtype=np.float32),
+              'mask': np.asarray(mask, dtype=np.uint8),
+              'bounding_box': bounding_box.astype(np.int32),
+              'volume_shape': np.asarray(img_dat.shape[:3], dtype=np.int32)}
+    return result, timer.seconds
+
+
+def _write_patient(hdf5_file, job, result):
     '''
-    Helper function to reset the tmp lists and free the memory
+    Helper function to write one patient to its index of the hdf5 datasets
     '''
 
-    img_list[train_test].clear()
-    mask_list[train_test].clear()
-    pids_list[train_test].clear()
-    gc.collect()
+    train_test, index = job['train_test'], job['index']
+
+    logging.info('Writing %s to index %d of the %s data' % (job['folder'], index, train_test))
 
+    hdf5_file['images_%s' % train_test][index, ...] = result['image']
+    hdf5_file['masks_%s' % train_test][index, ...] = result['mask']
+    hdf5_file['pids_%s' % train_test][index] = job['folder']
+    hdf5_file['bounding_boxes_%s' % train_test][index] = result['bounding_box']
+    hdf5_file['volume_shapes_%s' % train_test][index] = result['volume_shape']
 
 
 def load_and_maybe_process_data(input_folder,
@@ -278,7 +268,8 @@ def load_and_maybe_process_data(input_folder,
                                 size,
                                 input_channels,
                                 target_resolution,
-                                force_overwrite=False):
+                                force_overwrite=False,
+                                num_workers=0):
     '''
     This function is used to load and if necessary preprocesses the ACDC challenge data
 
@@ -287,6 +278,7 @@ def load_and_maybe_process_data(input_folder,
     :param size: Size of the output slices/volumes in pixels/voxels
     :param target_resolution: Resolution to which the data should resampled. Should have same shape as size
     :param force_overwrite: Set this to True if you want to overwrite already preprocessed data [default: False]
+    :param num_workers: Number of processes preprocessing the patients in parallel [default: 0]
 
     :return: Returns an h5py.File handle to the dataset
     '''
@@ -303,7 +295,12 @@ def load_and_maybe_process_data(input_folder,
     if not os.path.exists(data_file_path) or force_overwrite:
         logging.info('This configuration of mode, size and target resolution has not yet been preprocessed')
         logging.info('Preprocessing now!')
-        prepare_data(input_folder, data_file_path, size, input_channels, target_resolution)
+        if force_overwrite and os.path.exists(data_file_path):
+            os.remove(data_file_path)
+        prepare_data(input_folder, data_file_path, size, input_channels, target_resolution, num_workers)
+    elif not parallel_preprocessing.is_complete(data_file_path):
+        logging.info('The preprocessing of this configuration was interrupted, resuming it now!')
+        prepare_data(input_folder, data_file_path, size, input_channels, target_resolution, num_workers)
     else:
         logging.info('Already preprocessed this configuration. Loading now!')
 
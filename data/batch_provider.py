@@ -1,10 +1,12 @@
 # Authors:
 # Christian F. Baumgartner (c.f.baumgartner@gmail.com)
 
+import multiprocessing
 import numpy as np
 
 from scipy.ndimage import zoom
 import utils
+from data.chunk_sampler import ChunkShuffleSampler
 
 import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
@@ -15,6 +17,15 @@ def resize_batch(imgs, target_size):
     sy = imgs.shape[2]
     return zoom(imgs, (1, float(target_size[0]) / sx, float(target_size[1] / sy)), order=0)
 
+def read_rows(dataset, indices):
+    '''
+    Reads the rows given by the sorted indices. h5py handles a list of indices into a chunked dataset very slowly
+    (one selection per index), reading the rows one by one is an order of magnitude faster there.
+    '''
+    if getattr(dataset, 'chunks', None):
+        return np.stack([dataset[ii] for ii in indices])
+    return dataset[indices, ...]
+
 class BatchProvider():
     """
     This is a helper class to conveniently access mini batches of training, testing and validation data
@@ -25,9 +36,22 @@ class BatchProvider():
         self.X = X
         self.y = y
         self.indices = indices
-        self.unused_indices = indices.copy()
         self.add_dummy_dimension = add_dummy_dimension
 
+        # Sampling without replacement: one permutation of the indices per epoch, sliced into batches
+        self.seed = kwargs.get('seed', None)
+        self.rng = np.random.RandomState(self.seed) if self.seed is not None else np.random
+        self.epoch_permutation = None
+        self.epoch_position = 0
+
+        # Alternatively read whole HDF5 chunks and shuffle them in a bounded buffer, see ChunkShuffleSampler
+        self.chunk_sampler = None
+        if kwargs.get('sampler', 'permutation') == 'chunks':
+            self.chunk_sampler = ChunkShuffleSampler(X, y, indices,
+                                                     read_chunk_size=kwargs.get('read_chunk_size', None),
+                                                     shuffle_buffer_size=kwargs.get('shuffle_buffer_size', 512),
+                                                     rng=self.rng)
+
         self.num_labels_per_subject = kwargs.get('num_labels_per_subject', 1)
         if self.num_labels_per_subject > 1:
             self.annotator_range = kwargs.get('annotator_range', range(self.num_labels_per_subject))
@@ -40,32 +64,73 @@ class BatchProvider():
         self.rescale_rgb = kwargs.get('rescale_rgb', None)
         self.normalise_images = True if not self.rescale_range else False  # normalise if not rescale
 
+        self.augmentation_workers = kwargs.get('augmentation_workers', 0)
+        self._augmentation_pool = None
+
     def next_batch(self, batch_size):
         """
         Get a single random batch. This implements sampling without replacement (not just on a batch level), this means 
         all the data gets sampled eventually. 
         """
 
-        if len(self.unused_indices) < batch_size:
-            self.unused_indices = self.indices
+        X_batch, y_batch = self.read_next_batch(batch_size)
+        X_batch, y_batch = self._post_process_batch(X_batch, y_batch)
+
+        return X_batch, y_batch
+
+    def read_next_batch(self, batch_size):
+        """
+        First part of next_batch: draws the indices of the next batch and reads the raw images and labels, but
+        does not post process (augment, normalise, ...) them yet. Only this part changes the state of the provider,
+        post_process_batch can run concurrently for several batches.
+        """
 
-        batch_indices = np.random.choice(self.unused_indices, batch_size, replace=False)
-        self.unused_indices = np.setdiff1d(self.unused_indices, batch_indices)
+        if self.chunk_sampler is not None:
+            X_batch, y_batch = self.chunk_sampler.next_batch(batch_size)
+        else:
+            # Start a new epoch if the remaining indices do not fill a batch, the remainder is dropped
+            if self.epoch_permutation is None or self.epoch_position + batch_size > len(self.epoch_permutation):
+                self.epoch_permutation = self.rng.permutation(self.indices)
+                self.epoch_position = 0
 
-        # HDF5 requires indices to be in increasing order
-        batch_indices = np.sort(batch_indices)
+            batch_indices = self.epoch_permutation[self.epoch_position:self.epoch_position + batch_size]
+            self.epoch_position += batch_size
 
-        X_batch = self.X[batch_indices, ...]
-        y_batch = self.y[batch_indices, ...]
+            # HDF5 requires indices to be in increasing order
+            batch_indices = np.sort(batch_indices)
 
+            X_batch = read_rows(self.X, batch_indices)
+            y_batch = read_rows(self.y, batch_indices)
 
         if self.num_labels_per_subject > 1:
             y_batch = self._select_random_label(y_batch, self.annotator_range)
 
-        X_batch, y_batch = self._post_process_batch(X_batch, y_batch)
-
         return X_batch, y_batch
 
+    def get_state(self):
+        """
+        Returns the position in the current epoch (and the state of the own random generator if a seed was given), so
+        that a resumed run continues with the same batches. The global numpy random state is not included.
+        """
+        return {'epoch_permutation': None if self.epoch_permutation is None else self.epoch_permutation.copy(),
+                'epoch_position': self.epoch_position,
+                'rng_state': self.rng.get_state() if self.seed is not None else None,
+                'chunk_sampler': self.chunk_sampler.get_state() if self.chunk_sampler is not None else None}
+
+    def set_state(self, state):
+        self.epoch_permutation = None if state['epoch_permutation'] is None else state['epoch_permutation'].copy()
+        self.epoch_position = state['epoch_position']
+        if state['rng_state'] is not None:
+            self.rng.set_state(state['rng_state'])
+        if state.get('chunk_sampler') is not None:
+            self.chunk_sampler.set_state(state['chunk_sampler'])
+
+    def post_process_batch(self, X_batch, y_batch):
+        """
+        Second part of next_batch, see read_next_batch
+        """
+        return self._post_process_batch(X_batch, y_batch)
+
     def iterate_batches(self, batch_size, shuffle=True):
         """
         Get a range of batches. Use as argument of a for loop like you would normally use 
@@ -85,8 +150,8 @@ class BatchProvider():
             # HDF5 requires indices to be in increasing order
             batch_indices = np.sort(self.indices[b_i:b_i + batch_size])
 
-            X_batch = self.X[batch_indices, ...]
-            y_batch = self.y[batch_indices, ...]
+            X_batch = read_rows(self.X, batch_indices)
+            y_batch = read_rows(self.y, batch_indices)
 
             if self.num_labels_per_subject > 1:
                 y_batch = self._select_random_label(y_batch, self.annotator_range)
@@ -98,6 +163,10 @@ class BatchProvider():
 
     def _post_process_batch(self, X_batch, y_batch):
 
+        # Images stored as float16 are only compact on disk, all processing happens in float32
+        if X_batch.dtype == np.float16:
+            X_batch = X_batch.astype(np.float32)
+
         if self.resize_to:
             X_batch = resize_batch(X_batch, self.resize_to)
             y_batch = resize_batch(y_batch, self.resize_to) if y_batch.ndim > 1 else y_batch
@@ -141,18 +210,18 @@ class BatchProvider():
         '''
         Function for augmentation of minibatches. It will transform a set of images and corresponding labels
         by a number of optional transformations. Each image/mask pair in the minibatch will be seperately transformed
-        with random parameters.
+        with random parameters, see augment_image_and_label. If augmentation_workers > 0 the pairs are distributed
+        over a pool of worker processes. Every pair gets its own seed drawn from the global numpy RNG, so the result
+        does not depend on the number of workers. With augmentation_options['backend'] == 'torch' the whole minibatch
+        is instead warped at once by data.torch_augmentation.augment_batch.
         :param images: A numpy array of shape [minibatch, X, Y, (Z), nchannels]
         :param labels: A numpy array containing a corresponding label mask
-        :param do_rotations: Rotate the input images by a random angle between -15 and 15 degrees.
-        :param do_scaleaug: Do scale augmentation by sampling one length of a square, then cropping and upsampling the image
-                            back to the original size.
-        :param do_fliplr: Perform random flips with a 50% chance in the left right direction.
         :return: A mini batch of the same size but with transformed images and masks.
         '''
 
-        def get_option(name, default):
-            return self.augmentation_options[name] if name in self.augmentation_options else default
+        if self.augmentation_options.get('backend', 'opencv') == 'torch':
+            from data import torch_augmentation
+            return torch_augmentation.augment_batch(images, labels, self.augmentation_options)
 
         try:
             import cv2
@@ -163,110 +232,146 @@ class BatchProvider():
             if images.ndim > 4:
                 raise AssertionError('Augmentation will only work with 2D images')
 
-            # If segmentation labels also augment them, otherwise don't
-            augment_labels = True if labels.ndim > 1 else False
-
-            do_rotations = get_option('do_rotations', False)
-            do_scaleaug = get_option('do_scaleaug', False)
-            do_fliplr = get_option('do_fliplr', False)
-            do_flipud = get_option('do_flipud', False)
-            do_elasticaug = get_option('do_elasticaug', False)
-            augment_every_nth = get_option('augment_every_nth', 2)  # 2 means augment half of the images
-                                                                    # 1 means augment every image
-
-            if do_rotations or do_scaleaug or do_elasticaug:
-                nlabels = get_option('nlabels', None)
-                if not nlabels:
+            options = self.augmentation_options
+            if options.get('do_rotations', False) or options.get('do_scaleaug', False) or options.get('do_elasticaug', False):
+                if not options.get('nlabels', None):
                     raise AssertionError("When doing augmentations with rotations, scaling, or elastic transformations "
                                          "the parameter 'nlabels' must be provided.")
 
-
-            new_images = []
-            new_labels = []
             num_images = images.shape[0]
-
-            for ii in range(num_images):
-
-                img = np.squeeze(images[ii, ...])
-                lbl = np.squeeze(labels[ii, ...])
-
-                coin_flip = np.random.randint(augment_every_nth)
-                if coin_flip == 0:
-
-                    # ROTATE
-                    if do_rotations:
-
-                        angles = get_option('rot_degrees', 10.0)
-                        random_angle = np.random.uniform(-angles, angles)
-                        img = utils.rotate_image(img, random_angle)
-
-                        if augment_labels:
-                            if nlabels <= 4:
-                                lbl = utils.rotate_image_as_onehot(lbl, random_angle, nlabels=nlabels)
-                            else:
-                                # If there are more than 4 labels open CV can no longer handle one-hot interpolation
-                                lbl = utils.rotate_image(lbl, random_angle, interp=cv2.INTER_NEAREST)
-
-                    # RANDOM CROP SCALE
-                    if do_scaleaug:
-
-                        offset = get_option('offset', 30)
-                        n_x, n_y = img.shape
-                        r_y = np.random.random_integers(n_y - offset, n_y)
-                        p_x = np.random.random_integers(0, n_x - r_y)
-                        p_y = np.random.random_integers(0, n_y - r_y)
-
-                        img = utils.resize_image(img[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y))
-                        if augment_labels:
-                            if nlabels <= 4:
-                                lbl = utils.resize_image_as_onehot(lbl[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y), nlabels=nlabels)
-                            else:
-                                lbl = utils.resize_image(lbl[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y), interp=cv2.INTER_NEAREST)
-
-                    # RANDOM ELASTIC DEFOMRATIONS (like in U-NET)
-                    if do_elasticaug:
-
-                        mu = 0
-                        sigma = 10
-                        n_x, n_y = img.shape
-
-                        dx = np.random.normal(mu, sigma, 9)
-                        dx_mat = np.reshape(dx, (3, 3))
-                        dx_img = utils.resize_image(dx_mat, (n_x, n_y), interp=cv2.INTER_CUBIC)
-
-                        dy = np.random.normal(mu, sigma, 9)
-                        dy_mat = np.reshape(dy, (3, 3))
-                        dy_img = utils.resize_image(dy_mat, (n_x, n_y), interp=cv2.INTER_CUBIC)
-
-                        img = utils.dense_image_warp(img, dx_img, dy_img)
-
-                        if augment_labels:
-
-                            if nlabels <= 4:
-                                lbl = utils.dense_image_warp_as_onehot(lbl, dx_img, dy_img, nlabels=nlabels)
-                            else:
-                                lbl = utils.dense_image_warp(lbl, dx_img, dy_img, interp=cv2.INTER_NEAREST, do_optimisation=False)
-
-
-                # RANDOM FLIP
-                if do_fliplr:
-                    coin_flip = np.random.randint(max(2, augment_every_nth))  # Flipping wouldn't make sense if you do it always
-                    if coin_flip == 0:
-                        img = np.fliplr(img)
-                        if augment_labels:
-                            lbl = np.fliplr(lbl)
-
-                if do_flipud:
-                    coin_flip = np.random.randint(max(2, augment_every_nth))
-                    if coin_flip == 0:
-                        img = np.flipud(img)
-                        if augment_labels:
-                            lbl = np.flipud(lbl)
-
-                new_images.append(img[...])
-                new_labels.append(lbl[...])
-
-            sampled_image_batch = np.asarray(new_images)
-            sampled_label_batch = np.asarray(new_labels)
-
-            return sampled_image_batch, sampled_label_batch
\ No newline at end of file
+            seeds = np.random.randint(2**31, size=num_images)
+            jobs = [(np.squeeze(images[ii, ...]), np.squeeze(labels[ii, ...]), options, seeds[ii])
+                    for ii in range(num_images)]
+
+            if self.augmentation_workers > 0:
+                augmented = self._get_augmentation_pool().starmap(augment_image_and_label, jobs)
+            else:
+                augmented = [augment_image_and_label(*job) for job in jobs]
+
+            sampled_image_batch = np.asarray([img for img, _ in augmented])
+            sampled_label_batch = np.asarray([lbl for _, lbl in augmented])
+
+            return sampled_image_batch, sampled_label_batch
+
+    def _get_augmentation_pool(self):
+        # The pool is created on first use, spawn avoids forking the open HDF5 file handles
+        if self._augmentation_pool is None:
+            context = multiprocessing.get_context('spawn')
+            self._augmentation_pool = context.Pool(self.augmentation_workers)
+            logging.info('Started %d augmentation worker processes' % self.augmentation_workers)
+        return self._augmentation_pool
+
+    def close(self):
+        if self._augmentation_pool is not None:
+            self._augmentation_pool.terminate()
+            self._augmentation_pool = None
+
+
+def augment_image_and_label(img, lbl, augmentation_options, seed):
+    '''
+    Randomly transforms a single image/mask pair. All random parameters are drawn from a RandomState seeded with seed,
+    which makes the function usable from worker processes.
+    :param img: A 2D numpy array
+    :param lbl: The corresponding label mask (or a scalar label, which is left untouched)
+    :param augmentation_options: dict with the options below
+    :param do_rotations: Rotate the input images by a random angle between -rot_degrees and rot_degrees.
+    :param do_scaleaug: Do scale augmentation by sampling one length of a square, then cropping and upsampling the image
+                        back to the original size.
+    :param do_fliplr: Perform random flips with a 50% chance in the left right direction.
+    :param seed: Seed of the random parameters
+    :return: The transformed image and mask
+    '''
+
+    import cv2
+
+    def get_option(name, default):
+        return augmentation_options[name] if name in augmentation_options else default
+
+    rng = np.random.RandomState(seed)
+
+    # If segmentation labels also augment them, otherwise don't
+    augment_labels = True if lbl.ndim > 1 else False
+
+    do_rotations = get_option('do_rotations', False)
+    do_scaleaug = get_option('do_scaleaug', False)
+    do_fliplr = get_option('do_fliplr', False)
+    do_flipud = get_option('do_flipud', False)
+    do_elasticaug = get_option('do_elasticaug', False)
+    augment_every_nth = get_option('augment_every_nth', 2)  # 2 means augment half of the images
+                                                            # 1 means augment every image
+    nlabels = get_option('nlabels', None)
+
+    coin_flip = rng.randint(augment_every_nth)
+    if coin_flip == 0:
+
+        # ROTATE
+        if do_rotations:
+
+            angles = get_option('rot_degrees', 10.0)
+            random_angle = rng.uniform(-angles, angles)
+            img = utils.rotate_image(img, random_angle)
+
+            if augment_labels:
+                if nlabels <= 4:
+                    lbl = utils.rotate_image_as_onehot(lbl, random_angle, nlabels=nlabels)
+                else:
+                    # If there are more than 4 labels open CV can no longer handle one-hot interpolation
+                    lbl = utils.rotate_image(lbl, random_angle, interp=cv2.INTER_NEAREST)
+
+        # RANDOM CROP SCALE
+        if do_scaleaug:
+
+            offset = get_option('offset', 30)
+            n_x, n_y = img.shape
+            r_y = rng.randint(n_y - offset, n_y + 1)
+            p_x = rng.randint(0, n_x - r_y + 1)
+            p_y = rng.randint(0, n_y - r_y + 1)
+
+            img = utils.resize_image(img[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y))
+            if augment_labels:
+                if nlabels <= 4:
+                    lbl = utils.resize_image_as_onehot(lbl[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y), nlabels=nlabels)
+                else:
+                    lbl = utils.resize_image(lbl[p_y:(p_y + r_y), p_x:(p_x + r_y)], (n_x, n_y), interp=cv2.INTER_NEAREST)
+
+        # RANDOM ELASTIC DEFOMRATIONS (like in U-NET)
+        if do_elasticaug:
+
+            mu = 0
+            sigma = 10
+            n_x, n_y = img.shape
+
+            dx = rng.normal(mu, sigma, 9)
+            dx_mat = np.reshape(dx, (3, 3))
+            dx_img = utils.resize_image(dx_mat, (n_x, n_y), interp=cv2.INTER_CUBIC)
+
+            dy = rng.normal(mu, sigma, 9)
+            dy_mat = np.reshape(dy, (3, 3))
+            dy_img = utils.resize_image(dy_mat, (n_x, n_y), interp=cv2.INTER_CUBIC)
+
+            img = utils.dense_image_warp(img, dx_img, dy_img)
+
+            if augment_labels:
+
+                if nlabels <= 4:
+                    lbl = utils.dense_image_warp_as_onehot(lbl, dx_img, dy_img, nlabels=nlabels)
+                else:
+                    lbl = utils.dense_image_warp(lbl, dx_img, dy_img, interp=cv2.INTER_NEAREST, do_optimisation=False)
+
+
+    # RANDOM FLIP
+    if do_fliplr:
+        coin_flip = rng.randint(max(2, augment_every_nth))  # Flipping wouldn't make sense if you do it always
+        if coin_flip == 0:
+            img = np.fliplr(img)
+            if augment_labels:
+                lbl = np.fliplr(lbl)
+
+    if do_flipud:
+        coin_flip = rng.randint(max(2, augment_every_nth))
+        if coin_flip == 0:
+            img = np.flipud(img)
+            if augment_labels:
+                lbl = np.flipud(lbl)
+
+    return img[...], lbl[...]
@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.utils.data
 import h5py
@@ -6,6 +7,110 @@ import time
 import random
 import data.BratsProcessing.augmentation as aug
 
+# One read only h5py handle per process and file, shared by all datasets (train/val/test) of the process
+_fileHandles = {}
+
+# Rows map the label values 0-4 to the one-hot channels
+EVALUATION_CLASSES = np.asarray([[0, 0, 0],   # background
+                                 [1, 1, 0],   # necrotic and non-enhancing tumour core: WT, TC
+                                 [1, 0, 0],   # peritumoral edema: WT
+                                 [1, 1, 0],   # (unused in BraTS 2018)
+                                 [1, 1, 1]],  # enhancing tumour: WT, TC, ET
+                                dtype=np.uint8)
+ORIGINAL_CLASSES = np.eye(5, dtype=np.uint8)
+# Channels of label values without a row: WT and TC (labels != 0 and labels != 2), none of the original classes
+EVALUATION_UNKNOWN_CLASS = np.asarray([1, 1, 0], dtype=np.uint8)
+ORIGINAL_UNKNOWN_CLASS = np.zeros(5, dtype=np.uint8)
+
+# Number of volumes converted at once when the label cache is built
+LABEL_CACHE_BUFFER = 8
+
+
+def labelLookupTable(classes, unknownClass, dtype=np.float32):
+    '''
+    Extends the rows of classes to a lookup table for every uint8 label value, label values without a row (e.g. from
+    interpolated labels) get the row unknownClass. Converting a mask is then a single gather of the table rows.
+    '''
+    table = np.empty((256, classes.shape[1]), dtype=dtype)
+    table[:] = unknownClass
+    table[:classes.shape[0]] = classes
+    return table
+
+
+EVALUATION_LOOKUP_TABLE = labelLookupTable(EVALUATION_CLASSES, EVALUATION_UNKNOWN_CLASS)
+ORIGINAL_LOOKUP_TABLE = labelLookupTable(ORIGINAL_CLASSES, ORIGINAL_UNKNOWN_CLASS)
+
+
+def convertLabels(labels, lookupTable):
+    if labels.dtype != np.uint8:
+        # fractional (interpolated) and out of range label values have no row of their own, they are looked up in the
+        # last row, which is the one of the label values without a class
+        known = (labels >= 0) & (labels < lookupTable.shape[0]) & (labels == np.floor(labels))
+        labels = np.where(known, labels, lookupTable.shape[0] - 1)
+    return np.take(lookupTable, labels.astype(np.uint8, copy=False), axis=0)
+
+
+def buildLabelCache(filePath, cachePath, mode, lookupTable):
+    '''
+    Writes the masks of one mode, converted to uint8 channel stacks with lookupTable (uint8, see labelLookupTable),
+    to the dataset "masks_<mode>" of the cache file (chunked per volume). The lookup table and the size and modification
+    time of the source file are stored with the dataset, isLabelCacheValid compares them before the cache is used.
+    '''
+    tmpPath = cachePath + ".tmp"
+    if os.path.exists(cachePath):
+        os.replace(cachePath, tmpPath)
+
+    with h5py.File(filePath, "r") as source, h5py.File(tmpPath, "a") as cache:
+        masks = source["masks_" + mode]
+        name = "masks_" + mode
+        if name in cache:
+            del cache[name]
+        shape = masks.shape + (lookupTable.shape[1],)
+        cached = cache.create_dataset(name, shape, dtype=np.uint8, chunks=(1,) + shape[1:])
+        for start in range(0, masks.shape[0], LABEL_CACHE_BUFFER):
+            stop = min(start + LABEL_CACHE_BUFFER, masks.shape[0])
+            cached[start:stop] = convertLabels(masks[start:stop], lookupTable)
+        cached.attrs["lookup_table"] = lookupTable
+        cached.attrs["source_size"] = os.path.getsize(filePath)
+        cached.attrs["source_mtime"] = os.path.getmtime(filePath)
+
+    os.replace(tmpPath, cachePath)
+
+
+def isLabelCacheValid(filePath, cachePath, mode, lookupTable):
+    if not os.path.exists(cachePath):
+        return False
+    with h5py.File(cachePath, "r") as cache:
+        name = "masks_" + mode
+        if name not in cache:
+            return False
+        attrs = cache[name].attrs
+        return np.array_equal(attrs.get("lookup_table"), lookupTable) \
+            and attrs.get("source_size") == os.path.getsize(filePath) \
+            and attrs.get("source_mtime") == os.path.getmtime(filePath)
+
+
+def getFileHandle(filePath):
+    '''
+    Returns the h5py handle of filePath of the calling process. Handles are never shared between processes: a handle
+    inherited from the parent process (e.g. by a forked DataLoader worker) is not reused.
+    '''
+    key = (os.getpid(), filePath)
+    if key not in _fileHandles:
+        _fileHandles[key] = h5py.File(filePath, "r")
+    return _fileHandles[key]
+
+
+def worker_init_fn(worker_id):
+    '''
+    worker_init_fn for DataLoaders of a BratsDataset. Opens the worker's own file handle before the first sample is read
+    and seeds numpy and random differently in every worker, otherwise all workers would draw the same augmentations.
+    '''
+    worker_info = torch.utils.data.get_worker_info()
+    np.random.seed(worker_info.seed % 2**32)
+    random.seed(worker_info.seed)
+    worker_info.dataset.openFileIfNotOpen()
+
 class BratsDataset(torch.utils.data.Dataset):
     #mode must be trian, test or val
     def __init__(self, filePath, expConfig, mode="train", randomCrop=None, hasMasks=True, returnOffsets=False):
@@ -13,6 +118,10 @@ class BratsDataset(torch.utils.data.Dataset):
         self.filePath = filePath
         self.mode = mode
         self.file = None
+        self.filePid = None
+        self.images = None
+        self.masks = None
+        self.cachedMasks = None
         self.trainOriginalClasses = expConfig.TRAIN_ORIGINAL_CLASSES
         self.randomCrop = randomCrop
         self.hasMasks = hasMasks
@@ -30,6 +139,29 @@ class BratsDataset(torch.utils.data.Dataset):
         self.sigma = expConfig.SIGMA
         self.doIntensityShift = expConfig.DO_INTENSITY_SHIFT
         self.maxIntensityShift = expConfig.MAX_INTENSITY_SHIFT
+        self.vectorizedAugmentation = getattr(expConfig, 'VECTORIZED_AUGMENTATION', False)
+        self.augmentationDevice = getattr(expConfig, 'AUGMENTATION_DEVICE', 'cpu')
+
+        # The length and the (small) metadata are read once, so that __len__ does not open the file and
+        # __getitem__ only reads the image and the mask
+        with h5py.File(self.filePath, "r") as file:
+            self.length = file["images_" + self.mode].shape[0]
+            self.pids = file["pids_" + self.mode][()]
+            if self.returnOffsets:
+                self.offsets = np.stack([file[name + "_" + self.mode][()]
+                                         for name in ["xOffsets", "yOffsets", "zOffsets"]], axis=1)
+
+        # With nearest neighbour augmentation the labels are converted after the augmentation, otherwise the converted
+        # masks can be cached on disk and read instead of the masks
+        self.labelCachePath = None
+        if getattr(expConfig, 'LABEL_CACHE', False) and self.hasMasks and not self.nnAugmentation:
+            evaluationClasses = not self.trainOriginalClasses and (self.mode != "train" or self.softAugmentation)
+            lookupTable, suffix = (EVALUATION_LOOKUP_TABLE, "evaluation") if evaluationClasses \
+                else (ORIGINAL_LOOKUP_TABLE, "original")
+            lookupTable = lookupTable.astype(np.uint8)
+            self.labelCachePath = os.path.splitext(self.filePath)[0] + "_labels_%s.hdf5" % suffix
+            if not isLabelCacheValid(self.filePath, self.labelCachePath, self.mode, lookupTable):
+                buildLabelCache(self.filePath, self.labelCachePath, self.mode, lookupTable)
 
     def __getitem__(self, index):
 
@@ -37,16 +169,18 @@ class BratsDataset(torch.utils.data.Dataset):
         self.openFileIfNotOpen()
 
         #load from hdf5 file
-        image = self.file["images_" + self.mode][index, ...]
-        if self.hasMasks: labels = self.file["masks_" + self.mode][index, ...]
+        image = self.images[index, ...]
+        if self.hasMasks and self.labelCachePath is not None:
+            labels = self.cachedMasks[index, ...].astype(np.float32)
+        elif self.hasMasks: labels = self.masks[index, ...]
 
         #Prepare data depeinding on soft/hard augmentation scheme
         if not self.nnAugmentation:
             if not self.trainOriginalClasses and (self.mode != "train" or self.softAugmentation):
-                if self.hasMasks: labels = self._toEvaluationOneHot(labels)
+                if self.hasMasks and self.labelCachePath is None: labels = self._toEvaluationOneHot(labels)
                 defaultLabelValues = np.zeros(3, dtype=np.float32)
             else:
-                if self.hasMasks: labels = self._toOrignalCategoryOneHot(labels)
+                if self.hasMasks and self.labelCachePath is None: labels = self._toOrignalCategoryOneHot(labels)
                 defaultLabelValues = np.asarray([1, 0, 0, 0, 0], dtype=np.float32)
         elif self.hasMasks:
             if labels.ndim < 4:
@@ -54,7 +188,22 @@ class BratsDataset(torch.utils.data.Dataset):
             defaultLabelValues = np.asarray([0], dtype=np.float32)
 
         #augment data
-        if self.mode == "train":
+        if self.mode == "train" and self.vectorizedAugmentation:
+            image, labels = aug.augment3DImageVectorized(image,
+                                                         labels,
+                                                         defaultLabelValues,
+                                                         self.nnAugmentation,
+                                                         self.doRotate,
+                                                         self.rotDegrees,
+                                                         self.doScale,
+                                                         self.scaleFactor,
+                                                         self.doFlip,
+                                                         self.doElasticAug,
+                                                         self.sigma,
+                                                         self.doIntensityShift,
+                                                         self.maxIntensityShift,
+                                                         device=self.augmentationDevice)
+        elif self.mode == "train":
             image, labels = aug.augment3DImage(image,
                                                labels,
                                                defaultLabelValues,
@@ -96,12 +245,10 @@ class BratsDataset(torch.utils.data.Dataset):
             labels = torch.from_numpy(labels) 
 
         #get pid
-        pid = self.file["pids_" + self.mode][index]
+        pid = self.pids[index]
 
         if self.returnOffsets:
-            xOffset = self.file["xOffsets_" + self.mode][index]
-            yOffset = self.file["yOffsets_" + self.mode][index]
-            zOffset = self.file["zOffsets_" + self.mode][index]
+            xOffset, yOffset, zOffset = self.offsets[index]
             if self.hasMasks:
                 return image, str(pid), labels, xOffset, yOffset, zOffset
             else:
@@ -113,29 +260,30 @@ class BratsDataset(torch.utils.data.Dataset):
                 return image, pid
 
     def __len__(self):
-        #lazily open file
-        self.openFileIfNotOpen()
-
-        return self.file["images_" + self.mode].shape[0]
+        return self.length
 
     def openFileIfNotOpen(self):
-        if self.file == None:
-            self.file = h5py.File(self.filePath, "r")
+        # a handle opened by another process (before the DataLoader workers were forked) is replaced
+        if self.file is None or self.filePid != os.getpid():
+            self.file = getFileHandle(self.filePath)
+            self.filePid = os.getpid()
+            self.images = self.file["images_" + self.mode]
+            if self.hasMasks: self.masks = self.file["masks_" + self.mode]
+            if self.labelCachePath is not None:
+                self.cachedMasks = getFileHandle(self.labelCachePath)["masks_" + self.mode]
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled (DataLoader workers started with spawn), they are opened again by the worker
+        state = self.__dict__.copy()
+        state.update(file=None, filePid=None, images=None, masks=None, cachedMasks=None)
+        return state
 
     def _toEvaluationOneHot(self, labels):
-        shape = labels.shape
-        out = np.zeros([shape[0], shape[1], shape[2], 3], dtype=np.float32)
-        out[:, :, :, 0] = (labels != 0)
-        out[:, :, :, 1] = (labels != 0) * (labels != 2)
-        out[:, :, :, 2] = (labels == 4)
-        return out
+        # a single gather of the lookup table rows instead of one pass over the volume per channel
+        return convertLabels(labels, EVALUATION_LOOKUP_TABLE)
 
     def _toOrignalCategoryOneHot(self, labels):
-        shape = labels.shape
-        out = np.zeros([shape[0], shape[1], shape[2], 5], dtype=np.float32)
-        for i in range(5):
-            out[:, :, :, i] = (labels == i)
-        return out
+        return convertLabels(labels, ORIGINAL_LOOKUP_TABLE)
 
     def _toOrdinal(self, labels):
         return np.argmax(labels, axis=3)
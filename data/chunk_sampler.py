@@ -0,0 +1,127 @@
+import numpy as np
+
+
+class ChunkShuffleSampler():
+    """
+    Draws training batches from HDF5 datasets with contiguous reads. The indices are grouped into blocks of consecutive
+    rows, aligned to the HDF5 chunks of the dataset. Every epoch visits the blocks in a random order, each block is read
+    with a single slice and added to a shuffle buffer, and the batches are drawn at random from that buffer. Every index
+    is used once per epoch, the remainder which does not fill a batch at the end of an epoch is dropped.
+
+    The randomness is controlled by the block size (read_chunk_size) and the buffer size (shuffle_buffer_size): the
+    larger the buffer compared to the blocks, the closer the batches are to uniform sampling.
+    """
+
+    def __init__(self, X, y, indices, read_chunk_size=None, shuffle_buffer_size=512, rng=np.random):
+
+        self.X = X
+        self.y = y
+        self.rng = rng
+        self.shuffle_buffer_size = shuffle_buffer_size
+
+        if read_chunk_size is None:
+            read_chunk_size = default_read_chunk_size(X)
+        self.read_chunk_size = read_chunk_size
+
+        # Group the (sorted) indices into blocks of rows which share a read
+        indices = np.sort(np.asarray(indices))
+        block_ids = indices // read_chunk_size
+        boundaries = np.flatnonzero(np.diff(block_ids)) + 1
+        self.blocks = np.split(indices, boundaries)
+
+        self.block_order = None
+        self.block_position = 0
+
+        # The buffer is allocated once, it is refilled while it holds less than shuffle_buffer_size images
+        capacity = shuffle_buffer_size + read_chunk_size
+        self.buffer_X = np.empty((capacity,) + tuple(X.shape[1:]), dtype=X.dtype)
+        self.buffer_y = np.empty((capacity,) + tuple(y.shape[1:]), dtype=y.dtype)
+        self.buffer_indices = np.empty((capacity,), dtype=np.int64)
+        self.buffer_count = 0
+
+    def next_batch(self, batch_size):
+        """
+        Returns the raw images and labels of the next batch
+        """
+
+        if batch_size > self.shuffle_buffer_size:
+            raise ValueError('The shuffle buffer (%d) must be at least as large as a batch (%d)'
+                             % (self.shuffle_buffer_size, batch_size))
+
+        self._fill_buffer()
+        if self.buffer_count < batch_size:
+            # End of the epoch, drop the remainder
+            self._new_epoch()
+            self._fill_buffer()
+
+        selected = self.rng.choice(self.buffer_count, batch_size, replace=False)
+        X_batch = self.buffer_X[selected]
+        y_batch = self.buffer_y[selected]
+
+        # Close the gaps with the remaining images from the end of the buffer, this only copies a batch worth of images
+        self.buffer_count -= batch_size
+        is_selected = np.zeros(self.buffer_count + batch_size, dtype=bool)
+        is_selected[selected] = True
+        gaps = np.flatnonzero(is_selected[:self.buffer_count])
+        remaining = self.buffer_count + np.flatnonzero(~is_selected[self.buffer_count:])
+        self.buffer_indices[gaps] = self.buffer_indices[remaining]
+        self.buffer_X[gaps] = self.buffer_X[remaining]
+        self.buffer_y[gaps] = self.buffer_y[remaining]
+
+        return X_batch, y_batch
+
+    def get_state(self):
+        """
+        Only the indices in the buffer are stored, set_state reads the corresponding data again
+        """
+        return {'block_order': None if self.block_order is None else self.block_order.copy(),
+                'block_position': self.block_position,
+                'buffer_indices': self.buffer_indices[:self.buffer_count].copy()}
+
+    def set_state(self, state):
+        self.block_order = None if state['block_order'] is None else state['block_order'].copy()
+        self.block_position = state['block_position']
+
+        buffer_indices = state['buffer_indices']
+        self.buffer_count = len(buffer_indices)
+        if self.buffer_count > 0:
+            # HDF5 requires indices to be in increasing order
+            order = np.argsort(buffer_indices)
+            inverse = np.argsort(order)
+            self.buffer_indices[:self.buffer_count] = buffer_indices
+            self.buffer_X[:self.buffer_count] = self.X[buffer_indices[order], ...][inverse]
+            self.buffer_y[:self.buffer_count] = self.y[buffer_indices[order], ...][inverse]
+
+    def _new_epoch(self):
+        self.block_order = self.rng.permutation(len(self.blocks))
+        self.block_position = 0
+        self.buffer_count = 0
+
+    def _fill_buffer(self):
+
+        if self.block_order is None:
+            self._new_epoch()
+
+        while self.buffer_count < self.shuffle_buffer_size and self.block_position < len(self.block_order):
+
+            block = self.blocks[self.block_order[self.block_position]]
+            self.block_position += 1
+
+            # One contiguous read of the rows spanned by the block
+            start, stop = block[0], block[-1] + 1
+            rows = block - start
+            buffer_slice = slice(self.buffer_count, self.buffer_count + len(block))
+            self.buffer_X[buffer_slice] = self.X[start:stop, ...][rows]
+            self.buffer_y[buffer_slice] = self.y[start:stop, ...][rows]
+            self.buffer_indices[buffer_slice] = block
+            self.buffer_count += len(block)
+
+
+def default_read_chunk_size(X, min_rows=32):
+    """
+    A multiple of the HDF5 chunk length along the first axis with at least min_rows rows. Contiguous (not chunked)
+    datasets and numpy arrays are read in blocks of min_rows rows.
+    """
+    chunks = getattr(X, 'chunks', None)
+    chunk_rows = chunks[0] if chunks else 1
+    return chunk_rows * int(np.ceil(min_rows / chunk_rows))
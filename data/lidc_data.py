@@ -14,6 +14,9 @@ class lidc_data():
             input_file=sys_config.data_root,
             preprocessing_folder=sys_config.preproc_folder,
             force_overwrite=False,
+            data_format=getattr(exp_config, 'data_format', 'hdf5'),
+            image_dtype=getattr(exp_config, 'hdf5_image_dtype', 'float32'),
+            compression=getattr(exp_config, 'hdf5_compression', None),
         )
 
         self.data = data
@@ -35,6 +38,11 @@ class lidc_data():
                                    add_dummy_dimension=True,
                                    do_augmentations=True,
                                    augmentation_options=augmentation_options,
+                                   augmentation_workers=getattr(exp_config, 'augmentation_workers', 0),
+                                   seed=getattr(exp_config, 'batch_order_seed', None),
+                                   sampler=getattr(exp_config, 'batch_sampler', 'permutation'),
+                                   read_chunk_size=getattr(exp_config, 'read_chunk_size', None),
+                                   shuffle_buffer_size=getattr(exp_config, 'shuffle_buffer_size', 512),
                                    num_labels_per_subject=exp_config.num_labels_per_subject,
                                    annotator_range=exp_config.annotator_range)
         self.validation = BatchProvider(data['val']['images'], data['val']['labels'], indices['val'],
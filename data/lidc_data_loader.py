@@ -6,10 +6,11 @@ import os
 import numpy as np
 import logging
 import h5py
-import pickle
 from sklearn.model_selection import train_test_split
 
 import utils
+from data import mmap_dataset
+from data import record_stream
 
 #logging.basicConfig(level=logging.info, format='%(asctime)s %(message)s')
 
@@ -43,28 +44,113 @@ def find_subset_for_id(ids_dict, id):
     raise ValueError('id was not found in any of the train/test/val subsets.')
 
 
-def prepare_data(input_file, output_file):
+# Version of the layout written by prepare_data, files without the attribute were written with float64 images and
+# without chunking or compression (version 1)
+LAYOUT_VERSION = 2
+
+# Filters which are not built into h5py and need the hdf5plugin package
+PLUGIN_COMPRESSIONS = ['blosc', 'lz4']
+
+
+def _compression_kwargs(compression, compression_opts=None):
+    '''
+    Maps the compression setting to the arguments of create_dataset. None, 'gzip' and 'lzf' are built into h5py,
+    'blosc' and 'lz4' require hdf5plugin.
+    '''
+
+    if compression is None or compression in ['gzip', 'lzf']:
+        return {'compression': compression, 'compression_opts': compression_opts}
+
+    if compression in PLUGIN_COMPRESSIONS:
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError("The compression '%s' requires the hdf5plugin package" % compression)
+        if compression == 'blosc':
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=compression_opts or 5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        return dict(hdf5plugin.LZ4())
+
+    raise ValueError('Unknown compression: %s' % compression)
+
+
+# Maximum number of samples per subset which are kept in memory before they are written
+MAX_WRITE_BUFFER = 100
+
+
+def create_subset(group, num_samples, image_shape, label_shape, image_dtype='float32', compression=None,
+                  compression_opts=None):
+    '''
+    Creates the (empty) uids, labels and images datasets of one subset (train/test/val) in an hdf5 group. Images and
+    labels are chunked per sample, so reading one sample only touches (and decompresses) its own chunk.
+    '''
+
+    # Empty datasets can neither be chunked nor compressed
+    filter_kwargs = _compression_kwargs(compression, compression_opts) if num_samples > 0 else {}
+
+    def chunks(shape):
+        return (1,) + tuple(shape) if num_samples > 0 else None
+
+    group.create_dataset('uids', (num_samples,), dtype=np.int64)
+    group.create_dataset('labels', (num_samples,) + tuple(label_shape), dtype=np.uint8, chunks=chunks(label_shape),
+                         **filter_kwargs)
+    group.create_dataset('images', (num_samples,) + tuple(image_shape), dtype=image_dtype, chunks=chunks(image_shape),
+                         **filter_kwargs)
+
+
+def write_subset(group, images, labels, uids, image_dtype='float32', compression=None, compression_opts=None):
+    '''
+    Writes the images, labels and uids of one subset at once, see create_subset
+    '''
+
+    images = np.asarray(images, dtype=image_dtype)
+    labels = np.asarray(labels, dtype=np.uint8)
+
+    create_subset(group, images.shape[0], images.shape[1:], labels.shape[1:], image_dtype, compression,
+                  compression_opts)
+    _write_range(group, images, labels, uids, 0)
+
+
+def _write_range(group, images, labels, uids, counter_from):
+    '''
+    Helper function to write a range of samples to the datasets of a subset, returns the end of the range
+    '''
+
+    counter_to = counter_from + len(uids)
+    if counter_to > counter_from:
+        group['uids'][counter_from:counter_to] = np.asarray(uids, dtype=np.int64)
+        group['labels'][counter_from:counter_to, ...] = np.asarray(labels, dtype=np.uint8)
+        group['images'][counter_from:counter_to, ...] = np.asarray(images, dtype=group['images'].dtype)
+    return counter_to
+
+
+def prepare_data(input_file, output_file, image_dtype='float32', compression=None, compression_opts=None,
+                 stream_file=None, force_overwrite=False):
     '''
     Main function that prepares a dataset from the raw challenge data to an hdf5 dataset
+
+    The pickle is first converted into a record stream (see data.record_stream), which is stored next to the output
+    file and reused as long as the pickle has the size and modification time it was converted from. The stream is then read twice: once for the series uids which determine the split, and once to
+    write the samples in buffers of at most MAX_WRITE_BUFFER samples per subset. Apart from the one time conversion
+    the memory does not grow with the size of the dataset.
+
+    :param image_dtype: 'float32' or 'float16', the dtype the images are stored with
+    :param compression: None, 'gzip', 'lzf', 'blosc' or 'lz4' (the last two require hdf5plugin)
+    :param compression_opts: Compression level for 'gzip' and 'blosc'
+    :param stream_file: Path of the record stream [default: output_file with the extension .records]
+    :param force_overwrite: Convert the pickle to the record stream again even if it is up to date [default: False]
     '''
 
-    hdf5_file = h5py.File(output_file, "w")
-    max_bytes = 2 ** 31 - 1
-
-    data = {}
-    file_path = os.fsdecode(input_file)
-    bytes_in = bytearray(0)
-    input_size = os.path.getsize(file_path)
-    with open(file_path, 'rb') as f_in:
-        for _ in range(0, input_size, max_bytes):
-            bytes_in += f_in.read(max_bytes)
-    new_data = pickle.loads(bytes_in)
-    data.update(new_data)
+    if stream_file is None:
+        stream_file = os.path.splitext(output_file)[0] + '.records'
+    if force_overwrite or not record_stream.is_up_to_date(input_file, stream_file):
+        record_stream.convert_pickle_to_record_stream(input_file, stream_file)
 
+    # First pass: the series uids and the shapes
     series_uid = []
-
-    for key, value in data.items():
+    for key, value in record_stream.iterate_records(stream_file):
         series_uid.append(value['series_uid'])
+        image_shape = value['image'].shape
+        label_shape = np.asarray(value['masks']).transpose((1, 2, 0)).shape
 
     unique_subjects = np.unique(series_uid)
 
@@ -72,23 +158,34 @@ def prepare_data(input_file, output_file):
     train_and_val_ids, split_ids['test'] = train_test_split(unique_subjects, test_size=0.2)
     split_ids['train'], split_ids['val'] = train_test_split(train_and_val_ids, test_size=0.2)
 
+    subset_of_id = {s_id: tt for tt in ['test', 'train', 'val'] for s_id in split_ids[tt]}
+    subsets = [subset_of_id[s_id] for s_id in series_uid]
+
+    hdf5_file = h5py.File(output_file, "w")
+    hdf5_file.attrs['layout_version'] = LAYOUT_VERSION
+    hdf5_file.attrs['image_dtype'] = np.dtype(image_dtype).name
+    hdf5_file.attrs['compression'] = compression or 'none'
+
     images = {}
     labels = {}
     uids = {}
     groups = {}
+    counter_from = {}
 
     for tt in ['train', 'test', 'val']:
         images[tt] = []
         labels[tt] = []
         uids[tt] = []
         groups[tt] = hdf5_file.create_group(tt)
+        counter_from[tt] = 0
+        create_subset(groups[tt], subsets.count(tt), image_shape, label_shape, image_dtype, compression,
+                      compression_opts)
 
-    for key, value in data.items():
+    # Second pass: write the samples
+    for (key, value), tt in zip(record_stream.iterate_records(stream_file), subsets):
 
         s_id = value['series_uid']
 
-        tt = find_subset_for_id(split_ids, s_id)
-
         images[tt].append(value['image'].astype(float)-0.5)
 
         lbl = np.asarray(value['masks'])  # this will be of shape 4 x 128 x 128
@@ -97,26 +194,54 @@ def prepare_data(input_file, output_file):
         labels[tt].append(lbl)
         uids[tt].append(hash(s_id))  # Checked manually that there are no collisions
 
-    for tt in ['test', 'train', 'val']:
+        if len(uids[tt]) >= MAX_WRITE_BUFFER:
+            counter_from[tt] = _write_range(groups[tt], images[tt], labels[tt], uids[tt], counter_from[tt])
+            images[tt].clear()
+            labels[tt].clear()
+            uids[tt].clear()
 
-        groups[tt].create_dataset('uids', data=np.asarray(uids[tt], dtype=np.int))
-        groups[tt].create_dataset('labels', data=np.asarray(labels[tt], dtype=np.uint8))
-        groups[tt].create_dataset('images', data=np.asarray(images[tt], dtype=np.float))
+    for tt in ['test', 'train', 'val']:
+        _write_range(groups[tt], images[tt], labels[tt], uids[tt], counter_from[tt])
 
     hdf5_file.close()
 
 
+def read_layout(data_file_path):
+    '''
+    Returns the layout attributes of a file written by prepare_data. Loads hdf5plugin if the file needs one of its
+    filters to be read.
+    '''
+
+    with h5py.File(data_file_path, 'r') as hdf5_file:
+        layout = {'layout_version': int(hdf5_file.attrs.get('layout_version', 1)),
+                  'image_dtype': hdf5_file.attrs.get('image_dtype', 'float64'),
+                  'compression': hdf5_file.attrs.get('compression', 'none')}
+
+    if layout['compression'] in PLUGIN_COMPRESSIONS:
+        import hdf5plugin  # registers the filters with h5py
+
+    return layout
+
+
 def load_and_maybe_process_data(input_file,
                                 preprocessing_folder,
-                                force_overwrite=False):
+                                force_overwrite=False,
+                                data_format='hdf5',
+                                image_dtype='float32',
+                                compression=None,
+                                compression_opts=None):
     '''
     This function is used to load and if necessary preprocesses the LIDC challenge data
 
     :param input_folder: Folder where the raw ACDC challenge data is located
     :param preprocessing_folder: Folder where the proprocessed data should be written to
     :param force_overwrite: Set this to True if you want to overwrite already preprocessed data [default: False]
+    :param image_dtype, compression, compression_opts: Layout of a newly written file, see prepare_data. An existing
+                        file is used with the layout it was written with.
+    :param data_format: 'hdf5' or 'npy'. With 'npy' the HDF5 file is additionally exported to memory mappable .npy
+                        files (see data.mmap_dataset) and these are opened instead [default: 'hdf5']
 
-    :return: Returns an h5py.File handle to the dataset
+    :return: Returns an h5py.File handle to the dataset, or a dict of memory mapped arrays for 'npy'
     '''
 
     data_file_name = 'data_lidc.hdf5'
@@ -128,11 +253,23 @@ def load_and_maybe_process_data(input_file,
     if not os.path.exists(data_file_path) or force_overwrite:
         #basic_logger.info('This configuration of mode, size and target resolution has not yet been preprocessed')
         #basic_logger.info('Preprocessing now!')
-        prepare_data(input_file, data_file_path)
+        prepare_data(input_file, data_file_path, image_dtype, compression, compression_opts,
+                     force_overwrite=force_overwrite)
     else:
         #basic_logger.info('Already preprocessed this configuration. Loading now!')
         pass
 
+    layout = read_layout(data_file_path)
+    if layout['image_dtype'] != np.dtype(image_dtype).name or layout['compression'] != (compression or 'none'):
+        logging.warning('%s was written with layout %s, which differs from the requested one. '
+                        'Use force_overwrite to rewrite it.' % (data_file_path, layout))
+
+    if data_format == 'npy':
+        npy_folder = os.path.splitext(data_file_path)[0] + '_npy'
+        if not mmap_dataset.is_exported(npy_folder, data_file_path) or force_overwrite:
+            mmap_dataset.export_hdf5_to_npy(data_file_path, npy_folder)
+        return mmap_dataset.load_npy_dataset(npy_folder)
+
     return h5py.File(data_file_path, 'r')
 
 
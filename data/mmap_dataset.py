@@ -0,0 +1,115 @@
+import os
+import json
+
+import h5py
+import numpy as np
+
+import utils
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+MANIFEST_FILE_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+
+# Maximum number of bytes copied from HDF5 at once during the export
+MAX_COPY_BYTES = 256 * 1024 ** 2
+
+
+def export_hdf5_to_npy(hdf5_file_path, output_folder):
+    '''
+    Exports every dataset of a preprocessed HDF5 file to a contiguous .npy file, which can be memory mapped. Groups are
+    kept in the file names ('train/images' is written to 'train__images.npy'). The manifest listing the datasets with
+    their shapes and dtypes, and the size and modification time of the HDF5 file, is written last, so an interrupted
+    export is not mistaken for a complete one.
+    :param hdf5_file_path: The HDF5 file written by one of the *_data_loader modules
+    :param output_folder: Folder where the .npy files and the manifest are written to
+    '''
+
+    os.makedirs(output_folder, exist_ok=True)
+    manifest_path = os.path.join(output_folder, MANIFEST_FILE_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    datasets = {}
+    with h5py.File(hdf5_file_path, 'r') as hdf5_file:
+
+        def visit(name, node):
+            if isinstance(node, h5py.Dataset):
+                datasets[name] = _export_dataset(node, name, output_folder)
+
+        hdf5_file.visititems(visit)
+
+    manifest = {'format_version': FORMAT_VERSION,
+                'source': os.path.basename(hdf5_file_path),
+                'source_signature': utils.file_signature(hdf5_file_path),
+                'datasets': datasets}
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    logging.info('Exported %d datasets from %s to %s' % (len(datasets), hdf5_file_path, output_folder))
+
+
+def _export_dataset(dataset, name, output_folder):
+
+    file_name = name.replace('/', '__') + '.npy'
+    output = np.lib.format.open_memmap(os.path.join(output_folder, file_name), mode='w+',
+                                       dtype=dataset.dtype, shape=dataset.shape)
+
+    if dataset.ndim == 0 or dataset.size == 0:
+        output[...] = dataset[()]
+    else:
+        # Copy in slabs along the first axis to bound the memory
+        rows_per_copy = max(1, MAX_COPY_BYTES // max(1, dataset[0:1].nbytes))
+        for start in range(0, dataset.shape[0], rows_per_copy):
+            stop = min(dataset.shape[0], start + rows_per_copy)
+            output[start:stop] = dataset[start:stop]
+
+    output.flush()
+    del output
+
+    return {'file': file_name, 'shape': list(dataset.shape), 'dtype': dataset.dtype.str}
+
+
+def is_exported(folder, hdf5_file_path=None):
+    '''
+    True if folder contains a complete export, and if hdf5_file_path is given, an export of the HDF5 file with its
+    current size and modification time (e.g. not of a file which has been written again since)
+    '''
+    manifest_path = os.path.join(folder, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return False
+    if hdf5_file_path is None:
+        return True
+    with open(manifest_path) as f:
+        return json.load(f).get('source_signature') == utils.file_signature(hdf5_file_path)
+
+
+def load_npy_dataset(folder):
+    '''
+    Opens a folder written by export_hdf5_to_npy. The arrays are opened read only with np.load(mmap_mode='r'), so
+    reading a batch does not go through h5py and processes sharing the arrays share the page cache.
+    :param folder: Folder containing the manifest and the .npy files
+    :return: Returns a (nested) dict of memory mapped arrays, with the same keys as the h5py.File of the HDF5 file
+    '''
+
+    with open(os.path.join(folder, MANIFEST_FILE_NAME)) as f:
+        manifest = json.load(f)
+
+    if manifest['format_version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported format version %s in %s' % (manifest['format_version'], folder))
+
+    data = {}
+    for name, info in manifest['datasets'].items():
+
+        array = np.load(os.path.join(folder, info['file']), mmap_mode='r')
+        if list(array.shape) != info['shape'] or array.dtype.str != info['dtype']:
+            raise ValueError('%s does not match the manifest in %s' % (info['file'], folder))
+
+        group = data
+        path = name.split('/')
+        for key in path[:-1]:
+            group = group.setdefault(key, {})
+        group[path[-1]] = array
+
+    return data
@@ -0,0 +1,144 @@
+import os
+import json
+import hashlib
+import time
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+class StageTimer():
+    """
+    Accumulates the time spent in named stages (loading, resampling, writing, ...), also over worker processes
+    """
+
+    def __init__(self):
+        self.seconds = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        time_ = time.time()
+        yield
+        self.add({name: time.time() - time_})
+
+    def add(self, timings):
+        for name, seconds in timings.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+    def summary(self):
+        return ', '.join('%s: %.1f s' % (name, seconds) for name, seconds in self.seconds.items())
+
+
+def is_complete(output_file):
+    '''
+    True if the file was completely written. Files written before the preprocessing was resumable do not carry the
+    fingerprint and count as complete.
+    '''
+    if not os.path.exists(output_file):
+        return False
+    try:
+        with h5py.File(output_file, 'r') as hdf5_file:
+            return bool(hdf5_file.attrs.get('complete', 'preprocessing_fingerprint' not in hdf5_file.attrs))
+    except OSError:
+        # A crash while the file was created can leave it unreadable
+        return False
+
+
+def preprocess_in_parallel(output_file, fingerprint, jobs, process_fn, create_fn, write_fn, num_workers=0,
+                           unit='patient'):
+    '''
+    Runs a preprocessing job per patient, either in the calling process (num_workers=0) or in a pool of worker
+    processes, while the calling process is the only one writing to the HDF5 file. Every job writes into its own,
+    preallocated range, so the output does not depend on the number of workers or the order in which the jobs finish.
+
+    The file records which jobs are done after each write. If a file with the same fingerprint exists but is not
+    complete, only the remaining jobs are run.
+
+    :param output_file: The HDF5 file to write
+    :param fingerprint: JSON serialisable description of the inputs and parameters, a file written with a different
+                        fingerprint is not resumed but rewritten
+    :param jobs: List of picklable job descriptions
+    :param process_fn: Module level function, process_fn(job) returns (result, timings), timings being a dict of seconds
+                       per stage
+    :param create_fn: create_fn(hdf5_file) creates the preallocated datasets in a new file
+    :param write_fn: write_fn(hdf5_file, job, result) writes the result of a job
+    :param num_workers: Number of worker processes [default: 0, i.e. run the jobs in the calling process]
+    '''
+
+    # only a digest is stored, the JSON of many jobs with long paths exceeds the 64 KB limit of an HDF5 attribute
+    fingerprint = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+    hdf5_file = _open_or_resume(output_file, fingerprint, len(jobs))
+    if 'preprocessing_done' not in hdf5_file.attrs:
+        create_fn(hdf5_file)
+        hdf5_file.attrs['preprocessing_done'] = np.zeros(len(jobs), dtype=np.uint8)
+        hdf5_file.flush()
+
+    done = hdf5_file.attrs['preprocessing_done']
+    pending = [ii for ii in range(len(jobs)) if not done[ii]]
+    if len(pending) < len(jobs):
+        logging.info('Resuming the preprocessing, %d of %d %ss are already done' % (len(jobs) - len(pending), len(jobs), unit))
+
+    timer = StageTimer()
+    time_ = time.time()
+
+    for counter, (ii, result, timings) in enumerate(_run_jobs(process_fn, [(ii, jobs[ii]) for ii in pending], num_workers)):
+
+        with timer.stage('write'):
+            write_fn(hdf5_file, jobs[ii], result)
+            done[ii] = 1
+            hdf5_file.attrs['preprocessing_done'] = done
+            hdf5_file.flush()
+        timer.add(timings)
+
+        elapsed = time.time() - time_
+        remaining = elapsed / (counter + 1) * (len(pending) - counter - 1)
+        logging.info('Preprocessed %d/%d %ss (%.1f s elapsed, %.1f s remaining)'
+                     % (counter + 1, len(pending), unit, elapsed, remaining))
+
+    hdf5_file.attrs['complete'] = True
+    hdf5_file.close()
+
+    logging.info('Preprocessing took %.1f s with %d workers. Time per stage (summed over workers): %s'
+                 % (time.time() - time_, num_workers, timer.summary()))
+
+
+def _open_or_resume(output_file, fingerprint, num_jobs):
+
+    if os.path.exists(output_file) and not is_complete(output_file):
+        try:
+            hdf5_file = h5py.File(output_file, 'a')
+        except OSError:
+            hdf5_file = None
+        if hdf5_file is not None:
+            if hdf5_file.attrs.get('preprocessing_fingerprint', None) == fingerprint \
+                    and len(hdf5_file.attrs.get('preprocessing_done', [])) == num_jobs:
+                return hdf5_file
+            hdf5_file.close()
+
+    hdf5_file = h5py.File(output_file, 'w')
+    hdf5_file.attrs['preprocessing_fingerprint'] = fingerprint
+    return hdf5_file
+
+
+def _run_job(args):
+    process_fn, ii, job = args
+    result, timings = process_fn(job)
+    return ii, result, timings
+
+
+def _run_jobs(process_fn, indexed_jobs, num_workers):
+
+    if num_workers > 0:
+        # spawn, so that the workers do not inherit the open HDF5 file
+        with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+            for output in pool.imap_unordered(_run_job, [(process_fn, ii, job) for ii, job in indexed_jobs]):
+                yield output
+    else:
+        for ii, job in indexed_jobs:
+            yield _run_job((process_fn, ii, job))
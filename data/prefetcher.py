@@ -0,0 +1,97 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+class BatchPrefetcher():
+    """
+    Prepares training batches of a BatchProvider in background threads, so that reading, augmenting and normalising
+    the next batches overlaps with the training step. Ready batches are kept as (pinned) torch tensors in a bounded
+    queue and copied to the device without blocking.
+
+    Threads are used instead of processes since the h5py datasets of the BatchProvider cannot be shared with forked
+    processes, and the OpenCV augmentation functions release the GIL.
+    """
+
+    def __init__(self, batch_provider, batch_size, device, queue_depth=4, num_workers=1):
+
+        self.batch_provider = batch_provider
+        self.batch_size = batch_size
+        self.device = device
+        self.pin_memory = device.type == 'cuda'
+
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.read_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        self.workers = []
+        for ii in range(num_workers):
+            worker = threading.Thread(target=self._worker_loop, name='BatchPrefetcher-%d' % ii, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def next_batch(self):
+        """
+        Returns the next batch as tensors on the device, images as float32 NCHW and labels as float32 NHW
+        """
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+
+        X_batch, y_batch = batch
+        return X_batch.to(self.device, non_blocking=True), y_batch.to(self.device, non_blocking=True)
+
+    def provider_state(self):
+        """
+        Returns the state of the batch provider (see BatchProvider.get_state) and the global numpy random state. Both
+        are taken under read_lock, so they are never from the middle of a batch read of a worker.
+        """
+        with self.read_lock:
+            return self.batch_provider.get_state(), np.random.get_state()
+
+    def stop(self):
+        self.stop_event.set()
+
+        # unblock workers waiting for a free slot in the queue
+        while any(worker.is_alive() for worker in self.workers):
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            for worker in self.workers:
+                worker.join(timeout=0.1)
+
+    def _worker_loop(self):
+        try:
+            while not self.stop_event.is_set():
+
+                # drawing indices and reading from HDF5 changes the state of the provider
+                with self.read_lock:
+                    X_batch, y_batch = self.batch_provider.read_next_batch(self.batch_size)
+
+                X_batch, y_batch = self.batch_provider.post_process_batch(X_batch, y_batch)
+
+                X_batch = torch.from_numpy(np.ascontiguousarray(X_batch, dtype=np.float32))
+                y_batch = torch.from_numpy(np.ascontiguousarray(y_batch, dtype=np.float32))
+                if self.pin_memory:
+                    X_batch = X_batch.pin_memory()
+                    y_batch = y_batch.pin_memory()
+
+                self._put((X_batch, y_batch))
+
+        except Exception as e:
+            logging.exception('Preparing a batch failed')
+            self._put(e)
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
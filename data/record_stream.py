@@ -0,0 +1,64 @@
+import os
+import json
+import pickle
+
+import utils
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def convert_pickle_to_record_stream(input_file, stream_file):
+    '''
+    Converts a pickled dict of samples (as the LIDC pickle) into a record stream, in which every sample is a separate
+    pickle. Unpickling the dict is done once, directly from the file (without the copy into a bytearray), and every
+    sample is released as soon as it has been written, so the memory shrinks while the stream grows. The stream is
+    written to a temporary file and renamed at the end, so an existing stream file is always complete. The size and
+    modification time of input_file are stored next to the stream, see is_up_to_date.
+    :param input_file: The pickled dict {key: sample}
+    :param stream_file: The record stream to write
+    '''
+
+    logging.info('Converting %s to the record stream %s' % (input_file, stream_file))
+
+    with open(os.fsdecode(input_file), 'rb') as f_in:
+        data = pickle.load(f_in)
+
+    tmp_file = stream_file + '.tmp'
+    num_records = 0
+    with open(tmp_file, 'wb') as f_out:
+        for key in list(data.keys()):
+            value = data.pop(key)
+            pickle.dump((key, value), f_out, protocol=pickle.HIGHEST_PROTOCOL)
+            num_records += 1
+
+    os.replace(tmp_file, stream_file)
+    with open(_source_file(stream_file), 'w') as f:
+        json.dump(utils.file_signature(input_file), f)
+    logging.info('Wrote %d records' % num_records)
+
+
+def is_up_to_date(input_file, stream_file):
+    '''
+    True if stream_file was converted from input_file with its current size and modification time
+    '''
+    if not os.path.exists(stream_file) or not os.path.exists(_source_file(stream_file)):
+        return False
+    with open(_source_file(stream_file), 'r') as f:
+        return json.load(f) == utils.file_signature(input_file)
+
+
+def _source_file(stream_file):
+    return stream_file + '.source.json'
+
+
+def iterate_records(stream_file):
+    '''
+    Generator over the (key, sample) pairs of a record stream, only one sample is in memory at a time
+    '''
+    with open(stream_file, 'rb') as f_in:
+        while True:
+            try:
+                yield pickle.load(f_in)
+            except EOFError:
+                return
@@ -0,0 +1,153 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def augment_batch(images, labels, augmentation_options, device=None):
+    '''
+    Torch counterpart of BatchProvider._augmentation_function. Instead of warping every slice with OpenCV, one sampling
+    grid per image is built which combines the rotation, the random crop scale and the elastic deformation, and all
+    images (and one-hot labels) of the minibatch are resampled with a single call to grid_sample. Accepts the same
+    option keys as the OpenCV implementation. Random parameters are drawn from the global numpy RNG.
+    :param images: A numpy array of shape [minibatch, X, Y]
+    :param labels: A numpy array containing a corresponding label mask [minibatch, X, Y] or a label per image
+    :param augmentation_options: dict of augmentation options, 'device' selects where the warping runs (default cpu)
+    :param device: Overrides augmentation_options['device']
+    :return: A mini batch of the same size but with transformed images and masks.
+    '''
+
+    def get_option(name, default):
+        return augmentation_options[name] if name in augmentation_options else default
+
+    if images.ndim > 4:
+        raise AssertionError('Augmentation will only work with 2D images')
+
+    if device is None:
+        device = get_option('device', 'cpu')
+
+    num_images, n_x, n_y = images.shape[:3]
+    images = images.reshape(num_images, n_x, n_y)
+
+    # If segmentation labels also augment them, otherwise don't
+    augment_labels = True if labels.ndim > 1 else False
+    if augment_labels:
+        labels = labels.reshape(num_images, n_x, n_y)
+
+    do_rotations = get_option('do_rotations', False)
+    do_scaleaug = get_option('do_scaleaug', False)
+    do_fliplr = get_option('do_fliplr', False)
+    do_flipud = get_option('do_flipud', False)
+    do_elasticaug = get_option('do_elasticaug', False)
+    augment_every_nth = get_option('augment_every_nth', 2)  # 2 means augment half of the images
+                                                            # 1 means augment every image
+
+    nlabels = get_option('nlabels', None)
+    if do_rotations or do_scaleaug or do_elasticaug:
+        if not nlabels:
+            raise AssertionError("When doing augmentations with rotations, scaling, or elastic transformations "
+                                 "the parameter 'nlabels' must be provided.")
+
+    # torch.tensor copies, the batch is modified in place below
+    image_tensor = torch.tensor(images, dtype=torch.float32, device=device)
+    label_tensor = torch.tensor(labels, dtype=torch.int64, device=device) if augment_labels else None
+
+    # WARP the selected subset of the images with one combined sampling grid
+    warped = np.flatnonzero(np.random.randint(augment_every_nth, size=num_images) == 0)
+    if (do_rotations or do_scaleaug or do_elasticaug) and warped.size > 0:
+
+        grid = sampling_grid(warped.size, n_x, n_y, augmentation_options, device)
+        index = torch.from_numpy(warped).to(device)
+
+        image_tensor[index] = F.grid_sample(image_tensor[index].unsqueeze(1), grid, mode='bilinear',
+                                            padding_mode='zeros', align_corners=False).squeeze(1)
+
+        if augment_labels:
+            onehot = F.one_hot(label_tensor[index], nlabels).permute(0, 3, 1, 2).float()
+            onehot = F.grid_sample(onehot, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+            # argmax over the contiguous last dimension is much faster than over the channel dimension on CPU
+            label_tensor[index] = torch.argmax(onehot.permute(0, 2, 3, 1).contiguous(), dim=-1)
+
+    # RANDOM FLIP
+    # Flipping wouldn't make sense if you do it always
+    for do_flip, dim in ((do_fliplr, 2), (do_flipud, 1)):
+        if do_flip:
+            flipped = np.flatnonzero(np.random.randint(max(2, augment_every_nth), size=num_images) == 0)
+            if flipped.size > 0:
+                index = torch.from_numpy(flipped).to(device)
+                image_tensor[index] = torch.flip(image_tensor[index], dims=(dim,))
+                if augment_labels:
+                    label_tensor[index] = torch.flip(label_tensor[index], dims=(dim,))
+
+    sampled_image_batch = image_tensor.cpu().numpy()
+    sampled_label_batch = label_tensor.cpu().numpy().astype(labels.dtype) if augment_labels else labels
+
+    return sampled_image_batch, sampled_label_batch
+
+
+def sampling_grid(num_images, n_x, n_y, augmentation_options, device='cpu'):
+    '''
+    Builds the normalised grid_sample grid of shape [num_images, X, Y, 2] for the enabled transformations. Following
+    the order of the OpenCV implementation the images are rotated, then crop scaled and then elastically deformed, so
+    an output pixel is first displaced by the deformation field, then mapped through the crop and finally rotated back.
+    All coordinates are in pixels with the pixel centres at integer positions (as in OpenCV) until the last step.
+    '''
+
+    def get_option(name, default):
+        return augmentation_options[name] if name in augmentation_options else default
+
+    grid_y, grid_x = torch.meshgrid(torch.arange(n_x, dtype=torch.float32, device=device),
+                                    torch.arange(n_y, dtype=torch.float32, device=device), indexing='ij')
+    y = grid_y.expand(num_images, n_x, n_y)
+    x = grid_x.expand(num_images, n_x, n_y)
+
+    # RANDOM ELASTIC DEFOMRATIONS (like in U-NET)
+    if get_option('do_elasticaug', False):
+
+        mu = 0
+        sigma = 10
+
+        d = torch.from_numpy(np.random.normal(mu, sigma, (num_images, 2, 3, 3)).astype(np.float32)).to(device)
+        d = torch.einsum('ik,bckl,jl->bcij', bicubic_weights(3, n_x, device), d, bicubic_weights(3, n_y, device))
+
+        x = x + d[:, 0]
+        y = y + d[:, 1]
+
+    # RANDOM CROP SCALE
+    if get_option('do_scaleaug', False):
+
+        offset = get_option('offset', 30)
+        r = np.random.randint(n_y - offset, n_y + 1, size=num_images)
+        p_x = np.random.randint(0, n_x - r + 1)
+        p_y = np.random.randint(0, n_y - r + 1)
+
+        def as_tensor(a):
+            return torch.from_numpy(a.astype(np.float32)).to(device).view(-1, 1, 1)
+
+        x = as_tensor(p_x) + (x + 0.5) * as_tensor(r / n_y) - 0.5
+        y = as_tensor(p_y) + (y + 0.5) * as_tensor(r / n_x) - 0.5
+
+    # ROTATE
+    if get_option('do_rotations', False):
+
+        angles = get_option('rot_degrees', 10.0)
+        random_angle = np.deg2rad(np.random.uniform(-angles, angles, size=num_images))
+        cos = torch.from_numpy(np.cos(random_angle).astype(np.float32)).to(device).view(-1, 1, 1)
+        sin = torch.from_numpy(np.sin(random_angle).astype(np.float32)).to(device).view(-1, 1, 1)
+
+        c_x = n_y / 2
+        c_y = n_x / 2
+        x, y = (cos * (x - c_x) - sin * (y - c_y) + c_x,
+                sin * (x - c_x) + cos * (y - c_y) + c_y)
+
+    # grid_sample expects (x, y) coordinates in [-1, 1]
+    return torch.stack(((2 * x + 1) / n_y - 1, (2 * y + 1) / n_x - 1), dim=-1)
+
+
+def bicubic_weights(n_in, n_out, device='cpu'):
+    '''
+    Bicubic upsampling is separable and linear, so upsampling the small deformation fields amounts to the matrix
+    product W_x d W_y^T with the [n_out, n_in] matrices returned here. This is a lot cheaper than calling interpolate
+    on the batch of fields.
+    '''
+    basis = torch.eye(n_in, device=device).view(n_in, 1, n_in, 1)
+    return F.interpolate(basis, size=(n_out, 1), mode='bicubic', align_corners=False).view(n_in, n_out).t()
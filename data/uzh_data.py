@@ -93,6 +93,11 @@ class uzh_data():
                                    add_dummy_dimension=True,
                                    do_augmentations=True,
                                    augmentation_options=augmentation_options,
+                                   augmentation_workers=getattr(exp_config, 'augmentation_workers', 0),
+                                   seed=getattr(exp_config, 'batch_order_seed', None),
+                                   sampler=getattr(exp_config, 'batch_sampler', 'permutation'),
+                                   read_chunk_size=getattr(exp_config, 'read_chunk_size', None),
+                                   shuffle_buffer_size=getattr(exp_config, 'shuffle_buffer_size', 512),
                                    num_labels_per_subject=1,
                                    annotator_range=annotator_range,
                                    resize_to=resize_to)
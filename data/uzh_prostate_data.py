@@ -17,15 +17,16 @@ class uzh_prostate_data():
             preprocessing_folder=sys_config.uzh_preproc_folder,
             size=exp_config.image_size[1:3],
             target_resolution=exp_config.target_resolution,
-            force_overwrite=False
-            ,
+            force_overwrite=False,
+            data_format=getattr(exp_config, 'data_format', 'hdf5'),
+            num_workers=getattr(exp_config, 'preprocessing_workers', 0),
         )
 
         self.data = data
 
         label_name = 'masks'
 
-        # the following are HDF5 datasets, not numpy arrays
+        # the following are HDF5 datasets (or memory mapped arrays), not numpy arrays
         images_train = data['images_train']
         labels_train = data['%s_train' % label_name]
 
@@ -56,6 +57,11 @@ class uzh_prostate_data():
                                    add_dummy_dimension=True,
                                    do_augmentations=True,
                                    augmentation_options=augmentation_options,
+                                   augmentation_workers=getattr(exp_config, 'augmentation_workers', 0),
+                                   seed=getattr(exp_config, 'batch_order_seed', None),
+                                   sampler=getattr(exp_config, 'batch_sampler', 'permutation'),
+                                   read_chunk_size=getattr(exp_config, 'read_chunk_size', None),
+                                   shuffle_buffer_size=getattr(exp_config, 'shuffle_buffer_size', 512),
                                    num_labels_per_subject=exp_config.num_labels_per_subject,
                                    annotator_range=exp_config.annotator_range
         )
@@ -8,18 +8,16 @@ import glob
 import numpy as np
 import logging
 import nibabel as nib
-import gc
 import h5py
 from skimage import transform
 
 import utils
+from data import parallel_preprocessing
+from data import mmap_dataset
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 
-# Maximum number of data points that can be in memory at any time
-MAX_WRITE_BUFFER = 5
-
 def crop_or_pad_slice_to_size(slice, nx, ny):
 
     x, y = slice.shape[:2]
@@ -47,12 +45,15 @@ def crop_or_pad_slice_to_size(slice, nx, ny):
 
     return slice_cropped
 
-def prepare_data(input_image_folder, input_mask_folder, output_file, size, target_resolution):
+def prepare_data(input_image_folder, input_mask_folder, output_file, size, target_resolution, num_workers=0):
     '''
     Main function that prepares a dataset from the raw challenge data to an hdf5 dataset
-    '''
 
-    hdf5_file = h5py.File(output_file, "w")
+    The patients are processed independently (see _process_patient), by num_workers worker processes or, with
+    num_workers=0, in this process. Every patient is written into its preallocated range of slices by this process, so
+    the output is the same for any number of workers. An interrupted run is resumed, see
+    data.parallel_preprocessing.preprocess_in_parallel.
+    '''
 
     expert_list = ['Readings_AH', 'Readings_EK', 'Readings_KC', 'Readings_KS', 'Readings_OD', 'Readings_UM']
     num_annotators = len(expert_list)
@@ -62,6 +63,7 @@ def prepare_data(input_image_folder, input_mask_folder, output_file, size, targe
 
     image_file_list = {'test': [], 'train': [], 'validation': []}
     mask_file_list = {'test': [], 'train': [], 'validation': []}
+    slices_per_patient = {'test': [], 'train': [], 'validation': []}
 
     num_slices = {'test': 0, 'train': 0, 'validation': 0}
 
@@ -104,10 +106,7 @@ def prepare_data(input_image_folder, input_mask_folder, output_file, size, targe
 
             nifty_img = nib.load(file_path)
             num_slices[train_test] += nifty_img.shape[2]
-
-    # Write the small datasets
-    for tt in ['test', 'train', 'validation']:
-        hdf5_file.create_dataset('patient_id_%s' % tt, data=np.asarray(patient_id_list[tt], dtype=np.uint8))
+            slices_per_patient[train_test].append(nifty_img.shape[2])
 
     nx, ny = size
     n_test = num_slices['test']
@@ -117,146 +116,129 @@ def prepare_data(input_image_folder, input_mask_folder, output_file, size, targe
     print('Debug: Check if sets add up to correct value:')
     print(n_train, n_val, n_test, n_train + n_val + n_test)
 
-    # Create datasets for images and masks
-    data = {}
-    for tt, num_points in zip(['test', 'train', 'validation'], [n_test, n_train, n_val]):
-
-        if num_points > 0:
-            data['images_%s' % tt] = hdf5_file.create_dataset("images_%s" % tt, [num_points] + list(size), dtype=np.float32)
-            data['masks_%s' % tt] = hdf5_file.create_dataset("masks_%s" % tt, [num_points] + list(size) + [num_annotators], dtype=np.uint8)
-
-    mask_list = {'test': [], 'train': [], 'validation': []}
-    img_list = {'test': [], 'train': [], 'validation': []}
-
-    logging.info('Parsing image files')
-
+    # One job per patient with its range of slices
+    jobs = []
     for train_test in ['test', 'train', 'validation']:
-
-        write_buffer = 0
         counter_from = 0
+        for img_file, mask_files, n in zip(image_file_list[train_test], mask_file_list[train_test],
+                                           slices_per_patient[train_test]):
+            jobs.append({'train_test': train_test, 'counter_from': counter_from, 'counter_to': counter_from + n,
+                         'img_file': img_file, 'mask_files': mask_files,
+                         'size': list(size), 'target_resolution': list(target_resolution)})
+            counter_from += n
 
-        patient_counter = 0
-        for img_file, mask_files in zip(image_file_list[train_test], mask_file_list[train_test]):
+    def create_datasets(hdf5_file):
 
-            patient_counter += 1
+        # Write the small datasets
+        for tt in ['test', 'train', 'validation']:
+            hdf5_file.create_dataset('patient_id_%s' % tt, data=np.asarray(patient_id_list[tt], dtype=np.uint8))
 
-            logging.info('-----------------------------------------------------------')
-            logging.info('Doing: %s' % img_file)
+        # Create datasets for images and masks
+        for tt, num_points in zip(['test', 'train', 'validation'], [n_test, n_train, n_val]):
 
-            img_dat = utils.load_nii(img_file)
-            img = img_dat[0]
+            if num_points > 0:
+                hdf5_file.create_dataset("images_%s" % tt, [num_points] + list(size), dtype=np.float32)
+                hdf5_file.create_dataset("masks_%s" % tt, [num_points] + list(size) + [num_annotators], dtype=np.uint8)
 
-            masks = []
-            for mf in mask_files:
-                mask_dat = utils.load_nii(mf)
-                masks.append(mask_dat[0])
-            masks_arr = np.asarray(masks)  # annotator, size_x, size_y, size_z
-            masks_arr = masks_arr.transpose((1,2,3,0)) # size_x, size_y, size_z, annotator
+    logging.info('Parsing image files')
 
-            img = utils.normalise_image(img)
+    parallel_preprocessing.preprocess_in_parallel(output_file, jobs, jobs, _process_patient, create_datasets,
+                                                  _write_patient, num_workers=num_workers)
 
-            pixel_size = (img_dat[2].structarr['pixdim'][1],
-                          img_dat[2].structarr['pixdim'][2],
-                          img_dat[2].structarr['pixdim'][3])
 
-            logging.info('Pixel size:')
-            logging.info(pixel_size)
+def _process_patient(job):
+    '''
+    Loads, rescales and crops the image and annotator masks of one patient. Runs in the worker processes.
+    :return: The slices and masks as float32 and uint8 arrays, and the time spent per stage
+    '''
 
-            scale_vector = [pixel_size[0] / target_resolution[0], pixel_size[1] / target_resolution[1]]
+    timer = parallel_preprocessing.StageTimer()
+    nx, ny = job['size']
+    target_resolution = job['target_resolution']
 
-            for zz in range(img.shape[2]):
+    logging.info('-----------------------------------------------------------')
+    logging.info('Doing: %s' % job['img_file'])
 
-                slice_img = np.squeeze(img[:, :, zz])
-                slice_rescaled = transform.rescale(slice_img,
-                                                   scale_vector,
-                                                   order=1,
-                                                   preserve_range=True,
-                                                   multichannel=False,
-                                                   mode='constant')
+    with timer.stage('load'):
+        img_dat = utils.load_nii(job['img_file'])
+        img = img_dat[0]
 
-                slice_mask = np.squeeze(masks_arr[:, :, zz,:])
-                mask_rescaled = transform.rescale(slice_mask,
-                                                  scale_vector,
-                                                  order=0,
-                                                  preserve_range=True,
-                                                  multichannel=True,
-                                                  mode='constant')
+        masks = []
+        for mf in job['mask_files']:
+            mask_dat = utils.load_nii(mf)
+            masks.append(mask_dat[0])
+        masks_arr = np.asarray(masks)  # annotator, size_x, size_y, size_z
+        masks_arr = masks_arr.transpose((1,2,3,0)) # size_x, size_y, size_z, annotator
 
-                slice_cropped = crop_or_pad_slice_to_size(slice_rescaled, nx, ny)
-                mask_cropped = crop_or_pad_slice_to_size(mask_rescaled, nx, ny)
+    with timer.stage('normalise'):
+        img = utils.normalise_image(img)
 
-                # REMOVE SEMINAL VESICLES
-                mask_cropped[mask_cropped==3] = 0
+    pixel_size = (img_dat[2].structarr['pixdim'][1],
+                  img_dat[2].structarr['pixdim'][2],
+                  img_dat[2].structarr['pixdim'][3])
 
-                # DEBUG
-                # import matplotlib.pyplot as plt
-                # plt.figure()
-                # plt.imshow(slice_img)
-                #
-                # plt.figure()
-                # plt.imshow(slice_rescaled)
-                #
-                # plt.figure()
-                # plt.imshow(slice_cropped)
-                #
-                # plt.show()
-                # END DEBUG
+    logging.info('Pixel size:')
+    logging.info(pixel_size)
 
-                img_list[train_test].append(slice_cropped)
-                mask_list[train_test].append(mask_cropped)
+    scale_vector = [pixel_size[0] / target_resolution[0], pixel_size[1] / target_resolution[1]]
 
-                write_buffer += 1
+    img_list = []
+    mask_list = []
 
-                # Writing needs to happen inside the loop over the slices
-                if write_buffer >= MAX_WRITE_BUFFER:
-                    counter_to = counter_from + write_buffer
-                    _write_range_to_hdf5(data, train_test, img_list, mask_list, counter_from, counter_to)
-                    _release_tmp_memory(img_list, mask_list, train_test)
+    for zz in range(img.shape[2]):
 
-                    # reset stuff for next iteration
-                    counter_from = counter_to
-                    write_buffer = 0
+        with timer.stage('rescale'):
+            slice_img = np.squeeze(img[:, :, zz])
+            slice_rescaled = transform.rescale(slice_img,
+                                               scale_vector,
+                                               order=1,
+                                               preserve_range=True,
+                                               multichannel=False,
+                                               mode='constant')
 
+            slice_mask = np.squeeze(masks_arr[:, :, zz,:])
+            mask_rescaled = transform.rescale(slice_mask,
+                                              scale_vector,
+                                              order=0,
+                                              preserve_range=True,
+                                              multichannel=True,
+                                              mode='constant')
 
-        # after file loop: Write the remaining data
+        with timer.stage('crop'):
+            slice_cropped = crop_or_pad_slice_to_size(slice_rescaled, nx, ny)
+            mask_cropped = crop_or_pad_slice_to_size(mask_rescaled, nx, ny)
 
-        logging.info('Writing remaining data')
-        counter_to = counter_from + write_buffer
+            # REMOVE SEMINAL VESICLES
+            mask_cropped[mask_cropped==3] = 0
 
-        _write_range_to_hdf5(data, train_test, img_list, mask_list, counter_from, counter_to)
-        _release_tmp_memory(img_list, mask_list, train_test)
+        img_list.append(slice_cropped)
+        mask_list.append(mask_cropped)
 
-    # After test train loop:
-    hdf5_file.close()
+    result = {'images': np.asarray(img_list, dtype=np.float32), 'masks': np.asarray(mask_list, dtype=np.uint8)}
+    return result, timer.seconds
 
-def _write_range_to_hdf5(hdf5_data, train_test, img_list, mask_list, counter_from, counter_to):
+
+def _write_patient(hdf5_file, job, result):
     '''
-    Helper function to write a range of data to the hdf5 datasets
+    Helper function to write the slices of one patient to its range of the hdf5 datasets
     '''
 
-    logging.info('Writing data from %d to %d' % (counter_from, counter_to))
-
-    img_arr = np.asarray(img_list[train_test], dtype=np.float32)
-    mask_arr = np.asarray(mask_list[train_test], dtype=np.uint8)
+    train_test, counter_from, counter_to = job['train_test'], job['counter_from'], job['counter_to']
 
-    hdf5_data['images_%s' % train_test][counter_from:counter_to, ...] = img_arr
-    hdf5_data['masks_%s' % train_test][counter_from:counter_to, ...] = mask_arr
+    logging.info('Writing data from %d to %d' % (counter_from, counter_to))
 
-def _release_tmp_memory(img_list, mask_list, train_test):
-    '''
-    Helper function to reset the tmp lists and free the memory
-    '''
+    hdf5_file['images_%s' % train_test][counter_from:counter_to, ...] = result['images']
+    hdf5_file['masks_%s' % train_test][counter_from:counter_to, ...] = result['masks']
 
-    img_list[train_test].clear()
-    mask_list[train_test].clear()
-    gc.collect()
 
 def load_and_maybe_process_data(input_image_folder,
                                 input_mask_folder,
                                 preprocessing_folder,
                                 size,
                                 target_resolution,
-                                force_overwrite=False):
+                                force_overwrite=False,
+                                data_format='hdf5',
+                                num_workers=0):
     '''
     This function is used to load and if necessary preprocesses the ACDC challenge data
     :param input_folder: Folder where the raw ACDC challenge data is located
@@ -265,7 +247,10 @@ def load_and_maybe_process_data(input_image_folder,
     :param size: Size of the output slices/volumes in pixels/voxels
     :param target_resolution: Resolution to which the data should resampled. Should have same shape as size
     :param force_overwrite: Set this to True if you want to overwrite already preprocessed data [default: False]
-    :return: Returns an h5py.File handle to the dataset
+    :param data_format: 'hdf5' or 'npy'. With 'npy' the HDF5 file is additionally exported to memory mappable .npy
+                        files (see data.mmap_dataset) and these are opened instead [default: 'hdf5']
+    :param num_workers: Number of processes preprocessing the patients in parallel [default: 0]
+    :return: Returns an h5py.File handle to the dataset, or a dict of memory mapped arrays for 'npy'
     '''
 
     size_str = '_'.join([str(i) for i in size])
@@ -280,10 +265,22 @@ def load_and_maybe_process_data(input_image_folder,
     if not os.path.exists(data_file_path) or force_overwrite:
         logging.info('This configuration of mode, size and target resolution has not yet been preprocessed')
         logging.info('Preprocessing now!')
-        prepare_data(input_image_folder, input_mask_folder, data_file_path, size, target_resolution)
+        if force_overwrite and os.path.exists(data_file_path):
+            os.remove(data_file_path)
+        prepare_data(input_image_folder, input_mask_folder, data_file_path, size, target_resolution, num_workers)
+    elif not parallel_preprocessing.is_complete(data_file_path):
+        logging.info('The preprocessing of this configuration was interrupted, resuming it now!')
+        prepare_data(input_image_folder, input_mask_folder, data_file_path, size, target_resolution, num_workers)
     else:
         logging.info('Already preprocessed this configuration. Loading now!')
 
+    if data_format == 'npy':
+        npy_folder = os.path.splitext(data_file_path)[0] + '_npy'
+        if not mmap_dataset.is_exported(npy_folder, data_file_path) or force_overwrite:
+            logging.info('Exporting to memory mappable files')
+            mmap_dataset.export_hdf5_to_npy(data_file_path, npy_folder)
+        return mmap_dataset.load_npy_dataset(npy_folder)
+
     return h5py.File(data_file_path, 'r')
 
 
@@ -12,6 +12,8 @@ import pickle
 from torch.utils.data import DataLoader
 from torch.utils.data.sampler import SubsetRandomSampler
 
+from data import record_stream
+
 
 def load_data_into_loader(sys_config, name, batch_size, transform=None):
     location = os.path.join(sys_config.data_root, name)
@@ -43,25 +45,21 @@ class LIDC_IDRI(Dataset):
 
     def __init__(self, dataset_location, transform=None):
         self.transform = transform
-        max_bytes = 2**31 - 1
-        data = {}
         for file in os.listdir(dataset_location):
             filename = os.fsdecode(file)
-            if '.pickle' in filename:
+            file_path = dataset_location + filename
+            if filename.endswith('.records'):
+                # record stream written by data.record_stream, read one sample at a time
+                print("Loading file", filename)
+                for key, value in record_stream.iterate_records(file_path):
+                    self._add_sample(value)
+            elif '.pickle' in filename:
                 print("Loading file", filename)
-                file_path = dataset_location + filename
-                bytes_in = bytearray(0)
-                input_size = os.path.getsize(file_path)
                 with open(file_path, 'rb') as f_in:
-                    for _ in range(0, input_size, max_bytes):
-                        bytes_in += f_in.read(max_bytes)
-                new_data = pickle.loads(bytes_in)
-                data.update(new_data)
-        
-        for key, value in data.items():
-            self.images.append(value['image'].astype(float))
-            self.labels.append(value['masks'])
-            self.series_uid.append(value['series_uid'])
+                    new_data = pickle.load(f_in)
+                # release every sample of the pickle as soon as it is converted
+                for key in list(new_data.keys()):
+                    self._add_sample(new_data.pop(key))
 
         assert (len(self.images) == len(self.labels) == len(self.series_uid))
 
@@ -70,8 +68,10 @@ class LIDC_IDRI(Dataset):
         for label in self.labels:
             assert np.max(label) <= 1 and np.min(label) >= 0
 
-        del new_data
-        del data
+    def _add_sample(self, value):
+        self.images.append(value['image'].astype(float))
+        self.labels.append(value['masks'])
+        self.series_uid.append(value['series_uid'])
 
     def __getitem__(self, index):
         image = np.expand_dims(self.images[index], axis=0)
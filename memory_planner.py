@@ -0,0 +1,265 @@
+"""
+Memory budget planner for PHISeg
+
+Profiles every resolution level of the Posterior/prior and the Likelihood once per execution mode (plain, activation
+checkpointing and reversible blocks) and chooses the mode of every level which gives the fastest training step whose
+estimated memory fits the budget. The plan is written as JSON and used by setting memory_plan in the experiment config:
+
+    python memory_planner.py models/experiments/phiseg_uzh_7_5_512.py --budget_mb 11000 --output phiseg_512.json
+
+The memory of a level is the memory of the activations kept for the backward pass (counted with saved tensor hooks,
+plus the inputs of the checkpointed segments and the outputs of the reversible sequences) and of its parameters,
+gradients and Adam state. The additional time of a mode is the measured difference of the step times of the plain
+and of the mode's network, split over the levels in proportion to their forward time. The profile runs with a small
+batch, memory and time are scaled to the batch size of the plan.
+"""
+
+import json
+import time
+import argparse
+import itertools
+from importlib.machinery import SourceFileLoader
+
+import torch
+import revtorch as rv
+
+from models.phiseg import PHISeg
+
+MODES = ['plain', 'checkpoint', 'reversible']
+
+# parameters, gradients and the two Adam moments
+OPTIMIZER_COPIES = 4
+
+
+def load_plan(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def build_net(exp_config, mode, image_size):
+    resolution_levels = len(exp_config.filter_channels)
+    return exp_config.model(input_channels=exp_config.input_channels,
+                            num_classes=exp_config.n_classes,
+                            num_filters=exp_config.filter_channels,
+                            latent_levels=exp_config.latent_levels,
+                            no_convs_fcomb=exp_config.no_convs_fcomb,
+                            beta=exp_config.beta,
+                            image_size=image_size,
+                            reversible=mode == 'reversible',
+                            checkpoint_levels=range(resolution_levels) if mode == 'checkpoint' else ())
+
+
+def level_modules(net):
+    """
+    List of (resolution level, module, checkpointed) of the blocks of PHISeg, checkpointed is True for the modules
+    whose input is the input of a checkpointed segment
+    """
+    modules = []
+    for path in [net.posterior, net.prior]:
+        latent_levels, lvl_diff = path.latent_levels, path.lvl_diff
+        modules += [(i, block, block.checkpoint) for i, block in enumerate(path.contracting_path)]
+        modules += [(latent_levels - 1 - i + lvl_diff, block, block.checkpoint)
+                    for i, block in enumerate(path.sample_z_path)]
+        # the last upsampling block is not used
+        modules += [(latent_levels - 2 - i + lvl_diff, block, block.checkpoint)
+                    for i, block in enumerate(path.upsampling_path) if i < latent_levels - 1]
+
+    likelihood = net.likelihood
+    for i, (ups, post_ups) in enumerate(zip(likelihood.likelihood_ups_path, likelihood.likelihood_post_ups_path)):
+        level = likelihood.latent_levels - 1 - i
+        modules += [(level, ups, level in likelihood.checkpoint_levels), (level, post_ups, False)]
+    modules += [(i, block, i in likelihood.checkpoint_levels)
+                for i, block in enumerate(likelihood.likelihood_post_c_path)]
+    return modules
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def profile(net, patch, mask, steps=3):
+    """
+    Profiles a training step of net. Returns the step time, the bytes kept for the backward pass and the
+    parameter bytes per level (level None for everything outside of the level modules) and the forward time per
+    level.
+    """
+    device = patch.device
+    modules = level_modules(net)
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+
+    def step():
+        optimizer.zero_grad()
+        net.forward(patch, mask, training=True)
+        net.loss(mask).backward()
+        optimizer.step()
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    # the first step allocates the optimizer state
+    step()
+    synchronize()
+    time_ = time.time()
+    for _ in range(steps):
+        step()
+    synchronize()
+    step_seconds = (time.time() - time_) / steps
+
+    saved_bytes, forward_seconds, parameter_bytes = {None: 0}, {}, {None: 0}
+    seen = set()
+    current = [None]
+    started = {}
+
+    for level, module, _ in modules:
+        saved_bytes[level] = 0
+        forward_seconds[level] = 0.0
+        parameter_bytes[level] = parameter_bytes.get(level, 0) + sum(tensor_bytes(p) for p in module.parameters())
+    parameter_bytes[None] = sum(tensor_bytes(p) for p in net.parameters()) - sum(parameter_bytes.values())
+
+    def add_saved(level, tensor):
+        key = (tensor.data_ptr(), tensor.shape, tensor.dtype)
+        if tensor.data_ptr() != 0 and key not in seen:
+            seen.add(key)
+            saved_bytes[level] += tensor_bytes(tensor)
+
+    def pack(tensor):
+        add_saved(current[-1], tensor)
+        return tensor
+
+    def pre_hook(level, checkpointed, module, args):
+        synchronize()
+        current.append(level)
+        started[module] = time.time()
+        # the checkpoint keeps the input of the segment for the recomputation
+        if checkpointed:
+            add_saved(level, args[0])
+
+    def post_hook(level, module, args, output):
+        synchronize()
+        forward_seconds[level] += time.time() - started.pop(module)
+        current.pop()
+
+    def reversible_hook(module, args, output):
+        # revtorch keeps the output of a reversible sequence for the backward pass, outside of the autograd graph
+        add_saved(current[-1], output)
+
+    handles = []
+    for level, module, checkpointed in modules:
+        handles.append(module.register_forward_pre_hook(
+            lambda module, args, level=level, checkpointed=checkpointed: pre_hook(level, checkpointed, module, args)))
+        handles.append(module.register_forward_hook(
+            lambda module, args, output, level=level: post_hook(level, module, args, output)))
+    handles += [module.register_forward_hook(reversible_hook)
+                for module in net.modules() if isinstance(module, rv.ReversibleSequence)]
+
+    optimizer.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        net.forward(patch, mask, training=True)
+        loss = net.loss(mask)
+    for handle in handles:
+        handle.remove()
+    loss.backward()
+
+    return {'step_seconds': step_seconds, 'saved_bytes': saved_bytes, 'parameter_bytes': parameter_bytes,
+            'forward_seconds': forward_seconds}
+
+
+def plan_levels(profiles, budget_bytes, scale=1.0):
+    """
+    Chooses the mode of every level with the lowest estimated step time whose estimated memory is within
+    budget_bytes, by trying all combinations. The activations and the time of the profiles are multiplied by scale.
+    Returns the modes per level and the estimated memory and step time, raises a ValueError if no combination fits.
+    """
+    plain = profiles['plain']
+    levels = sorted(level for level in plain['saved_bytes'] if level is not None)
+
+    def level_bytes(mode, level):
+        profile_ = profiles[mode]
+        return scale * profile_['saved_bytes'][level] + OPTIMIZER_COPIES * profile_['parameter_bytes'][level]
+
+    def level_seconds(mode, level):
+        profile_ = profiles[mode]
+        share = profile_['forward_seconds'][level] / sum(profile_['forward_seconds'].values())
+        return scale * (profile_['step_seconds'] - plain['step_seconds']) * share
+
+    base_bytes = scale * plain['saved_bytes'][None] + OPTIMIZER_COPIES * plain['parameter_bytes'][None]
+    base_seconds = scale * plain['step_seconds']
+
+    best = None
+    for modes in itertools.product([mode for mode in MODES if mode in profiles], repeat=len(levels)):
+        memory = base_bytes + sum(level_bytes(mode, level) for mode, level in zip(modes, levels))
+        seconds = base_seconds + sum(level_seconds(mode, level) for mode, level in zip(modes, levels))
+        if memory <= budget_bytes and (best is None or (seconds, memory) < best[1:]):
+            best = (modes, seconds, memory)
+
+    if best is None:
+        minimum = base_bytes + sum(min(level_bytes(mode, level) for mode in profiles) for level in levels)
+        raise ValueError('No plan fits into {:.0f} MB, at least {:.0f} MB are needed'.format(
+            budget_bytes / 1024 ** 2, minimum / 1024 ** 2))
+
+    modes, seconds, memory = best
+    return dict(zip(levels, modes)), memory, seconds
+
+
+def make_plan(exp_config, budget_mb, image_size=None, batch_size=None, profile_batch_size=2, device=None):
+    """
+    Profiles the network of exp_config in every mode and returns the plan for the budget as a JSON serialisable dict
+    """
+    device = device or torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    image_size = tuple(image_size or exp_config.image_size)
+    batch_size = batch_size or exp_config.batch_size
+    profile_batch_size = min(profile_batch_size, batch_size)
+
+    patch = torch.randn((profile_batch_size,) + image_size, device=device)
+    mask = (torch.rand((profile_batch_size, 1) + image_size[1:], device=device) > 0.5).float()
+
+    profiles = {}
+    for mode in MODES:
+        torch.manual_seed(0)
+        net = build_net(exp_config, mode, image_size).to(device)
+        profiles[mode] = profile(net, patch, mask)
+        del net
+
+    levels, memory, seconds = plan_levels(profiles, budget_mb * 1024 ** 2, scale=batch_size / profile_batch_size)
+
+    return {'checkpoint_levels': [level for level, mode in levels.items() if mode == 'checkpoint'],
+            'reversible_levels': [level for level, mode in levels.items() if mode == 'reversible'],
+            'modes': [levels[level] for level in sorted(levels)],
+            'budget_mb': budget_mb,
+            'estimated_memory_mb': memory / 1024 ** 2,
+            'estimated_seconds_per_step': seconds,
+            'image_size': list(image_size),
+            'batch_size': batch_size,
+            'filter_channels': list(exp_config.filter_channels),
+            'device': device.type}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Plans the execution mode of every resolution level of PHISeg")
+    parser.add_argument("EXP_PATH", type=str, help="Path to experiment config file")
+    parser.add_argument("--budget_mb", type=float, required=True, help="Memory budget of the training in MB")
+    parser.add_argument("--image_size", type=int, default=None, help="Image size, default: the one of the config")
+    parser.add_argument("--batch_size", type=int, default=None, help="Batch size, default: the one of the config")
+    parser.add_argument("--profile_batch_size", type=int, default=2)
+    parser.add_argument("--output", type=str, default='memory_plan.json')
+    args = parser.parse_args()
+
+    exp_config = SourceFileLoader('exp_config', args.EXP_PATH).load_module()
+    if exp_config.model is not PHISeg:
+        raise ValueError('The memory planner supports PHISeg models only')
+
+    image_size = None
+    if args.image_size is not None:
+        image_size = (exp_config.image_size[0], args.image_size, args.image_size)
+
+    plan = make_plan(exp_config, args.budget_mb, image_size=image_size, batch_size=args.batch_size,
+                     profile_batch_size=args.profile_batch_size)
+
+    with open(args.output, 'w') as f:
+        json.dump(plan, f, indent=2)
+
+    print('Modes per resolution level: {}'.format(', '.join(plan['modes'])))
+    print('Estimated memory: {:.0f} MB, estimated time per step: {:.3f} s'.format(
+        plan['estimated_memory_mb'], plan['estimated_seconds_per_step']))
+    print('Plan written to {}, set memory_plan = \'{}\' in the experiment config'.format(args.output, args.output))
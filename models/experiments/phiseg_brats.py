@@ -28,6 +28,7 @@ exponential_weighting = True
 input_channels = 4
 epochs_to_train = 20
 batch_size = 1
+accumulation_steps = 4 # one optimizer step per 4 volumes, only a single volume fits into memory
 image_size = (4,128,128,128)
 
 augmentation_options = {'do_flip_lr': True,
@@ -68,6 +69,7 @@ LOG_LR_EVERY_EPOCH = True
 #data and augmentation
 TRAIN_ORIGINAL_CLASSES = False #train on original 5 classes
 DATASET_WORKERS = 1
+LABEL_CACHE = False #Store the one-hot labels next to the data (uint8) instead of converting the masks of every sample
 SOFT_AUGMENTATION = False #Soft augmetation directly works on the 3 classes. Hard augmentation augments on the 5 orignal labels, then takes the argmax
 NN_AUGMENTATION = True #Has priority over soft/hard augmentation. Uses nearest-neighbor interpolation
 DO_ROTATE = True
@@ -75,6 +77,8 @@ DO_SCALE = True
 DO_FLIP = True
 DO_ELASTIC_AUG = True
 DO_INTENSITY_SHIFT = True
+VECTORIZED_AUGMENTATION = False #Rotation, scale and elastic deformation with one sampling grid for the whole volume (torch)
+AUGMENTATION_DEVICE = 'cpu' #Device of the vectorized augmentation, 'cuda' requires DATASET_WORKERS = 0
 #RANDOM_CROP = [128, 128, 128]
 
 ROT_DEGREES = 20
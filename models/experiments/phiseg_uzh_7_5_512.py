@@ -20,6 +20,7 @@ no_convs_fcomb = 4 # not used
 beta = 10.0 # not used
 #
 use_reversible = False
+checkpoint_levels = [0, 1] # recompute the activations of the two highest resolutions in the backward pass
 exponential_weighting = True
 
 # use 1 for grayscale, 3 for RGB images
@@ -9,11 +9,14 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
 # TODO: only debugging
 from utils import show_tensor
-from torchlayers import Conv2D, Conv2DSequence, ReversibleSequence
+from torchlayers import Conv2D, Conv2DSequence, ReversibleSequence, checkpoint_activations, selected_levels
 
 class DownConvolutionalBlock(nn.Module):
-    def __init__(self, input_dim, output_dim, initializers, depth=3, padding=True, pool=True, reversible=False):
+    def __init__(self, input_dim, output_dim, initializers, depth=3, padding=True, pool=True, reversible=False,
+                 checkpoint=False):
         super(DownConvolutionalBlock, self).__init__()
+        # the reversible blocks do not store their activations anyway
+        self.checkpoint = checkpoint and not reversible
 
         if depth < 1:
             raise ValueError
@@ -36,6 +39,8 @@ class DownConvolutionalBlock(nn.Module):
         #self.layers.apply(init_weights)
 
     def forward(self, x):
+        if self.checkpoint:
+            return checkpoint_activations(self, self.layers, x)
         return self.layers(x)
 
 
@@ -45,9 +50,11 @@ class UpConvolutionalBlock(nn.Module):
         If bilinear is set to false, we do a transposed convolution instead of upsampling
         """
 
-    def __init__(self, input_dim, output_dim, initializers, padding, bilinear=True, reversible=False):
+    def __init__(self, input_dim, output_dim, initializers, padding, bilinear=True, reversible=False,
+                 checkpoint=False):
         super(UpConvolutionalBlock, self).__init__()
         self.bilinear = bilinear
+        self.checkpoint = checkpoint and not reversible
 
         if self.bilinear:
             if reversible:
@@ -63,8 +70,10 @@ class UpConvolutionalBlock(nn.Module):
 
     def forward(self, x, bridge):
         if self.bilinear:
-            x = nn.functional.interpolate(x, mode='bilinear', scale_factor=2, align_corners=True)
-            x = self.upconv_layer(x)
+            if self.checkpoint:
+                x = checkpoint_activations(self, self.upsample, x)
+            else:
+                x = self.upsample(x)
 
         assert x.shape[3] == bridge.shape[3]
         assert x.shape[2] == bridge.shape[2]
@@ -72,15 +81,20 @@ class UpConvolutionalBlock(nn.Module):
 
         return out
 
+    def upsample(self, x):
+        x = nn.functional.interpolate(x, mode='bilinear', scale_factor=2, align_corners=True)
+        return self.upconv_layer(x)
+
 
 class SampleZBlock(nn.Module):
     """
     Performs 2 3X3 convolutions and a 1x1 convolution to mu and sigma which are used as parameters for a Gaussian
     for generating z
     """
-    def __init__(self, input_dim, z_dim0=2, depth=2, reversible=False):
+    def __init__(self, input_dim, z_dim0=2, depth=2, reversible=False, checkpoint=False):
         super(SampleZBlock, self).__init__()
         self.input_dim = input_dim
+        self.checkpoint = checkpoint and not reversible
 
         layers = []
 
@@ -97,14 +111,21 @@ class SampleZBlock(nn.Module):
                                         nn.Softplus())
 
     def forward(self, pre_z):
-        pre_z = self.conv(pre_z)
-        mu = self.mu_conv(pre_z)
-        sigma = self.sigma_conv(pre_z)
+        if self.checkpoint:
+            pre_z = checkpoint_activations(self, self.conv, pre_z)
+        else:
+            pre_z = self.conv(pre_z)
+        mu, sigma = self.gaussian_parameters(pre_z)
 
         z = mu + sigma * torch.randn_like(sigma, dtype=torch.float32)
 
         return mu, sigma, z
 
+    @utils.in_float32
+    def gaussian_parameters(self, pre_z):
+        # the softplus of the sigma head is computed in float32 with mixed precision
+        return self.mu_conv(pre_z), self.sigma_conv(pre_z)
+
 
 class Posterior(nn.Module):
     """
@@ -115,6 +136,9 @@ class Posterior(nn.Module):
     ----------
     input_channels : Number of input channels, 1 for greyscale,
     is_posterior: if True, the mask is concatenated to the input of the encoder, causing it to be a ConditionalVAE
+    reversible: True, False or the resolution levels whose blocks are reversible
+    checkpoint_levels: resolution levels (0 is the full resolution) whose blocks recompute their activations in the
+                       backward pass instead of storing them
     """
     def __init__(self,
                  input_channels,
@@ -123,7 +147,8 @@ class Posterior(nn.Module):
                  initializers=None,
                  padding=True,
                  is_posterior=True,
-                 reversible=False):
+                 reversible=False,
+                 checkpoint_levels=()):
         super(Posterior, self).__init__()
         self.input_channels = input_channels
         self.num_filters = num_filters
@@ -132,6 +157,8 @@ class Posterior(nn.Module):
         self.resolution_levels = 7
         self.lvl_diff = self.resolution_levels - self.latent_levels
 
+        reversible_levels = selected_levels(reversible, self.resolution_levels)
+
         self.padding = padding
         self.activation_maps = []
 
@@ -153,7 +180,8 @@ class Posterior(nn.Module):
                                                                 depth=3,
                                                                 padding=padding,
                                                                 pool=pool,
-                                                                reversible=reversible)
+                                                                reversible=i in reversible_levels,
+                                                                checkpoint=i in checkpoint_levels)
                                          )
 
         self.upsampling_path = nn.ModuleList()
@@ -161,18 +189,29 @@ class Posterior(nn.Module):
         for i in reversed(range(self.latent_levels)):  # iterates from [latent_levels -1, ... ,0]
             input = 2
             output = self.num_filters[0]*2
-            self.upsampling_path.append(UpConvolutionalBlock(input, output, initializers, padding, reversible=reversible))
+            # used for the input of latent level i - 1
+            level = i - 1 + self.lvl_diff
+            self.upsampling_path.append(UpConvolutionalBlock(input, output, initializers, padding,
+                                                             reversible=level in reversible_levels,
+                                                             checkpoint=level in checkpoint_levels))
 
         self.sample_z_path = nn.ModuleList()
         for i in reversed(range(self.latent_levels)):
             input = 2*self.num_filters[0] + self.num_filters[i + self.lvl_diff]
+            level = i + self.lvl_diff
             if i == self.latent_levels - 1:
                 input = self.num_filters[i + self.lvl_diff]
-                self.sample_z_path.append(SampleZBlock(input, depth=2, reversible=reversible))
+                self.sample_z_path.append(SampleZBlock(input, depth=2, reversible=level in reversible_levels,
+                                                       checkpoint=level in checkpoint_levels))
             else:
-                self.sample_z_path.append(SampleZBlock(input, depth=2, reversible=reversible))
+                self.sample_z_path.append(SampleZBlock(input, depth=2, reversible=level in reversible_levels,
+                                                       checkpoint=level in checkpoint_levels))
 
-    def forward(self, patch, segm=None, training_prior=False, z_list=None):
+    def forward(self, patch, segm=None, training_prior=False, z_list=None, n_samples=1):
+        """
+        If n_samples > 1, the contracting path is evaluated once per image and only the latent hierarchy is
+        evaluated n_samples times. The outputs are ordered image by image, like patch.repeat_interleave(n_samples).
+        """
         if segm is not None:
 
             with torch.no_grad():
@@ -193,6 +232,10 @@ class Posterior(nn.Module):
             if i != len(self.contracting_path) - 1:
                 blocks.append(x)
 
+        if n_samples > 1:
+            blocks = [block.repeat_interleave(n_samples, dim=0) for block in blocks]
+            x = x.repeat_interleave(n_samples, dim=0)
+
         pre_conv = x
         for i, sample_z in enumerate(self.sample_z_path):
             if i != 0:
@@ -233,7 +276,8 @@ class Likelihood(nn.Module):
                  reversible=False,
                  initializers=None,
                  apply_last_layer=True,
-                 padding=True):
+                 padding=True,
+                 checkpoint_levels=()):
         super(Likelihood, self).__init__()
 
         self.input_channels = input_channels
@@ -246,6 +290,9 @@ class Likelihood(nn.Module):
 
         self.image_size = image_size
         self.reversible= reversible
+        reversible_levels = selected_levels(reversible, resolution_levels)
+        # resolution levels whose paths recompute their activations in the backward pass
+        self.checkpoint_levels = set(checkpoint_levels) - reversible_levels
 
         self.padding = padding
         self.activation_maps = []
@@ -258,7 +305,7 @@ class Likelihood(nn.Module):
         for i in reversed(range(self.latent_levels)):
             input = self.num_filters[i]
             output = self.num_filters[i]
-            if reversible:
+            if i in reversible_levels:
                 self.likelihood_ups_path.append(ReversibleSequence(input_dim=2, output_dim=input, reversible_depth=2))
             else:
                 self.likelihood_ups_path.append(Conv2DSequence(input_dim=2, output_dim=input, depth=2))
@@ -271,7 +318,7 @@ class Likelihood(nn.Module):
             input = self.num_filters[i] + self.num_filters[i + 1 + self.lvl_diff]
             output = self.num_filters[i + self.lvl_diff]
 
-            if reversible:
+            if i in reversible_levels:
                 self.likelihood_post_c_path.append(ReversibleSequence(input_dim=input, output_dim=output, reversible_depth=2))
             else:
                 self.likelihood_post_c_path.append(Conv2DSequence(input_dim=input, output_dim=output, depth=2))
@@ -293,9 +340,7 @@ class Likelihood(nn.Module):
         for i in range(self.latent_levels):
             assert z[-i-1].shape[1] == 2
             assert z[-i-1].shape[2] == self.image_size[1] * 2**(-self.resolution_levels + 1 + i)
-            post_z[-i - 1] = self.likelihood_ups_path[i](z[-i - 1])
-
-            post_z[-i - 1] = self.likelihood_post_ups_path[i](post_z[-i - 1])
+            post_z[-i - 1] = self._run_level(self.latent_levels - 1 - i, self._upsample_z, i, z[-i - 1])
             assert post_z[-i - 1].shape[2] == self.image_size[1] * 2 ** (-self.latent_levels + i + 1)
             assert post_z[-i-1].shape[1] == self.num_filters[-i-1 - self.lvl_diff], '{} != {}'.format(post_z[-i-1].shape[1],self.num_filters[-i-1])
 
@@ -314,7 +359,7 @@ class Likelihood(nn.Module):
             # Reminder: Pytorch standard is NCHW, TF NHWC
             concat = torch.cat([post_z[i], ups_below], dim=1)
 
-            post_c[i] = self.likelihood_post_c_path[i](concat)
+            post_c[i] = self._run_level(i, self.likelihood_post_c_path[i], concat)
 
         for i, block in enumerate(self.s_layer):
             s_in = block(post_c[-i-1]) # no activation in the last layer
@@ -322,6 +367,14 @@ class Likelihood(nn.Module):
 
         return s
 
+    def _upsample_z(self, i, z):
+        return self.likelihood_post_ups_path[i](self.likelihood_ups_path[i](z))
+
+    def _run_level(self, level, function, *args):
+        if level in self.checkpoint_levels:
+            return checkpoint_activations(self, function, *args)
+        return function(*args)
+
 
 class PHISeg(nn.Module):
     """
@@ -331,6 +384,10 @@ class PHISeg(nn.Module):
     num_filters: list with the amount of filters per layer
     apply_last_layer: boolean to apply last layer or not (not used in PHISeg)
     padding: Boolean, if true we pad the images with 1 so that we keep the same dimensions
+    reversible: True, False or the resolution levels (0 is the full resolution) whose blocks are reversible
+    checkpoint_levels: resolution levels (0 is the full resolution) whose non-reversible blocks recompute their
+                       activations in the backward pass instead of storing them. The parameters and the results do not
+                       change, the memory of the activations is traded for a second forward pass through the blocks
     """
 
     def __init__(self,
@@ -346,7 +403,8 @@ class PHISeg(nn.Module):
                  reversible=False,
                  apply_last_layer=True,
                  exponential_weighting=True,
-                 padding=True):
+                 padding=True,
+                 checkpoint_levels=()):
         super(PHISeg, self).__init__()
         self.input_channels = input_channels
         self.num_classes = num_classes
@@ -373,12 +431,14 @@ class PHISeg(nn.Module):
         self.reconstruction_loss = 0
 
         self.posterior = Posterior(input_channels, num_classes, num_filters,
-                                   initializers=None, padding=True, reversible=reversible)
+                                   initializers=None, padding=True, reversible=reversible,
+                                   checkpoint_levels=checkpoint_levels)
         self.likelihood = Likelihood(input_channels, num_classes, num_filters,
                                      initializers=None, apply_last_layer=True, padding=True, image_size=self.image_size,
-                                     reversible=reversible)
+                                     reversible=reversible, checkpoint_levels=checkpoint_levels)
         self.prior = Posterior(input_channels, num_classes, num_filters,
-                               initializers=None, padding=True, is_posterior=False, reversible=reversible)
+                               initializers=None, padding=True, is_posterior=False, reversible=reversible,
+                               checkpoint_levels=checkpoint_levels)
 
         self.s_out_list = [None] * self.latent_levels
         self.s_out_list_with_softmax = [None] * self.latent_levels
@@ -425,6 +485,26 @@ class PHISeg(nn.Module):
 
         return self.s_out_list
 
+    def sample_n(self, patch, n, mask=None):
+        """
+        Draws n samples from the prior for every image in patch. The contracting paths of the prior and the
+        posterior are evaluated once per image, only the latent sampling and the likelihood run for every sample.
+        The posterior is only evaluated if a mask is given, i.e. if loss() is called afterwards with the mask
+        repeated n times per image. Meant for inference, batch norm has to be in eval mode.
+        :param patch: images of shape B x C x H x W
+        :param n: number of samples per image
+        :param mask: optional masks of shape B x 1 x H x W
+        :return: list of outputs per latent level of shape B*n x num_classes x H x W, ordered image by image
+        """
+        if mask is not None:
+            self.posterior_latent_space, self.posterior_mu, self.posterior_sigma = self.posterior(patch, mask,
+                                                                                                  n_samples=n)
+        self.prior_latent_space, self.prior_mu, self.prior_sigma = self.prior(patch, training_prior=False,
+                                                                              n_samples=n)
+        self.s_out_list = self.likelihood(self.prior_latent_space)
+
+        return self.s_out_list
+
     def accumulate_output(self, output_list, use_softmax=False):
         s_accum = output_list[-1]
         for i in range(len(output_list) - 1):
@@ -433,6 +513,7 @@ class PHISeg(nn.Module):
             return torch.nn.functional.softmax(s_accum, dim=1)
         return s_accum
 
+    @utils.in_float32
     def KL_two_gauss_with_diag_cov(self, mu0, sigma0, mu1, sigma1):
 
         sigma0_fs = torch.mul(torch.flatten(sigma0, start_dim=1), torch.flatten(sigma0, start_dim=1))
@@ -468,16 +549,19 @@ class PHISeg(nn.Module):
                                      reversed(posterior_mu_list),
                                      reversed(posterior_sigma_list)):
 
-            self.loss_dict['KL_divergence_loss_lvl%d' % ii] = level_weights[ii]*self.KL_two_gauss_with_diag_cov(
+            kl_divergence_loss = level_weights[ii]*self.KL_two_gauss_with_diag_cov(
                 mu_i,
                 sigma_i,
                 prior_mu_list[ii],
                 prior_sigma_list[ii])
 
-            self.loss_tot += self.kl_divergence_loss_weight * self.loss_dict['KL_divergence_loss_lvl%d' % ii]
+            # the loss_dict only keeps the values for logging, not the graphs
+            self.loss_dict['KL_divergence_loss_lvl%d' % ii] = kl_divergence_loss.detach()
+            self.loss_tot += self.kl_divergence_loss_weight * kl_divergence_loss
 
         return self.loss_tot
 
+    @utils.in_float32
     def multinoulli_loss(self, reconstruction, target):
         criterion = torch.nn.CrossEntropyLoss(reduction='none')
 
@@ -502,14 +586,14 @@ class PHISeg(nn.Module):
             if ii == self.latent_levels-1:
 
                 self.s_accumulated[ii] = s_ii
-                self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = criterion(self.s_accumulated[ii], target)
 
             else:
 
                 self.s_accumulated[ii] = self.s_accumulated[ii+1] + s_ii
-                self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = criterion(self.s_accumulated[ii], target)
 
-            self.loss_tot += self.residual_multinoulli_loss_weight * self.loss_dict['residual_multinoulli_loss_lvl%d' % ii]
+            reconstruction_loss = criterion(self.s_accumulated[ii], target)
+            self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = reconstruction_loss.detach()
+            self.loss_tot += self.residual_multinoulli_loss_weight * reconstruction_loss
         return self.loss_tot
 
     def kl_divergence(self):
@@ -175,13 +175,17 @@ class SampleZBlock(nn.Module):
 
     def forward(self, pre_z):
         pre_z = self.conv(pre_z)
-        mu = self.mu_conv(pre_z)
-        sigma = self.sigma_conv(pre_z)
+        mu, sigma = self.gaussian_parameters(pre_z)
 
         z = mu + sigma * torch.randn_like(sigma, dtype=torch.float32)
 
         return mu, sigma, z
 
+    @utils.in_float32
+    def gaussian_parameters(self, pre_z):
+        # the softplus of the sigma head is computed in float32 with mixed precision
+        return self.mu_conv(pre_z), self.sigma_conv(pre_z)
+
 
 class Posterior(nn.Module):
     """
@@ -507,6 +511,7 @@ class PHISeg3D(nn.Module):
             return torch.nn.functional.softmax(s_accum, dim=1)
         return s_accum
 
+    @utils.in_float32
     def KL_two_gauss_with_diag_cov(self, mu0, sigma0, mu1, sigma1):
 
         sigma0_fs = torch.mul(torch.flatten(sigma0, start_dim=1), torch.flatten(sigma0, start_dim=1))
@@ -542,16 +547,19 @@ class PHISeg3D(nn.Module):
                                      reversed(posterior_mu_list),
                                      reversed(posterior_sigma_list)):
 
-            self.loss_dict['KL_divergence_loss_lvl%d' % ii] = level_weights[ii]*self.KL_two_gauss_with_diag_cov(
+            kl_divergence_loss = level_weights[ii]*self.KL_two_gauss_with_diag_cov(
                 mu_i,
                 sigma_i,
                 prior_mu_list[ii],
                 prior_sigma_list[ii])
 
-            self.loss_tot += self.kl_divergence_loss_weight * self.loss_dict['KL_divergence_loss_lvl%d' % ii]
+            # the loss_dict only keeps the values for logging, not the graphs
+            self.loss_dict['KL_divergence_loss_lvl%d' % ii] = kl_divergence_loss.detach()
+            self.loss_tot += self.kl_divergence_loss_weight * kl_divergence_loss
 
         return self.loss_tot
 
+    @utils.in_float32
     def multinoulli_loss(self, reconstruction, target):
         criterion = torch.nn.CrossEntropyLoss(reduction='none')
 
@@ -576,14 +584,14 @@ class PHISeg3D(nn.Module):
             if ii == self.latent_levels-1:
 
                 self.s_accumulated[ii] = s_ii
-                self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = criterion(self.s_accumulated[ii], target)
 
             else:
 
                 self.s_accumulated[ii] = self.s_accumulated[ii+1] + s_ii
-                self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = criterion(self.s_accumulated[ii], target)
 
-            self.loss_tot += self.residual_multinoulli_loss_weight * self.loss_dict['residual_multinoulli_loss_lvl%d' % ii]
+            reconstruction_loss = criterion(self.s_accumulated[ii], target)
+            self.loss_dict['residual_multinoulli_loss_lvl%d' % ii] = reconstruction_loss.detach()
+            self.loss_tot += self.residual_multinoulli_loss_weight * reconstruction_loss
         return self.loss_tot
 
     def kl_divergence(self):
@@ -5,10 +5,10 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from models.unet import Unet
 from utils import init_weights, init_weights_orthogonal_normal
 from torch.distributions import Normal, Independent, kl
-import numpy as np
 from utils import l2_regularisation
 import utils
 
@@ -121,8 +121,9 @@ class AxisAlignedConvGaussian(nn.Module):
         mu_log_sigma = torch.squeeze(mu_log_sigma, dim=2)
         mu_log_sigma = torch.squeeze(mu_log_sigma, dim=2)
 
-        mu = mu_log_sigma[:, :self.latent_dim]
-        log_sigma = mu_log_sigma[:, self.latent_dim:]
+        # float32 for the exponential, also with mixed precision
+        mu = mu_log_sigma[:, :self.latent_dim].float()
+        log_sigma = mu_log_sigma[:, self.latent_dim:].float()
 
         # This is a multivariate normal with diagonal covariance matrix sigma
         # https://github.com/pytorch/pytorch/pull/11178
@@ -169,33 +170,32 @@ class Fcomb(nn.Module):
                 self.layers.apply(init_weights)
                 self.last_layer.apply(init_weights)
 
-    def tile(self, a, dim, n_tile):
-        """
-        This function is taken form PyTorch forum and mimics the behavior of tf.tile.
-        Source: https://discuss.pytorch.org/t/how-to-tile-a-tensor/13853/3
-        """
-        init_dim = a.size(dim)
-        repeat_idx = [1] * a.dim()
-        repeat_idx[dim] = n_tile
-        a = a.repeat(*(repeat_idx))
-        order_index = torch.LongTensor(np.concatenate([init_dim * np.arange(n_tile) + i for i in range(init_dim)])).to(
-            device)
-        return torch.index_select(a, dim, order_index)
-
     def forward(self, feature_map, z):
         """
         Z is batch_sizexlatent_dim and feature_map is batch_sizexno_channelsxHxW.
-        So broadcast Z to batch_sizexlatent_dimxHxW. Behavior is exactly the same as tf.tile (verified)
+        Concatenating z tiled to batch_sizexlatent_dimxHxW to the feature map and applying the first 1x1 convolution
+        is the same as applying the feature map part of its weights to the feature map and adding the latent part
+        applied to z as a per sample bias. This avoids materializing the tiled z and the concatenated input.
+        z may also hold n samples per feature map, ordered image by image, in which case the feature map part is
+        computed once per image and broadcast over the samples.
         """
         if self.use_tile:
-            z = torch.unsqueeze(z, 2)
-            z = self.tile(z, 2, feature_map.shape[self.spatial_axes[0]])
-            z = torch.unsqueeze(z, 3)
-            z = self.tile(z, 3, feature_map.shape[self.spatial_axes[1]])
-
-            # Concatenate the feature map (output of the UNet) and the sample taken from the latent space
-            feature_map = torch.cat((feature_map, z), dim=self.channel_axis)
-            output = self.layers(feature_map)
+            first_layer = self.layers[0].convolution
+            first_conv = first_layer[0]
+
+            n_features = feature_map.shape[self.channel_axis]
+            batch_size = feature_map.shape[0]
+
+            output = F.conv2d(feature_map, first_conv.weight[:, :n_features])
+            latent_bias = F.linear(z, first_conv.weight[:, n_features:, 0, 0], first_conv.bias)
+
+            # B x n x C x H x W -> B*n x C x H x W
+            output = output.unsqueeze(1) + latent_bias.view(batch_size, -1, latent_bias.shape[1], 1, 1)
+            output = output.flatten(start_dim=0, end_dim=1)
+
+            # batch norm and activation of the first layer, then the remaining layers
+            output = first_layer[1:](output)
+            output = self.layers[1:](output)
             return self.last_layer(output)
 
 
@@ -207,6 +207,8 @@ class ProbabilisticUnet(nn.Module):
     num_filters: is a list consisint of the amount of filters layer
     latent_dim: dimension of the latent space
     no_cons_per_block: no convs per block in the (convolutional) encoder of prior and posterior
+    reversible: True, False or the resolution levels (0 is the full resolution) whose UNet blocks are reversible
+    checkpoint_levels: resolution levels whose UNet blocks recompute their activations in the backward pass
     """
 
     def __init__(self, input_channels=1,
@@ -218,7 +220,8 @@ class ProbabilisticUnet(nn.Module):
                  no_convs_fcomb=4,
                  image_size=(1, 128, 128),
                  beta=10.0,
-                 reversible=False):
+                 reversible=False,
+                 checkpoint_levels=()):
         super(ProbabilisticUnet, self).__init__()
         self.input_channels = input_channels
         self.num_classes = num_classes
@@ -230,8 +233,8 @@ class ProbabilisticUnet(nn.Module):
         self.z_prior_sample = 0
 
         self.unet = Unet(self.input_channels, self.num_classes, self.num_filters, initializers=self.initializers,
-                         apply_last_layer=False, padding=True, reversible=reversible
-                         ).to(device)
+                         apply_last_layer=False, padding=True, reversible=reversible,
+                         checkpoint_levels=checkpoint_levels).to(device)
         self.prior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block,
                                              self.latent_dim, initializers=self.initializers).to(device)
         self.posterior = AxisAlignedConvGaussian(self.input_channels, self.num_filters, self.no_convs_per_block,
@@ -269,6 +272,36 @@ class ProbabilisticUnet(nn.Module):
             self.z_prior_sample = z_prior
         return self.fcomb.forward(self.unet_features, z_prior)
 
+    def sample_n(self, patch, n, mask=None):
+        """
+        Draws n samples for every image in patch. The UNet, the prior and, if a mask is given, the posterior
+        are evaluated once per image and all n latent codes are drawn with one batched rsample. Afterwards
+        the latent spaces are stored repeated n times per image, so that loss() can be called with the mask repeated
+        n times per image. Fcomb broadcasts the feature map of each image over its samples.
+        :param patch: images of shape B x C x H x W
+        :param n: number of samples per image
+        :param mask: optional masks of shape B x 1 x H x W
+        :return: logits of shape B*n x num_classes x H x W, ordered image by image
+        """
+        unet_features = self.unet.forward(patch, False)
+        prior_latent_space = self.prior.forward(patch)
+
+        # n x B x latent_dim -> B*n x latent_dim
+        z_prior = prior_latent_space.rsample((n,)).transpose(0, 1).reshape(-1, self.latent_dim)
+        self.z_prior_sample = z_prior
+
+        self.prior_latent_space = self._repeat_latent_space(prior_latent_space, n)
+        if mask is not None:
+            self.posterior_latent_space = self._repeat_latent_space(self.posterior.forward(patch, mask), n)
+
+        self.unet_features = unet_features
+        return self.fcomb.forward(self.unet_features, z_prior)
+
+    def _repeat_latent_space(self, latent_space, n):
+        loc = latent_space.base_dist.loc.repeat_interleave(n, dim=0)
+        scale = latent_space.base_dist.scale.repeat_interleave(n, dim=0)
+        return Independent(Normal(loc=loc, scale=scale), 1)
+
     def reconstruct(self, use_posterior_mean=False, calculate_posterior=False, z_posterior=None):
         """
         Reconstruct a segmentation from a posterior sample (decoding a posterior sample) and UNet feature map
@@ -289,6 +322,7 @@ class ProbabilisticUnet(nn.Module):
             return torch.nn.functional.softmax(s_accum, dim=1)
         return s_accum
 
+    @utils.in_float32
     def KL_two_gauss_with_diag_cov(self, mu0, sigma0, mu1, sigma1):
         sigma0_fs = torch.mul(torch.flatten(sigma0, start_dim=1), torch.flatten(sigma0, start_dim=1))
         sigma1_fs = torch.mul(torch.flatten(sigma1, start_dim=1), torch.flatten(sigma0, start_dim=1))
@@ -329,6 +363,7 @@ class ProbabilisticUnet(nn.Module):
         kl_div = self.KL_two_gauss_with_diag_cov(mu0, sigma0, mu1, sigma1)
         return kl_div
 
+    @utils.in_float32
     def multinoulli_loss(self, reconstruction, target):
         criterion = torch.nn.CrossEntropyLoss(reduction='none')
 
@@ -6,7 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import revtorch as rv
 from utils import init_weights
-from torchlayers import ReversibleSequence
+from torchlayers import ReversibleSequence, checkpoint_activations, selected_levels
 
 
 class DownConvBlock(nn.Module):
@@ -14,8 +14,10 @@ class DownConvBlock(nn.Module):
     A block of three convolutional layers where each layer is followed by a non-linear activation function
     Between each block we add a pooling operation.
     """
-    def __init__(self, input_dim, output_dim, initializers, padding, pool=True, reversible=False):
+    def __init__(self, input_dim, output_dim, initializers, padding, pool=True, reversible=False, checkpoint=False):
         super(DownConvBlock, self).__init__()
+        # the reversible blocks do not store their activations anyway
+        self.checkpoint = checkpoint and not reversible
         layers = []
 
         if pool:
@@ -37,6 +39,8 @@ class DownConvBlock(nn.Module):
         self.layers.apply(init_weights)
 
     def forward(self, patch):
+        if self.checkpoint:
+            return checkpoint_activations(self, self.layers, patch)
         return self.layers(patch)
 
 
@@ -46,7 +50,8 @@ class UpConvBlock(nn.Module):
     If bilinear is set to false, we do a transposed convolution instead of upsampling
     """
 
-    def __init__(self, input_dim, output_dim, initializers, padding, bilinear=True, reversible=False):
+    def __init__(self, input_dim, output_dim, initializers, padding, bilinear=True, reversible=False,
+                 checkpoint=False):
         super(UpConvBlock, self).__init__()
         self.bilinear = bilinear
 
@@ -59,7 +64,8 @@ class UpConvBlock(nn.Module):
                                         initializers,
                                         padding,
                                         pool=False,
-                                        reversible=reversible
+                                        reversible=reversible,
+                                        checkpoint=checkpoint
                                         )
 
     def forward(self, x, bridge):
@@ -83,11 +89,14 @@ class Unet(nn.Module):
     num_filters: list with the amount of filters per layer
     apply_last_layer: boolean to apply last layer or not (not used in Probabilistic UNet)
     padding: Boolean, if true we pad the images with 1 so that we keep the same dimensions
+    reversible: True, False or the resolution levels (0 is the full resolution) whose blocks are reversible
+    checkpoint_levels: resolution levels (0 is the full resolution) whose blocks recompute their activations in the
+                       backward pass instead of storing them
     """
 
     def __init__(self, input_channels, num_classes, num_filters,
                  initializers=None, apply_last_layer=True, padding=True,
-                 reversible=False, training=False, latent_dim=3, no_convs_fcomb=4, beta=1.0):
+                 reversible=False, training=False, latent_dim=3, no_convs_fcomb=4, beta=1.0, checkpoint_levels=()):
         super(Unet, self).__init__()
         self.input_channels = input_channels
         self.num_classes = num_classes
@@ -97,6 +106,7 @@ class Unet(nn.Module):
         self.apply_last_layer = apply_last_layer
         self.contracting_path = nn.ModuleList()
         self.prediction = None
+        reversible_levels = selected_levels(reversible, len(self.num_filters))
 
         for i in range(len(self.num_filters)):
             input = self.input_channels if i == 0 else output
@@ -108,7 +118,8 @@ class Unet(nn.Module):
                 pool = True
 
             self.contracting_path.append(
-                DownConvBlock(input, output, initializers, padding, pool=pool, reversible=reversible))
+                DownConvBlock(input, output, initializers, padding, pool=pool, reversible=i in reversible_levels,
+                              checkpoint=i in checkpoint_levels))
 
         self.upsampling_path = nn.ModuleList()
 
@@ -116,7 +127,8 @@ class Unet(nn.Module):
         for i in range(n, -1, -1):
             input = output + self.num_filters[i]
             output = self.num_filters[i]
-            self.upsampling_path.append(UpConvBlock(input, output, initializers, padding, reversible=reversible))
+            self.upsampling_path.append(UpConvBlock(input, output, initializers, padding, reversible=i in reversible_levels,
+                                                    checkpoint=i in checkpoint_levels))
 
         if self.apply_last_layer:
             self.last_layer = nn.Conv2d(output, num_classes, kernel_size=1)
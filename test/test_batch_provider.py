@@ -0,0 +1,126 @@
+"""Testing the batch provider"""
+
+import numpy as np
+
+from data.batch_provider import BatchProvider
+
+augmentation_options = {'do_fliplr': True,
+                        'do_flipud': True,
+                        'do_rotations': True,
+                        'do_scaleaug': True,
+                        'do_elasticaug': True,
+                        'nlabels': 2,
+                        'augment_every_nth': 1}
+
+
+def random_data(n=24, size=64):
+    rng = np.random.RandomState(0)
+    images = rng.rand(n, size, size).astype(np.float32)
+    labels = (rng.rand(n, size, size) > 0.5).astype(np.uint8)
+    return images, labels
+
+
+def test_augmentation_independent_of_workers():
+    images, labels = random_data()
+    serial = BatchProvider(images, labels, np.arange(images.shape[0]),
+                           do_augmentations=True, augmentation_options=augmentation_options)
+    pooled = BatchProvider(images, labels, np.arange(images.shape[0]),
+                           do_augmentations=True, augmentation_options=augmentation_options,
+                           augmentation_workers=2)
+
+    try:
+        np.random.seed(0)
+        X_serial, y_serial = serial._augmentation_function(images, labels)
+        np.random.seed(0)
+        X_pooled, y_pooled = pooled._augmentation_function(images, labels)
+    finally:
+        pooled.close()
+
+    assert X_serial.shape == images.shape and y_serial.shape == labels.shape
+    assert np.array_equal(X_serial, X_pooled)
+    assert np.array_equal(y_serial, y_pooled)
+    assert not np.array_equal(X_serial, images)
+
+
+def test_torch_augmentation_matches_opencv_rotation():
+    import torch
+    import torch.nn.functional as F
+    import utils
+    from data.torch_augmentation import sampling_grid
+
+    n = 64
+    yy, xx = np.mgrid[:n, :n]
+    image = (np.sin(xx / 7.) + np.cos(yy / 5.)).astype(np.float32)
+
+    np.random.seed(1)
+    grid = sampling_grid(1, n, n, {'do_rotations': True, 'rot_degrees': 15.0})
+    rotated = F.grid_sample(torch.from_numpy(image)[None, None], grid, align_corners=False)[0, 0].numpy()
+
+    np.random.seed(1)
+    reference = utils.rotate_image(image, np.random.uniform(-15.0, 15.0))
+
+    assert np.allclose(rotated[8:-8, 8:-8], reference[8:-8, 8:-8], atol=1e-4)
+
+
+def test_torch_augmentation_backend():
+    images, labels = random_data()
+    options = dict(augmentation_options, backend='torch', augment_every_nth=2)
+    provider = BatchProvider(images, labels, np.arange(images.shape[0]),
+                             do_augmentations=True, augmentation_options=options)
+
+    np.random.seed(0)
+    X, y = provider._augmentation_function(images, labels)
+
+    assert X.shape == images.shape and X.dtype == np.float32
+    assert y.shape == labels.shape and y.dtype == labels.dtype
+    assert set(np.unique(y)) <= {0, 1}
+    assert not np.array_equal(X, images)
+
+
+def test_next_batch_epochs_and_state():
+    n, batch_size = 50, 12
+    images = np.arange(n, dtype=np.float32).reshape(n, 1)
+    provider = BatchProvider(images, images.copy(), np.arange(n), seed=3)
+
+    # every epoch visits each index at most once and drops the remainder of 2
+    for _ in range(3):
+        seen = np.concatenate([provider.read_next_batch(batch_size)[0].ravel() for _ in range(n // batch_size)])
+        assert len(np.unique(seen)) == len(seen) == 48
+
+    state = provider.get_state()
+    expected = [provider.read_next_batch(batch_size)[0] for _ in range(6)]
+
+    resumed = BatchProvider(images, images.copy(), np.arange(n), seed=0)
+    resumed.set_state(state)
+    for X_expected in expected:
+        assert np.array_equal(resumed.read_next_batch(batch_size)[0], X_expected)
+
+
+def test_chunk_sampler(tmp_path):
+    import h5py
+
+    n, batch_size = 200, 12
+    with h5py.File(str(tmp_path / 'data.hdf5'), 'w') as f:
+        f.create_dataset('images', data=np.arange(n, dtype=np.float32).reshape(n, 1), chunks=(10, 1))
+        f.create_dataset('labels', data=np.arange(n, dtype=np.uint8).reshape(n, 1), chunks=(10, 1))
+
+    with h5py.File(str(tmp_path / 'data.hdf5'), 'r') as f:
+        indices = np.arange(5, n)
+        provider = BatchProvider(f['images'], f['labels'], indices, seed=1, sampler='chunks', shuffle_buffer_size=40)
+        assert provider.chunk_sampler.read_chunk_size == 40
+
+        # every index once per epoch, the remainder of 195 % 12 = 3 is dropped
+        for _ in range(2):
+            seen = np.concatenate([provider.read_next_batch(batch_size)[0].ravel() for _ in range(len(indices) // batch_size)])
+            assert len(np.unique(seen)) == len(seen) == 192
+            assert set(seen) <= set(indices)
+
+        provider.read_next_batch(batch_size)
+        state = provider.get_state()
+        expected = [provider.read_next_batch(batch_size)[0] for _ in range(20)]
+
+        resumed = BatchProvider(f['images'], f['labels'], indices, seed=2, sampler='chunks', shuffle_buffer_size=40)
+        resumed.set_state(state)
+        for X_expected in expected:
+            assert np.array_equal(resumed.read_next_batch(batch_size)[0], X_expected)
+
@@ -0,0 +1,173 @@
+"""Testing the BraTS dataset"""
+
+import os
+import types
+
+import h5py
+import numpy as np
+import torch
+
+from data import bratsDataset
+
+
+def brats_config(**kwargs):
+    config = dict(TRAIN_ORIGINAL_CLASSES=False, NN_AUGMENTATION=False, SOFT_AUGMENTATION=False, DO_ROTATE=False,
+                  ROT_DEGREES=20, DO_SCALE=False, SCALE_FACTOR=1.1, DO_FLIP=False, DO_ELASTIC_AUG=False, SIGMA=10,
+                  DO_INTENSITY_SHIFT=False, MAX_INTENSITY_SHIFT=0.1)
+    config.update(kwargs)
+    return types.SimpleNamespace(**config)
+
+
+def write_brats_like_file(path, n=6, size=8):
+    rng = np.random.RandomState(0)
+    with h5py.File(path, 'w') as f:
+        for tt in ['train', 'validation']:
+            f.create_dataset('images_%s' % tt, data=rng.rand(n, size, size, size, 4).astype(np.float32))
+            f.create_dataset('masks_%s' % tt, data=rng.choice([0, 1, 2, 4], (n, size, size, size)).astype(np.uint8))
+            f.create_dataset('pids_%s' % tt, data=['%s_%d' % (tt, ii) for ii in range(n)],
+                             dtype=h5py.special_dtype(vlen=str))
+
+
+def test_one_hot_conversion():
+    labels = np.random.RandomState(0).choice([0, 1, 2, 4], (4, 5, 6)).astype(np.uint8)
+
+    evaluation = bratsDataset.BratsDataset._toEvaluationOneHot(None, labels)
+    assert evaluation.dtype == np.float32 and evaluation.shape == (4, 5, 6, 3)
+    assert np.array_equal(evaluation[..., 0], labels != 0)
+    assert np.array_equal(evaluation[..., 1], (labels != 0) * (labels != 2))
+    assert np.array_equal(evaluation[..., 2], labels == 4)
+
+    original = bratsDataset.BratsDataset._toOrignalCategoryOneHot(None, labels)
+    assert original.shape == (4, 5, 6, 5)
+    assert np.array_equal(np.argmax(original, axis=-1), labels)
+
+
+def test_dataset_with_workers(tmp_path):
+    path = str(tmp_path / 'brats.hdf5')
+    write_brats_like_file(path)
+
+    dataset = bratsDataset.BratsDataset(path, brats_config(), mode='validation')
+    assert len(dataset) == 6
+    assert dataset.file is None
+
+    image, pid, labels = dataset[2]
+    assert image.shape == (4, 8, 8, 8) and labels.shape == (3, 8, 8, 8)
+    with h5py.File(path, 'r') as f:
+        assert np.array_equal(image.numpy(), np.transpose(f['images_validation'][2], (3, 0, 1, 2)))
+        assert np.array_equal(labels[0].numpy(), f['masks_validation'][2] != 0)
+
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2, num_workers=2,
+                                         worker_init_fn=bratsDataset.worker_init_fn)
+    images = torch.cat([batch[0] for batch in loader])
+    pids = [pid for batch in loader for pid in batch[1]]
+    assert images.shape == (6, 4, 8, 8, 8)
+    assert torch.equal(images[2], image)
+    assert pids == [str(p) for p in dataset.pids]
+
+
+def test_vectorized_augmentation_matches_slicewise():
+    from data.BratsProcessing import augmentation as aug
+
+    n = 96
+    yy, xx = np.mgrid[:n, :n]
+    image = (np.sin(xx / 7.) + np.cos(yy / 5.)).astype(np.float32)
+    volume = np.stack([image * (c + 1) + z for z in range(3) for c in range(4)], -1).reshape(n, n, 3, 4)
+    labels = np.stack([image > 0.5 * c for c in range(5)], -1)[:, :, None, :].repeat(3, 2).astype(np.float32)
+
+    no_augmentation = dict(do_rotate=False, do_scale=False, do_flip=False, do_elasticAug=False, do_intensityShift=False)
+    # (options, seed, tolerance), the slice-wise implementation interpolates once per step, the vectorized one once
+    cases = [(dict(no_augmentation, do_rotate=True, do_scale=True, do_flip=True, do_intensityShift=True), 2, 0.02),
+             (dict(no_augmentation, do_elasticAug=True), 0, 0.01),
+             (dict(do_rotate=True, do_scale=True, do_flip=True, do_elasticAug=True, do_intensityShift=True), 0, 0.02)]
+
+    for options, seed, tolerance in cases:
+        np.random.seed(seed)
+        reference = aug.augment3DImage(volume.copy(), labels.copy(), np.zeros(5, np.float32), False, **options)
+        np.random.seed(seed)
+        vectorized = aug.augment3DImageVectorized(volume.copy(), labels.copy(), np.zeros(5, np.float32), False,
+                                                  **options)
+
+        assert vectorized[0].shape == volume.shape and vectorized[1].shape == labels.shape
+        assert np.abs(vectorized[0] - reference[0])[16:-16, 16:-16].mean() < tolerance, options
+        assert np.abs(vectorized[1] - reference[1])[16:-16, 16:-16].mean() < tolerance, options
+        if options['do_elasticAug']:
+            # the deformation is not negligible
+            assert np.abs(reference[0] - volume)[16:-16, 16:-16].mean() > 1
+
+
+def test_label_lookup_table():
+    labels = np.asarray([0, 1, 2, 3, 4, 7], dtype=np.uint8)
+    evaluation = bratsDataset.convertLabels(labels, bratsDataset.EVALUATION_LOOKUP_TABLE)
+    assert np.array_equal(evaluation, [[0, 0, 0], [1, 1, 0], [1, 0, 0], [1, 1, 0], [1, 1, 1], [1, 1, 0]])
+    assert np.array_equal(bratsDataset.convertLabels(labels, bratsDataset.ORIGINAL_LOOKUP_TABLE)[-1], [0, 0, 0, 0, 0])
+    assert np.array_equal(bratsDataset.convertLabels(labels.astype(np.float32), bratsDataset.EVALUATION_LOOKUP_TABLE),
+                          evaluation)
+
+    # labels which went through an interpolation convert like with the comparisons of the original classes
+    interpolated = np.asarray([0.5, 2.5, 3.9, 4.5, -1, 300], dtype=np.float32)
+    expected = np.stack([interpolated != 0, (interpolated != 0) * (interpolated != 2), interpolated == 4], axis=-1)
+    assert np.array_equal(bratsDataset.convertLabels(interpolated, bratsDataset.EVALUATION_LOOKUP_TABLE), expected)
+    assert not bratsDataset.convertLabels(interpolated, bratsDataset.ORIGINAL_LOOKUP_TABLE).any()
+
+
+def test_label_cache(tmp_path):
+    path = str(tmp_path / 'brats.hdf5')
+    write_brats_like_file(path)
+
+    direct = bratsDataset.BratsDataset(path, brats_config(), mode='validation')
+    cached = bratsDataset.BratsDataset(path, brats_config(LABEL_CACHE=True), mode='validation')
+    assert (tmp_path / 'brats_labels_evaluation.hdf5').exists()
+    for index in range(len(direct)):
+        assert torch.equal(direct[index][2], cached[index][2])
+
+    original = bratsDataset.BratsDataset(path, brats_config(LABEL_CACHE=True, TRAIN_ORIGINAL_CLASSES=True),
+                                         mode='train')
+    assert original[0][2].shape == (5, 8, 8, 8)
+    with h5py.File(str(tmp_path / 'brats_labels_original.hdf5'), 'r') as f, h5py.File(path, 'r') as source:
+        assert f['masks_train'].dtype == np.uint8
+        assert np.array_equal(np.argmax(f['masks_train'][()], axis=-1), source['masks_train'][()])
+
+
+def write_brats_patients(folder, n=10, size=10):
+    import nibabel as nib
+
+    rng = np.random.RandomState(0)
+    for ii in range(n):
+        name = 'Brats18_TEST_%d' % ii
+        os.makedirs(os.path.join(folder, name))
+        # the brain is inside a border of zeros, its extent differs per patient
+        x0, x1 = 1 + ii % 3, size - 1
+        for modality in ['t1', 't1ce', 't2', 'flair']:
+            volume = np.zeros((size, size, size), dtype=np.float32)
+            volume[x0:x1, 2:size - 2, 1:size - 1] = rng.rand(x1 - x0, size - 4, size - 2) + 1
+            nib.Nifti1Image(volume, np.eye(4)).to_filename(os.path.join(folder, name, '%s_%s.nii.gz' % (name, modality)))
+        mask = np.zeros((size, size, size), dtype=np.uint8)
+        mask[x0:x1, 2:size - 2, 1:size - 1] = rng.choice([0, 1, 2, 4], (x1 - x0, size - 4, size - 2))
+        nib.Nifti1Image(mask, np.eye(4)).to_filename(os.path.join(folder, name, '%s_seg.nii.gz' % name))
+
+
+def test_brats_preprocessing(tmp_path):
+    from data.BratsProcessing import brats18_data_loader
+
+    input_folder = str(tmp_path / 'raw')
+    write_brats_patients(input_folder)
+
+    serial_path, pool_path = str(tmp_path / 'serial.hdf5'), str(tmp_path / 'pool.hdf5')
+    brats18_data_loader.prepare_data(input_folder, serial_path, (8, 8, 8), 4, (1.0, 1.0, 1.0))
+    brats18_data_loader.prepare_data(input_folder, pool_path, (8, 8, 8), 4, (1.0, 1.0, 1.0), num_workers=2)
+
+    with h5py.File(serial_path, 'r') as f, h5py.File(pool_path, 'r') as f_pool:
+        # the patients are split by their index in the directory listing, as before the parallel preprocessing
+        assert [pid.decode() for pid in f['pids_validation'][()]] == os.listdir(input_folder)[6:8]
+        assert f['images_train'].shape == (8, 8, 8, 8, 4)
+        for tt in ['train', 'validation']:
+            assert list(f['pids_%s' % tt][()]) == list(f_pool['pids_%s' % tt][()])
+            for name in ['images', 'masks', 'bounding_boxes', 'volume_shapes']:
+                key = '%s_%s' % (name, tt)
+                assert f[key][()].tobytes() == f_pool[key][()].tobytes(), key
+
+        # the brain of patient ii starts at 1 + ii % 3 in the first dimension
+        first = int(f['pids_train'][0].decode().split('_')[-1])
+        assert np.array_equal(f['bounding_boxes_train'][0], [1 + first % 3, 2, 1, 9, 8, 9])
+        assert np.array_equal(f['volume_shapes_train'][0], [10, 10, 10])
+        assert set(np.unique(f['masks_train'][()])) <= {0, 1, 2, 4}
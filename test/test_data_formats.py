@@ -0,0 +1,301 @@
+"""Testing the on-disk dataset formats"""
+
+import json
+
+import h5py
+import numpy as np
+import pytest
+
+from data import mmap_dataset
+from data.batch_provider import BatchProvider
+
+
+def write_lidc_like_file(path, n=20, size=16):
+    rng = np.random.RandomState(0)
+    with h5py.File(path, 'w') as f:
+        for tt in ['train', 'val']:
+            group = f.create_group(tt)
+            group.create_dataset('images', data=rng.rand(n, size, size).astype(np.float32))
+            group.create_dataset('labels', data=(rng.rand(n, size, size, 4) > 0.5).astype(np.uint8))
+            group.create_dataset('uids', data=np.arange(n, dtype=np.int64))
+
+
+def test_npy_export_roundtrip(tmp_path):
+    hdf5_path = str(tmp_path / 'data.hdf5')
+    npy_folder = str(tmp_path / 'data_npy')
+    write_lidc_like_file(hdf5_path)
+
+    assert not mmap_dataset.is_exported(npy_folder)
+    mmap_dataset.export_hdf5_to_npy(hdf5_path, npy_folder)
+    assert mmap_dataset.is_exported(npy_folder) and mmap_dataset.is_exported(npy_folder, hdf5_path)
+
+    data = mmap_dataset.load_npy_dataset(npy_folder)
+    with h5py.File(hdf5_path, 'r') as f:
+        for tt in ['train', 'val']:
+            for name in ['images', 'labels', 'uids']:
+                assert isinstance(data[tt][name], np.memmap)
+                assert data[tt][name].dtype == f[tt][name].dtype
+                assert np.array_equal(data[tt][name], f[tt][name][()])
+
+    images, labels = data['train']['images'], data['train']['labels']
+    provider = BatchProvider(images, labels, np.arange(images.shape[0]), num_labels_per_subject=4)
+    X_batch, y_batch = provider.next_batch(5)
+    assert X_batch.shape == (5, 16, 16) and y_batch.shape == (5, 16, 16)
+
+    # the export of a rewritten HDF5 file is out of date
+    write_lidc_like_file(hdf5_path, n=10)
+    assert mmap_dataset.is_exported(npy_folder) and not mmap_dataset.is_exported(npy_folder, hdf5_path)
+
+
+def test_lidc_layout(tmp_path):
+    from data import lidc_data_loader
+
+    rng = np.random.RandomState(0)
+    images = rng.rand(6, 16, 16) - 0.5
+    labels = (rng.rand(6, 16, 16, 4) > 0.5).astype(np.uint8)
+
+    path = str(tmp_path / 'data_lidc.hdf5')
+    with h5py.File(path, 'w') as f:
+        f.attrs['layout_version'] = lidc_data_loader.LAYOUT_VERSION
+        f.attrs['image_dtype'] = 'float16'
+        f.attrs['compression'] = 'gzip'
+        lidc_data_loader.write_subset(f.create_group('train'), images, labels, np.arange(6),
+                                      image_dtype='float16', compression='gzip')
+
+    assert lidc_data_loader.read_layout(path) == {'layout_version': 2, 'image_dtype': 'float16', 'compression': 'gzip'}
+
+    with h5py.File(path, 'r') as f:
+        assert f['train']['images'].dtype == np.float16
+        assert f['train']['images'].chunks == (1, 16, 16)
+        assert f['train']['labels'].chunks == (1, 16, 16, 4)
+        assert np.array_equal(f['train']['labels'][()], labels)
+
+        provider = BatchProvider(f['train']['images'], f['train']['labels'], np.arange(6), num_labels_per_subject=4)
+        X_batch, _ = provider.next_batch(3)
+        assert X_batch.dtype == np.float32
+
+
+def test_lidc_prepare_data_from_record_stream(tmp_path, monkeypatch):
+    import pickle
+    from data import lidc_data_loader
+
+    rng = np.random.RandomState(0)
+    samples = {'sample_%d' % ii: {'image': rng.rand(8, 8).astype(np.float32),
+                                  'masks': [(rng.rand(8, 8) > 0.5).astype(np.uint8) for _ in range(4)],
+                                  'series_uid': 'series_%d' % (ii // 3)}
+               for ii in range(30)}
+    pickle_file = str(tmp_path / 'data_lidc.pickle')
+    with open(pickle_file, 'wb') as f:
+        pickle.dump(samples, f)
+
+    # small write buffers, so that the samples are written in several ranges
+    monkeypatch.setattr(lidc_data_loader, 'MAX_WRITE_BUFFER', 4)
+    output_file = str(tmp_path / 'data_lidc.hdf5')
+    lidc_data_loader.prepare_data(pickle_file, output_file)
+
+    expected_images = sorted(value['image'].astype(float).sum() - 32 for value in samples.values())
+    with h5py.File(output_file, 'r') as f:
+        assert sum(f[tt]['images'].shape[0] for tt in ['train', 'test', 'val']) == 30
+        images = np.concatenate([f[tt]['images'][()] for tt in ['train', 'test', 'val']])
+        labels = np.concatenate([f[tt]['labels'][()] for tt in ['train', 'test', 'val']])
+    assert np.allclose(sorted(images.reshape(30, -1).sum(-1)), expected_images, atol=1e-4)
+    assert labels.shape == (30, 8, 8, 4)
+    assert (tmp_path / 'data_lidc.records').exists()
+
+    # a changed pickle is converted again instead of reusing the stream
+    del samples['sample_0']
+    with open(pickle_file, 'wb') as f:
+        pickle.dump(samples, f)
+    lidc_data_loader.prepare_data(pickle_file, output_file)
+    with h5py.File(output_file, 'r') as f:
+        assert sum(f[tt]['images'].shape[0] for tt in ['train', 'test', 'val']) == 29
+
+
+def _square_job(job):
+    return np.full((job['size'],), job['value'] ** 2, dtype=np.float32), {'square': 0.0}
+
+
+def _create_squares(hdf5_file):
+    hdf5_file.create_dataset('squares', (12,), dtype=np.float32)
+
+
+def _write_squares(hdf5_file, job, result):
+    hdf5_file['squares'][job['start']:job['start'] + job['size']] = result
+
+
+def test_parallel_preprocessing_resumes(tmp_path):
+    from data import parallel_preprocessing
+
+    jobs = [{'start': 3 * ii, 'size': 3, 'value': ii + 1} for ii in range(4)]
+    expected = np.repeat(np.float32([1, 4, 9, 16]), 3)
+
+    failed = []
+
+    def write_until_failure(hdf5_file, job, result):
+        if job['value'] == 3:
+            failed.append(job)
+            raise RuntimeError('interrupted')
+        _write_squares(hdf5_file, job, result)
+
+    path = str(tmp_path / 'squares.hdf5')
+    try:
+        parallel_preprocessing.preprocess_in_parallel(path, jobs, jobs, _square_job, _create_squares,
+                                                      write_until_failure)
+    except RuntimeError:
+        pass
+    assert failed and not parallel_preprocessing.is_complete(path)
+
+    written = []
+
+    def write_and_record(hdf5_file, job, result):
+        written.append(job['value'])
+        _write_squares(hdf5_file, job, result)
+
+    parallel_preprocessing.preprocess_in_parallel(path, jobs, jobs, _square_job, _create_squares, write_and_record)
+    assert written == [3, 4]
+    assert parallel_preprocessing.is_complete(path)
+
+    pool_path = str(tmp_path / 'squares_pool.hdf5')
+    parallel_preprocessing.preprocess_in_parallel(pool_path, jobs, jobs, _square_job, _create_squares,
+                                                  _write_squares, num_workers=2)
+    with h5py.File(path, 'r') as f, h5py.File(pool_path, 'r') as f_pool:
+        assert np.array_equal(f['squares'][()], expected)
+        assert f['squares'][()].tobytes() == f_pool['squares'][()].tobytes()
+
+
+def write_uzh_patients(image_folder, mask_folder, patient_ids, size=12):
+    import os
+    import nibabel as nib
+
+    rng = np.random.RandomState(0)
+    experts = ['Readings_AH', 'Readings_EK', 'Readings_KC', 'Readings_KS', 'Readings_OD', 'Readings_UM']
+    for expert in experts:
+        os.makedirs(os.path.join(mask_folder, expert))
+    for patient_id in patient_ids:
+        folder = os.path.join(image_folder, '888' + str(patient_id).zfill(2))
+        os.makedirs(folder)
+        # a different number of slices per patient, so that the order of the patients changes the slice ranges
+        shape = (size, size, 2 + patient_id % 3)
+        affine = np.diag([0.5, 0.5, 3.0, 1.0])
+        image = rng.rand(*shape).astype(np.float32)
+        nib.Nifti1Image(image, affine).to_filename(os.path.join(folder, 't2_tse_tra.nii.gz'))
+        for expert in experts:
+            mask = rng.randint(0, 4, shape).astype(np.uint8)
+            nib.Nifti1Image(mask, affine).to_filename(
+                os.path.join(mask_folder, expert, 'Case%s_mask.nii.gz' % str(patient_id).zfill(4)))
+
+
+def serial_uzh_reference(input_image_folder, input_mask_folder, output_file, size, target_resolution):
+    '''
+    The serial UZH prostate preprocessing before it was parallelised: the patients of every subset are processed in
+    the directory listing order and their slices are appended to the datasets
+    '''
+    import os
+    import glob
+    import nibabel as nib
+    from skimage import transform
+    import utils
+    from data.uzh_prostate_data_loader import crop_or_pad_slice_to_size
+
+    experts = ['Readings_AH', 'Readings_EK', 'Readings_KC', 'Readings_KS', 'Readings_OD', 'Readings_UM']
+    patient_ids = {'test': [], 'train': [], 'validation': []}
+    files = {'test': [], 'train': [], 'validation': []}
+    num_slices = {'test': 0, 'train': 0, 'validation': 0}
+
+    for folder in os.listdir(input_image_folder):
+        patient_id = int(folder.lstrip('888'))
+        if patient_id == 9:
+            continue
+        train_test = 'test' if patient_id % 5 == 0 else 'validation' if patient_id % 4 == 0 else 'train'
+        file_path = os.path.join(input_image_folder, folder, 't2_tse_tra.nii.gz')
+        mask_files = [glob.glob(os.path.join(input_mask_folder, exp, '*' + str(patient_id).zfill(4) + '_*.nii.gz'))[0]
+                      for exp in experts]
+        files[train_test].append((file_path, mask_files))
+        patient_ids[train_test].append(patient_id)
+        num_slices[train_test] += nib.load(file_path).shape[2]
+
+    nx, ny = size
+    with h5py.File(output_file, 'w') as hdf5_file:
+        for tt in ['test', 'train', 'validation']:
+            hdf5_file.create_dataset('patient_id_%s' % tt, data=np.asarray(patient_ids[tt], dtype=np.uint8))
+
+        for tt in ['test', 'train', 'validation']:
+            if num_slices[tt] == 0:
+                continue
+            img_list, mask_list = [], []
+            for img_file, mask_files in files[tt]:
+                img_dat = utils.load_nii(img_file)
+                masks_arr = np.asarray([utils.load_nii(mf)[0] for mf in mask_files]).transpose((1, 2, 3, 0))
+                img = utils.normalise_image(img_dat[0])
+                pixdim = img_dat[2].structarr['pixdim']
+                scale_vector = [pixdim[1] / target_resolution[0], pixdim[2] / target_resolution[1]]
+                for zz in range(img.shape[2]):
+                    slice_rescaled = transform.rescale(np.squeeze(img[:, :, zz]), scale_vector, order=1,
+                                                       preserve_range=True, multichannel=False, mode='constant')
+                    mask_rescaled = transform.rescale(np.squeeze(masks_arr[:, :, zz, :]), scale_vector, order=0,
+                                                      preserve_range=True, multichannel=True, mode='constant')
+                    mask_cropped = crop_or_pad_slice_to_size(mask_rescaled, nx, ny)
+                    mask_cropped[mask_cropped == 3] = 0
+                    img_list.append(crop_or_pad_slice_to_size(slice_rescaled, nx, ny))
+                    mask_list.append(mask_cropped)
+            hdf5_file.create_dataset('images_%s' % tt, data=np.asarray(img_list, dtype=np.float32))
+            hdf5_file.create_dataset('masks_%s' % tt, data=np.asarray(mask_list, dtype=np.uint8))
+
+
+def test_uzh_preprocessing_matches_serial_reference(tmp_path):
+    from data import uzh_prostate_data_loader
+
+    image_folder, mask_folder = str(tmp_path / 'images'), str(tmp_path / 'masks')
+    write_uzh_patients(image_folder, mask_folder, [1, 2, 3, 4, 5, 6, 7, 10, 11, 12, 13])
+
+    reference_path = str(tmp_path / 'reference.hdf5')
+    serial_uzh_reference(image_folder, mask_folder, reference_path, (8, 8), (1.0, 1.0))
+
+    for num_workers in [0, 2]:
+        path = str(tmp_path / ('uzh_%d.hdf5' % num_workers))
+        uzh_prostate_data_loader.prepare_data(image_folder, mask_folder, path, (8, 8), (1.0, 1.0),
+                                              num_workers=num_workers)
+        with h5py.File(reference_path, 'r') as reference, h5py.File(path, 'r') as f:
+            assert set(f.keys()) == set(reference.keys())
+            for key in reference.keys():
+                assert f[key].dtype == reference[key].dtype, key
+                assert f[key][()].tobytes() == reference[key][()].tobytes(), key
+
+
+def test_parallel_preprocessing_fingerprint_of_many_jobs(tmp_path):
+    from data import parallel_preprocessing
+
+    # like the BraTS and UZH jobs, hundreds of patients with long absolute paths
+    folder = '/' + '/'.join(['long_input_folder_name'] * 8)
+    jobs = [{'start': ii % 4 * 3, 'size': 3, 'value': ii % 4 + 1,
+             'files': ['%s/Brats18_TCIA_%03d_1/Brats18_TCIA_%03d_1_%s.nii.gz' % (folder, ii, ii, modality)
+                       for modality in ['t1', 't1ce', 't2', 'flair', 'seg']]}
+            for ii in range(300)]
+    assert len(json.dumps(jobs)) > 64 * 1024
+
+    written = []
+
+    def write_until_failure(hdf5_file, job, result):
+        if len(written) == 10:
+            raise RuntimeError('interrupted')
+        written.append(job)
+        _write_squares(hdf5_file, job, result)
+
+    path = str(tmp_path / 'squares.hdf5')
+    with pytest.raises(RuntimeError):
+        parallel_preprocessing.preprocess_in_parallel(path, jobs, jobs, _square_job, _create_squares,
+                                                      write_until_failure)
+
+    # the digest of the jobs matches, so only the remaining jobs are run
+    resumed = []
+
+    def write_and_record(hdf5_file, job, result):
+        resumed.append(job)
+        _write_squares(hdf5_file, job, result)
+
+    parallel_preprocessing.preprocess_in_parallel(path, jobs, jobs, _square_job, _create_squares, write_and_record)
+    assert len(resumed) == len(jobs) - 10
+    assert parallel_preprocessing.is_complete(path)
+
+    with h5py.File(path, 'r') as f:
+        assert np.array_equal(f['squares'][()], np.repeat(np.float32([1, 4, 9, 16]), 3))
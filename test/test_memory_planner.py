@@ -0,0 +1,60 @@
+"""Testing the memory budget planner"""
+
+import types
+
+import pytest
+import torch
+
+import memory_planner
+from models.phiseg import PHISeg
+
+
+def synthetic_profile(step_seconds, saved_mb, parameter_mb=0.0):
+    mb = 1024 ** 2
+    saved_bytes = {level: saved * mb for level, saved in enumerate(saved_mb)}
+    saved_bytes[None] = 10 * mb
+    parameter_bytes = {level: parameter_mb * mb for level in [None] + list(range(len(saved_mb)))}
+    return {'step_seconds': step_seconds, 'saved_bytes': saved_bytes, 'parameter_bytes': parameter_bytes,
+            'forward_seconds': {level: 1.0 for level in range(len(saved_mb))}}
+
+
+def test_plan_levels_prefers_the_fastest_plan_within_the_budget():
+    # checkpointing costs 1 s per level and saves most of the memory, the reversible blocks cost 2 s per level
+    profiles = {'plain': synthetic_profile(10.0, [100, 50, 20]),
+                'checkpoint': synthetic_profile(13.0, [10, 5, 2]),
+                'reversible': synthetic_profile(16.0, [1, 1, 1])}
+
+    levels, memory, seconds = memory_planner.plan_levels(profiles, 1000 * 1024 ** 2)
+    assert levels == {0: 'plain', 1: 'plain', 2: 'plain'} and seconds == 10.0
+
+    levels, memory, seconds = memory_planner.plan_levels(profiles, 100 * 1024 ** 2)
+    assert levels == {0: 'checkpoint', 1: 'plain', 2: 'plain'} and seconds == 11.0
+    assert memory == 90 * 1024 ** 2
+
+    levels, _, _ = memory_planner.plan_levels(profiles, 22 * 1024 ** 2)
+    assert levels == {0: 'reversible', 1: 'checkpoint', 2: 'checkpoint'}
+
+    # the batch of the plan is twice the profiled batch
+    levels, _, _ = memory_planner.plan_levels(profiles, 200 * 1024 ** 2, scale=2.0)
+    assert levels == {0: 'checkpoint', 1: 'plain', 2: 'plain'}
+
+    with pytest.raises(ValueError):
+        memory_planner.plan_levels(profiles, 12 * 1024 ** 2)
+
+
+def test_profile_counts_the_levels_of_every_mode():
+    exp_config = types.SimpleNamespace(model=PHISeg, input_channels=1, n_classes=2, filter_channels=[4] * 7,
+                                       latent_levels=5, no_convs_fcomb=4, beta=10.0, image_size=(1, 64, 64))
+    patch = torch.randn(2, 1, 64, 64)
+    mask = (torch.rand(2, 1, 64, 64) > 0.5).float()
+
+    profiles = {mode: memory_planner.profile(memory_planner.build_net(exp_config, mode, (1, 64, 64)), patch, mask,
+                                             steps=1)
+                for mode in memory_planner.MODES}
+
+    for mode, profile in profiles.items():
+        assert set(profile['saved_bytes']) == {None} | set(range(7))
+        assert all(profile['forward_seconds'][level] > 0 for level in range(7))
+    # the full resolution level keeps less memory when checkpointed or reversible
+    assert profiles['checkpoint']['saved_bytes'][0] < profiles['plain']['saved_bytes'][0] / 2
+    assert profiles['reversible']['saved_bytes'][0] < profiles['plain']['saved_bytes'][0]
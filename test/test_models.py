@@ -0,0 +1,154 @@
+"""Testing the inference paths of the models"""
+
+import torch
+
+from models.phiseg import PHISeg
+from models.probabilistic_unet import ProbabilisticUnet
+
+
+def test_phiseg_sample_n_matches_repeated_prior():
+    net = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128)).eval()
+    patch = torch.randn(2, 1, 128, 128)
+
+    with torch.no_grad():
+        torch.manual_seed(0)
+        z_repeated, mu_repeated, _ = net.prior(patch.repeat_interleave(3, dim=0))
+        s_repeated = net.likelihood(z_repeated)
+
+        torch.manual_seed(0)
+        s_out_list = net.sample_n(patch, 3)
+
+    assert len(s_out_list) == len(s_repeated)
+    for s, s_ref in zip(s_out_list, s_repeated):
+        assert s.shape == (6, 2, 128, 128)
+        assert torch.allclose(s, s_ref, atol=1e-5)
+    for mu, mu_ref in zip(net.prior_mu, mu_repeated):
+        assert torch.allclose(mu, mu_ref, atol=1e-5)
+
+
+def test_phiseg_sample_n_loss():
+    net = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128)).eval()
+    patch = torch.randn(2, 1, 128, 128)
+    mask = (torch.rand(2, 1, 128, 128) > 0.5).float()
+
+    with torch.no_grad():
+        net.sample_n(patch, 3, mask=mask)
+        loss = net.loss(mask.repeat_interleave(3, dim=0))
+
+    assert net.posterior_mu[0].shape[0] == 6
+    assert torch.isfinite(loss)
+
+
+def test_probabilistic_unet_sample_n():
+    net = ProbabilisticUnet(input_channels=1, num_classes=2, num_filters=[32, 8, 8, 8], latent_dim=3).eval()
+    patch = torch.randn(2, 1, 64, 64)
+    mask = (torch.rand(2, 1, 64, 64) > 0.5).float()
+
+    with torch.no_grad():
+        samples = net.sample_n(patch, 4, mask=mask)
+        z_prior = net.z_prior_sample
+        loss = net.loss(mask.repeat_interleave(4, dim=0))
+
+        # every sample of an image is decoded from the feature map of that image with its own latent code
+        net.forward(patch[1:], training=False)
+        reference = net.fcomb.forward(net.unet_features.expand(4, -1, -1, -1), z_prior[4:])
+
+    assert samples.shape == (8, 2, 64, 64)
+    assert torch.allclose(samples[4:], reference, atol=1e-5)
+    assert torch.isfinite(loss)
+
+
+def test_fcomb_matches_tiled_concatenation():
+    fcomb = ProbabilisticUnet(input_channels=1, num_classes=2, num_filters=[32, 8], latent_dim=6).fcomb.eval()
+    feature_map = torch.randn(3, 32, 16, 16)
+    z = torch.randn(3, 6)
+
+    with torch.no_grad():
+        tiled = z.view(3, 6, 1, 1).expand(-1, -1, 16, 16)
+        reference = fcomb.last_layer(fcomb.layers(torch.cat([feature_map, tiled], dim=1)))
+        output = fcomb.forward(feature_map, z)
+
+        # two latent samples per feature map
+        z_pairs = torch.randn(6, 6)
+        reference_pairs = fcomb.forward(feature_map.repeat_interleave(2, dim=0), z_pairs)
+        output_pairs = fcomb.forward(feature_map, z_pairs)
+
+    assert torch.allclose(output, reference, atol=1e-5)
+    assert torch.allclose(output_pairs, reference_pairs, atol=1e-5)
+
+
+def test_phiseg_mixed_precision_keeps_sensitive_parts_in_float32():
+    net = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128))
+    patch = torch.randn(2, 1, 128, 128)
+    mask = (torch.rand(2, 1, 128, 128) > 0.5).float()
+
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        s_out_list = net.forward(patch, mask, training=True)
+        loss = net.loss(mask)
+
+    assert s_out_list[0].dtype == torch.bfloat16
+    assert all(sigma.dtype == torch.float32 for sigma in net.posterior_sigma + net.prior_sigma)
+    assert loss.dtype == torch.float32 and torch.isfinite(loss)
+    assert net.kl_divergence_loss.dtype == torch.float32
+
+    loss.backward()
+    assert all(torch.isfinite(p.grad).all() for p in net.parameters() if p.grad is not None)
+
+
+def test_phiseg_loss_dict_is_detached():
+    net = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128))
+    patch = torch.randn(2, 1, 128, 128)
+    mask = (torch.rand(2, 1, 128, 128) > 0.5).float()
+
+    net.forward(patch, mask, training=True)
+    loss = net.loss(mask)
+
+    assert len(net.loss_dict) == 2 * net.latent_levels
+    assert all(not value.requires_grad for value in net.loss_dict.values())
+    assert torch.allclose(sum(net.loss_dict.values()), loss.detach())
+
+
+def test_phiseg_checkpointing_matches_plain_model():
+    torch.manual_seed(0)
+    plain = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128))
+    checkpointed = PHISeg(input_channels=1, num_classes=2, num_filters=[4] * 7, image_size=(1, 128, 128),
+                          checkpoint_levels=range(7))
+    assert list(checkpointed.state_dict()) == list(plain.state_dict())
+    checkpointed.load_state_dict(plain.state_dict())
+
+    patch = torch.randn(2, 1, 128, 128)
+    mask = (torch.rand(2, 1, 128, 128) > 0.5).float()
+
+    losses = []
+    for net in [plain, checkpointed]:
+        torch.manual_seed(1)
+        net.forward(patch, mask, training=True)
+        loss = net.loss(mask)
+        loss.backward()
+        losses.append(loss.detach())
+
+    assert torch.equal(losses[0], losses[1])
+    for p_plain, p_checkpointed in zip(plain.parameters(), checkpointed.parameters()):
+        assert (p_plain.grad is None) == (p_checkpointed.grad is None)
+        assert p_plain.grad is None or torch.equal(p_plain.grad, p_checkpointed.grad)
+    # the batch norm statistics are only updated once
+    for (name, b_plain), b_checkpointed in zip(plain.named_buffers(), checkpointed.buffers()):
+        assert torch.equal(b_plain, b_checkpointed), name
+
+
+def test_probabilistic_unet_checkpoint_and_reversible_levels():
+    from torchlayers import ReversibleSequence
+
+    net = ProbabilisticUnet(input_channels=1, num_classes=2, num_filters=[32, 8, 8, 8], latent_dim=3,
+                            reversible=[2], checkpoint_levels=[0, 1])
+    down_blocks = net.unet.contracting_path
+    assert [block.checkpoint for block in down_blocks] == [True, True, False, False]
+    assert [any(isinstance(layer, ReversibleSequence) for layer in block.layers) for block in down_blocks] == \
+        [False, False, True, False]
+
+    patch = torch.randn(2, 1, 64, 64)
+    mask = (torch.rand(2, 1, 64, 64) > 0.5).float()
+    net.forward(patch, mask, training=True)
+    loss = net.loss(mask)
+    loss.backward()
+    assert torch.isfinite(loss)
@@ -54,6 +54,63 @@ def test_ged(lidc_data):
     pass
 
 
+def test_ged_empty_masks():
+    empty = torch.zeros((3, 16, 16), dtype=torch.long)
+    full = torch.ones((2, 16, 16), dtype=torch.float32)
+
+    assert utils.generalised_energy_distance(empty, empty.float(), nlabels=1, label_range=range(1, 2)) == 0.0
+    assert utils.generalised_energy_distance(empty, full, nlabels=1, label_range=range(1, 2)) == 2.0
+
+
+def test_ged_matches_per_pair_reference():
+    from benchmarks.metric_references import random_blobs, reference_generalised_energy_distance
+
+    torch.manual_seed(1)
+    samples = random_blobs(12, 32, torch.device('cpu'), nlabels=3)
+    annotations = random_blobs(4, 32, torch.device('cpu'), nlabels=3).float()
+
+    ged = utils.generalised_energy_distance(samples, annotations, nlabels=2, label_range=range(1, 3))
+    ged_ref = reference_generalised_energy_distance(samples, annotations, nlabels=2, label_range=range(1, 3))
+    assert math.isclose(ged, ged_ref, abs_tol=1e-12)
+
+    batched = utils.generalised_energy_distance(samples.unsqueeze(0).repeat(2, 1, 1, 1),
+                                                annotations.unsqueeze(0).repeat(2, 1, 1, 1),
+                                                nlabels=2, label_range=range(1, 3))
+    assert batched.shape == (2,)
+    assert math.isclose(batched[1].item(), ged_ref, abs_tol=1e-12)
+
+
+def test_ncc_matches_numpy_reference():
+    from benchmarks.metric_references import random_blobs, random_softmax, reference_variance_ncc_dist
+
+    torch.manual_seed(2)
+    samples = random_softmax(8, 2, 32, torch.device('cpu'))
+    annotations = utils.convert_batch_to_onehot(random_blobs(4, 32, torch.device('cpu')).unsqueeze(1), nlabels=2)
+
+    ncc = utils.variance_ncc_dist(samples, annotations)
+    assert ncc.shape == (1,)
+    assert math.isclose(ncc[0].item(), reference_variance_ncc_dist(samples, annotations)[0], abs_tol=1e-5)
+
+    batched = utils.variance_ncc_dist(torch.stack([samples, samples.flip(0)]), torch.stack([annotations] * 2))
+    assert batched.shape == (2,)
+    assert math.isclose(batched[0].item(), batched[1].item(), abs_tol=1e-6)
+
+
 def test_dice(lidc_data):
     pass
 
+
+def test_per_label_dice():
+    prediction = torch.zeros((3, 8, 8), dtype=torch.long)
+    ground_truth = torch.zeros((3, 8, 8))
+    prediction[1, :4] = 1
+    ground_truth[1, :2] = 1
+    ground_truth[2, 0, 0] = 1
+
+    dice = utils.per_label_dice(prediction, ground_truth, nlabels=2)
+
+    assert dice.shape == (3, 2)
+    assert dice[0].tolist() == [1.0, 1.0]  # label 1 absent in both
+    assert math.isclose(dice[1, 1].item(), 2 * 16 / (32 + 16))
+    assert math.isclose(dice[1, 0].item(), 2 * 32 / (32 + 48))
+    assert dice[2, 1].item() == 0.0  # label 1 only in the ground truth
@@ -0,0 +1,236 @@
+"""Testing the training loop of UNetModel"""
+
+import types
+import logging
+
+import pytest
+import torch
+
+from train_model import UNetModel
+
+
+class PixelwiseModel(torch.nn.Module):
+    """Deterministic model without batch statistics, its loss terms are means over the images like the ones of PHISeg"""
+
+    def __init__(self, **kwargs):
+        super(PixelwiseModel, self).__init__()
+        self.conv = torch.nn.Conv2d(1, 2, kernel_size=3, padding=1)
+
+    def forward(self, patch, mask, training=True):
+        self.prediction = self.conv(patch)
+        return self.prediction
+
+    def loss(self, mask):
+        self.reconstruction_loss = torch.nn.functional.cross_entropy(
+            self.prediction, mask[:, 0].long(), reduction='none').sum(dim=(1, 2)).mean()
+        self.kl_divergence_loss = 0.1 * self.prediction.pow(2).sum(dim=(1, 2, 3)).mean()
+        return self.reconstruction_loss + self.kl_divergence_loss
+
+
+def trainer(**kwargs):
+    options = dict(model=PixelwiseModel, input_channels=1, n_classes=2, filter_channels=[4], latent_levels=1,
+                   no_convs_fcomb=4, beta=1.0, image_size=(1, 16, 16), use_reversible=False, batch_size=4,
+                   pretrained_model=None)
+    options.update(kwargs)
+    exp_config = types.SimpleNamespace(**options)
+    torch.manual_seed(0)
+    return UNetModel(exp_config, logger=logging.getLogger('test'), tensorboard=False)
+
+
+def gradients(model):
+    return [p.grad.clone() for p in model.net.parameters()]
+
+
+def test_gradient_accumulation_matches_full_batch():
+    patch = torch.randn(8, 1, 16, 16)
+    mask = (torch.rand(8, 1, 16, 16) > 0.5).float()
+
+    full_batch = trainer(batch_size=8)
+    full_batch._train_step([(patch, mask)])
+
+    accumulated = trainer(accumulation_steps=2, micro_batch_size=3)
+    accumulated._train_step([(patch[:4], mask[:4]), (patch[4:], mask[4:])])
+
+    assert torch.allclose(accumulated.loss, full_batch.loss)
+    assert torch.allclose(accumulated.step_kl_loss, full_batch.step_kl_loss)
+    for accumulated_grad, full_grad in zip(gradients(accumulated), gradients(full_batch)):
+        assert torch.allclose(accumulated_grad, full_grad, atol=1e-5)
+
+
+def test_micro_batch_size_reduced_when_out_of_memory():
+    patch = torch.randn(4, 1, 16, 16)
+    mask = (torch.rand(4, 1, 16, 16) > 0.5).float()
+
+    reference = trainer()
+    reference._train_step([(patch, mask)])
+
+    model = trainer(micro_batch_size='auto')
+    forward = model.net.forward
+
+    def forward_with_memory_limit(patch, mask, training=True):
+        if patch.shape[0] > 1:
+            raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+        return forward(patch, mask, training)
+
+    model.net.forward = forward_with_memory_limit
+    model._train_step([(patch, mask)])
+
+    assert model.micro_batch_size == 1
+    assert torch.allclose(model.loss, reference.loss)
+    for grad, reference_grad in zip(gradients(model), gradients(reference)):
+        assert torch.allclose(grad, reference_grad, atol=1e-5)
+
+
+def test_metrics_accumulator():
+    from utils import MetricsAccumulator
+
+    metrics = MetricsAccumulator(percentiles=(50, 90))
+    weight = torch.ones(1, requires_grad=True)
+    for ii in range(1, 11):
+        metrics.add('loss', weight.sum() * ii)
+        metrics.add_dict({'lvl0': torch.tensor(2.0 * ii), 'lvl1': 3.0}, prefix='kl_')
+
+    assert len(metrics) == 10
+    assert all(not value.requires_grad for values in metrics.values.values() for value in values)
+
+    summary = metrics.summary()
+    assert list(summary) == ['loss', 'kl_lvl0', 'kl_lvl1']
+    assert summary['loss'] == pytest.approx({'mean': 5.5, 'p50': 5.5, 'p90': 9.1})
+    assert summary['kl_lvl0']['mean'] == 11.0 and summary['kl_lvl1']['p90'] == 3.0
+
+    metrics.reset()
+    assert len(metrics) == 0 and metrics.summary() == {}
+
+
+def test_resumed_training_matches_uninterrupted_training(tmp_path):
+    import numpy as np
+    from data.batch_provider import BatchProvider
+    from models.phiseg import PHISeg
+
+    rng = np.random.RandomState(0)
+    images = rng.rand(10, 128, 128).astype(np.float32)
+    labels = (rng.rand(10, 128, 128, 4) > 0.5).astype(np.uint8)
+
+    def run(iterations, log_dir, resume=False):
+        model = trainer(batch_size=2, model=PHISeg, filter_channels=[4] * 7, latent_levels=5, image_size=(1, 128, 128),
+                        iterations=iterations, validation_frequency=100, logging_frequency=2, checkpoint_frequency=3,
+                        experiment_name='test')
+        model.log_dir = log_dir
+        data = types.SimpleNamespace(train=BatchProvider(images, labels, np.arange(10), add_dummy_dimension=True,
+                                                         num_labels_per_subject=4))
+        if resume:
+            model.load_training_state(model.training_state_path(), data)
+        else:
+            np.random.seed(1)
+            torch.manual_seed(1)
+        model.train(data)
+        return model
+
+    (tmp_path / 'uninterrupted').mkdir()
+    (tmp_path / 'interrupted').mkdir()
+
+    uninterrupted = run(8, str(tmp_path / 'uninterrupted'))
+    run(5, str(tmp_path / 'interrupted'))
+    resumed = run(8, str(tmp_path / 'interrupted'), resume=True)
+
+    assert resumed.iteration == uninterrupted.iteration == 7
+    assert torch.equal(resumed.loss, uninterrupted.loss)
+    for name, value in uninterrupted.net.state_dict().items():
+        assert torch.equal(resumed.net.state_dict()[name], value), name
+    assert resumed.scheduler.state_dict() == uninterrupted.scheduler.state_dict()
+
+
+def test_failing_step_stops_the_workers_and_writes_the_checkpoint(tmp_path):
+    import threading
+    import numpy as np
+    from data.batch_provider import BatchProvider
+    import training_state
+
+    rng = np.random.RandomState(0)
+    images = rng.rand(8, 16, 16).astype(np.float32)
+    labels = (rng.rand(8, 16, 16, 4) > 0.5).astype(np.uint8)
+
+    model = trainer(batch_size=2, iterations=10, validation_frequency=100, logging_frequency=100,
+                    checkpoint_frequency=1, prefetch_workers=1, experiment_name='test')
+    model.log_dir = str(tmp_path)
+    data = types.SimpleNamespace(train=BatchProvider(images, labels, np.arange(8), add_dummy_dimension=True,
+                                                     num_labels_per_subject=4))
+    train_step = model._train_step
+
+    def train_step_out_of_memory(batches):
+        if model.iteration == 3:
+            raise RuntimeError('CUDA out of memory. Tried to allocate 2.00 GiB')
+        train_step(batches)
+
+    model._train_step = train_step_out_of_memory
+    closed = []
+    close = data.train.close
+    data.train.close = lambda: closed.append(True) or close()
+    with pytest.raises(RuntimeError):
+        model.train(data)
+
+    assert not any(thread.name.startswith('BatchPrefetcher') and thread.is_alive() for thread in threading.enumerate())
+    assert closed
+    assert training_state.load(model.training_state_path(), 'cpu')['iteration'] == 2
+
+
+def test_checkpoint_waits_for_the_batch_read_of_a_running_prefetcher():
+    import threading
+    import numpy as np
+    from data.batch_provider import BatchProvider
+    from data.prefetcher import BatchPrefetcher
+
+    rng = np.random.RandomState(0)
+    images = rng.rand(8, 16, 16).astype(np.float32)
+    labels = (rng.rand(8, 16, 16) > 0.5).astype(np.uint8)
+
+    reading = threading.Event()
+    resume = threading.Event()
+
+    class SlowBatchProvider(BatchProvider):
+        """Pauses in its first batch read, after the new epoch permutation is drawn"""
+
+        def read_next_batch(self, batch_size):
+            if not reading.is_set():
+                self.epoch_permutation = self.rng.permutation(self.indices)
+                self.epoch_position = 0
+                reading.set()
+                resume.wait()
+            return super(SlowBatchProvider, self).read_next_batch(batch_size)
+
+    model = trainer(batch_size=2)
+    data = types.SimpleNamespace(train=SlowBatchProvider(images, labels, np.arange(8), add_dummy_dimension=True,
+                                                         seed=0))
+    prefetcher = BatchPrefetcher(data.train, 2, model.device, queue_depth=1)
+    try:
+        reading.wait()
+        states = []
+        checkpoint = threading.Thread(target=lambda: states.append(model.training_state(data, prefetcher)))
+        checkpoint.start()
+        checkpoint.join(timeout=0.5)
+        assert checkpoint.is_alive()
+
+        resume.set()
+        checkpoint.join()
+    finally:
+        resume.set()
+        prefetcher.stop()
+
+    provider_state = states[0]['batch_provider']
+    assert provider_state['epoch_permutation'] is not None
+    assert provider_state['epoch_position'] in [2, 4]
+
+    # the provider restored from the checkpoint continues with the batches the prefetcher read next
+    resumed = BatchProvider(images, labels, np.arange(8), add_dummy_dimension=True, seed=0)
+    resumed.set_state(provider_state)
+    permutation = provider_state['epoch_permutation']
+    position = provider_state['epoch_position']
+    x_b, _ = resumed.read_next_batch(2)
+    assert np.array_equal(x_b, images[np.sort(permutation[position:position + 2])])
+
+
+def test_checkpoint_levels_rejected_for_models_without_checkpointing():
+    from models.phiseg3D import PHISeg3D
+
+    with pytest.raises(ValueError):
+        trainer(model=PHISeg3D, checkpoint_levels=[0])
@@ -1,9 +1,49 @@
 """Custom layers with activation and norm for code readability"""
+from contextlib import contextmanager, nullcontext
+
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import revtorch as rv
 
 
+def selected_levels(levels, num_levels):
+    """
+    Resolution levels selected by an option which is either True (all levels), False or None (no level) or a
+    collection of levels
+    """
+    if levels is True:
+        return set(range(num_levels))
+    return set(levels or ())
+
+
+def checkpoint_activations(module, function, *args):
+    """
+    Calls function(*args) with activation checkpointing when gradients are computed: the activations inside function
+    are not stored but recomputed in the backward pass, only its inputs and outputs are kept. The random number
+    generator state is restored for the recomputation and the batch norm layers of module do not update their running
+    statistics a second time, so the results and the state of the model are the same as without checkpointing.
+    """
+    if not torch.is_grad_enabled():
+        return function(*args)
+    return torch.utils.checkpoint.checkpoint(function, *args, use_reentrant=False,
+                                             context_fn=lambda: (nullcontext(), _frozen_batch_norm_statistics(module)))
+
+
+@contextmanager
+def _frozen_batch_norm_statistics(module):
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
 class Conv2D(nn.Module):
     def __init__(self, input_dim, output_dim, kernel_size=3, stride=1, padding=1, activation=torch.nn.ReLU, norm=torch.nn.BatchNorm2d,
                  norm_before_activation=True):
@@ -9,13 +9,17 @@ import logging
 import shutil
 from importlib.machinery import SourceFileLoader
 import argparse
+import inspect
 import time
 from medpy.metric import dc
 import math
 
 # own files
 import utils
+import memory_planner
+import training_state
 from data.batch_provider import resize_batch
+from data.prefetcher import BatchPrefetcher
 import data.bratsDataset as bratsDataset
 
 # catch all the warnings with the debugger
@@ -23,13 +27,45 @@ import data.bratsDataset as bratsDataset
 # warnings.filterwarnings('error')
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
+# number of validation images evaluated per forward pass when running on the CPU
+DEFAULT_CPU_VALIDATION_IMAGES_PER_PASS = 4
+
 
 class UNetModel:
     '''Wrapper class for different Unet models to facilitate training, validation, logging etc.
         Args:
             exp_config: Experiment configuration file as given in the experiment folder
+            log_dir: Folder of the full training state checkpoints, no checkpoints are written if it is None
     '''
-    def __init__(self, exp_config, logger=None, tensorboard=True):
+    def __init__(self, exp_config, logger=None, tensorboard=True, log_dir=None):
+
+        self.exp_config = exp_config
+        self.batch_size = exp_config.batch_size
+        self.logger = logger
+        self.log_dir = log_dir
+
+        # activation checkpointing is only passed to the models if it is configured, not all models support it
+        model_options = {}
+        if getattr(exp_config, 'checkpoint_levels', None):
+            model_options['checkpoint_levels'] = exp_config.checkpoint_levels
+        reversible = exp_config.use_reversible
+
+        # a plan of memory_planner.py replaces use_reversible and checkpoint_levels
+        if getattr(exp_config, 'memory_plan', None) is not None:
+            plan = memory_planner.load_plan(exp_config.memory_plan)
+            self.logger.info('Using the memory plan {} (modes per resolution level: {})'.format(
+                exp_config.memory_plan, ', '.join(plan['modes'])))
+            if plan['batch_size'] != self.batch_size or plan['image_size'] != list(exp_config.image_size):
+                self.logger.warning('The memory plan was made for batch size {} and image size {}'.format(
+                    plan['batch_size'], plan['image_size']))
+            if plan['checkpoint_levels']:
+                model_options['checkpoint_levels'] = plan['checkpoint_levels']
+            reversible = plan['reversible_levels']
+
+        if 'checkpoint_levels' in model_options and \
+                'checkpoint_levels' not in inspect.signature(exp_config.model).parameters:
+            raise ValueError('checkpoint_levels is set, but {} does not support activation checkpointing'.format(
+                exp_config.model.__name__))
 
         self.net = exp_config.model(input_channels=exp_config.input_channels,
                                     num_classes=exp_config.n_classes,
@@ -38,17 +74,31 @@ class UNetModel:
                                     no_convs_fcomb=exp_config.no_convs_fcomb,
                                     beta=exp_config.beta,
                                     image_size=exp_config.image_size,
-                                    reversible=exp_config.use_reversible
+                                    reversible=reversible,
+                                    **model_options
                                     )
-        self.exp_config = exp_config
-        self.batch_size = exp_config.batch_size
-        self.logger = logger
+
+        # gradient accumulation: every optimizer step sees accumulation_steps batches of batch_size images, and
+        # every batch is passed through the network in micro batches of micro_batch_size images
+        self.accumulation_steps = getattr(exp_config, 'accumulation_steps', 1)
+        self.auto_micro_batch_size = getattr(exp_config, 'micro_batch_size', None) == 'auto'
+        self.micro_batch_size = self.batch_size if getattr(exp_config, 'micro_batch_size', None) in [None, 'auto'] \
+            else exp_config.micro_batch_size
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.net.to(self.device)
         self.optimizer = torch.optim.Adam(self.net.parameters(), lr=1e-3, weight_decay=1e-5)
+
+        # optional automatic mixed precision, float16 with loss scaling on the GPU and bfloat16 on the CPU
+        self.mixed_precision = getattr(exp_config, 'use_mixed_precision', False)
+        self.mixed_precision_dtype = getattr(torch, getattr(exp_config, 'mixed_precision_dtype',
+                                                            'float16' if self.device.type == 'cuda' else 'bfloat16'))
+        self.grad_scaler = torch.amp.GradScaler(self.device.type, enabled=self.mixed_precision and
+                                                self.mixed_precision_dtype == torch.float16)
+        # stepped with the mean training loss every logging_frequency iterations, the patience of 50000 iterations
+        # is given in logging intervals
         self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-            self.optimizer, 'min', min_lr=1e-4, verbose=True, patience=50000)
+            self.optimizer, 'min', min_lr=1e-4, patience=max(1, 50000 // getattr(exp_config, 'logging_frequency', 1)))
 
         if exp_config.pretrained_model is not None:
             self.logger.info('Loading pretrained model {}'.format(exp_config.pretrained_model))
@@ -67,9 +117,9 @@ class UNetModel:
                                  .format(save_model_path))
 
         self.mean_loss_of_epoch = 0
-        self.tot_loss = 0
-        self.kl_loss = 0
-        self.reconstruction_loss = 0
+        # detached loss terms of the training steps, summarised every logging_frequency steps
+        self.training_metrics = utils.MetricsAccumulator()
+        self.training_summary = {}
         self.dice_mean = 0
         self.val_loss = 0
         self.foreground_dice = 0
@@ -86,55 +136,215 @@ class UNetModel:
         self.best_ged = np.inf
         self.best_ncc = -1
 
+        self.validation_images_per_pass = None
+        self.validation_memory_per_image = None
+
         if tensorboard:
             self.training_writer = SummaryWriter()
             self.validation_writer = SummaryWriter(comment='_validation')
         self.iteration = 0
+        # first iteration of train(), set by load_training_state
+        self.start_iteration = 1
 
     def train(self, data):
         self.net.train()
         self.logger.info('Starting training.')
         self.logger.info('Current filters: {}'.format(self.exp_config.filter_channels))
         self.logger.info('Batch size: {}'.format(self.batch_size))
+        if self.accumulation_steps > 1 or self.micro_batch_size != self.batch_size or self.auto_micro_batch_size:
+            self.logger.info('Effective batch size: {} (micro batch size: {}{})'.format(
+                self.batch_size * self.accumulation_steps, self.micro_batch_size,
+                ', reduced when out of memory' if self.auto_micro_batch_size else ''))
+
+        # optional background preparation of the training batches
+        prefetch_workers = getattr(self.exp_config, 'prefetch_workers', 0)
+        if prefetch_workers > 0:
+            prefetcher = BatchPrefetcher(data.train, self.batch_size, self.device,
+                                         queue_depth=getattr(self.exp_config, 'prefetch_queue_depth', 4),
+                                         num_workers=prefetch_workers)
+            self.logger.info('Prefetching batches with {} worker(s)'.format(prefetch_workers))
+        else:
+            prefetcher = None
+
+        # full training state checkpoints, written in the background every checkpoint_frequency iterations
+        checkpoint_frequency = getattr(self.exp_config, 'checkpoint_frequency', self.exp_config.validation_frequency)
+        checkpoint_writer = None
+        if self.log_dir is not None and checkpoint_frequency:
+            checkpoint_writer = training_state.AsyncCheckpointWriter()
+            if prefetcher is not None:
+                self.logger.info('The batches in the prefetch queue are not part of the training state checkpoints, '
+                                 'a resumed training skips them')
+
+        if self.start_iteration > 1:
+            self.logger.info('Resuming the training at iteration {}'.format(self.start_iteration))
+
+        # the prefetch threads and augmentation workers are stopped and the last checkpoint is written also when a
+        # step raises
+        try:
+            for self.iteration in range(self.start_iteration, self.exp_config.iterations):
+                batches = []
+                for _ in range(self.accumulation_steps):
+                    if prefetcher is not None:
+                        patch, mask = prefetcher.next_batch()
+                    else:
+                        x_b, s_b = data.train.next_batch(self.batch_size)
 
-        for self.iteration in range(1, self.exp_config.iterations):
-            x_b, s_b = data.train.next_batch(self.batch_size)
-
-            patch = torch.tensor(x_b, dtype=torch.float32).to(self.device)
-
-            mask = torch.tensor(s_b, dtype=torch.float32).to(self.device)
-            mask = torch.unsqueeze(mask, 1)
-
-            self.mask = mask
-            self.patch = patch
+                        patch = torch.tensor(x_b, dtype=torch.float32).to(self.device)
+                        mask = torch.tensor(s_b, dtype=torch.float32).to(self.device)
 
-            self.net.forward(patch, mask, training=True)
-            self.loss = self.net.loss(mask)
+                    batches.append((patch, torch.unsqueeze(mask, 1)))
 
-            self.tot_loss += self.loss
+                self.patch, self.mask = batches[-1]
 
-            self.reconstruction_loss += self.net.reconstruction_loss
-            self.kl_loss += self.net.kl_divergence_loss
+                self._train_step(batches)
 
-            self.optimizer.zero_grad()
+                self.training_metrics.add('loss', self.loss)
+                self.training_metrics.add('reconstruction_loss', self.step_reconstruction_loss)
+                self.training_metrics.add('kl_divergence_loss', self.step_kl_loss)
+                self.training_metrics.add_dict(self.step_loss_dict)
 
-            self.loss.backward()
-            self.optimizer.step()
+                if self.iteration % self.exp_config.validation_frequency == 0:
+                    self.validate(data)
 
-            if self.iteration % self.exp_config.validation_frequency == 0:
-                self.validate(data)
+                if self.iteration % self.exp_config.logging_frequency == 0:
+                    self.training_summary = self.training_metrics.summary()
+                    self.training_metrics.reset()
+                    self.logger.info('Iteration {} Loss {}'.format(self.iteration,
+                                                                   self.training_summary['loss']['mean']))
+                    for name, summary in self.training_summary.items():
+                        self.logger.info(' - {}: {}'.format(name, ', '.join('{} {:.4f}'.format(key, value)
+                                                                          for key, value in summary.items())))
+                    #self._create_tensorboard_summary()
 
-            if self.iteration % self.exp_config.logging_frequency == 0:
-                self.logger.info('Iteration {} Loss {}'.format(self.iteration, self.loss))
-                #self._create_tensorboard_summary()
-                self.tot_loss = 0
-                self.kl_loss = 0
-                self.reconstruction_loss = 0
+                    self.scheduler.step(self.training_summary['loss']['mean'])
 
-            self.scheduler.step(self.loss)
+                if checkpoint_writer is not None and self.iteration % checkpoint_frequency == 0:
+                    checkpoint_writer.write(self.training_state(data, prefetcher), self.training_state_path())
+        finally:
+            if prefetcher is not None:
+                prefetcher.stop()
+            # stops the augmentation worker processes of the batch provider
+            if hasattr(data.train, 'close'):
+                data.train.close()
+            if checkpoint_writer is not None:
+                checkpoint_writer.close()
 
         self.logger.info('Finished training.')
 
+    def _train_step(self, batches):
+        """
+        One optimizer step on the (patch, mask) batches. The gradients of the micro batches are accumulated, the loss
+        of every micro batch is weighted with its share of all images of the step. Since the loss terms of the models
+        are means over the images of a batch, the accumulated gradient and the loss are the ones of a single batch
+        with all images (up to the batch statistics of the BatchNorm layers, which are computed per micro batch).
+        The loss and its terms are stored detached in self.loss, self.step_reconstruction_loss, self.step_kl_loss and,
+        per latent level, self.step_loss_dict.
+        """
+        num_images = sum(patch.shape[0] for patch, _ in batches)
+
+        while True:
+            micro_batch_size = self.micro_batch_size
+            self.optimizer.zero_grad()
+            loss, reconstruction_loss, kl_loss = 0, 0, 0
+            loss_dict = {}
+
+            try:
+                for patch, mask in batches:
+                    for start in range(0, patch.shape[0], micro_batch_size):
+                        micro_patch = patch[start:start + micro_batch_size]
+                        micro_mask = mask[start:start + micro_batch_size]
+                        weight = micro_patch.shape[0] / num_images
+
+                        with self._autocast():
+                            self.net.forward(micro_patch, micro_mask, training=True)
+                            micro_loss = self.net.loss(micro_mask)
+
+                        self.grad_scaler.scale(weight * micro_loss).backward()
+
+                        loss += weight * micro_loss.detach()
+                        reconstruction_loss += weight * self.net.reconstruction_loss.detach()
+                        kl_loss += weight * self.net.kl_divergence_loss.detach()
+                        for name, value in getattr(self.net, 'loss_dict', {}).items():
+                            loss_dict[name] = loss_dict.get(name, 0) + weight * value.detach()
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or not self.auto_micro_batch_size or micro_batch_size == 1:
+                    raise
+                self.micro_batch_size = max(1, micro_batch_size // 2)
+                self.logger.info('Out of memory during training, reducing the micro batch size '
+                                 'to {}'.format(self.micro_batch_size))
+                torch.cuda.empty_cache()
+                continue
+
+            break
+
+        self.grad_scaler.step(self.optimizer)
+        self.grad_scaler.update()
+
+        self.loss = loss
+        self.step_reconstruction_loss = reconstruction_loss
+        self.step_kl_loss = kl_loss
+        self.step_loss_dict = loss_dict
+
+    def training_state_path(self):
+        return os.path.join(self.log_dir, self.exp_config.experiment_name + '_training_state.pth')
+
+    def training_state(self, data, prefetcher=None):
+        """
+        Everything a resumed training needs to continue exactly after the current iteration, copied to the CPU. With
+        a running prefetcher the batch provider and the numpy random state are taken between two of its batch reads.
+        """
+        rng_state = training_state.get_rng_state()
+        if prefetcher is not None:
+            provider_state, rng_state['numpy'] = prefetcher.provider_state()
+        else:
+            provider_state = data.train.get_state()
+
+        return training_state.snapshot({
+            'iteration': self.iteration,
+            'net': self.net.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'grad_scaler': self.grad_scaler.state_dict(),
+            'micro_batch_size': self.micro_batch_size,
+            'training_metrics': self.training_metrics.values,
+            'training_summary': self.training_summary,
+            'best': {'dice': self.best_dice, 'loss': self.best_loss, 'ged': self.best_ged, 'ncc': self.best_ncc},
+            'batch_provider': provider_state,
+            'rng': rng_state})
+
+    def load_training_state(self, path, data):
+        """
+        Restores a checkpoint of training_state, the next call of train(data) continues after its iteration. Without
+        prefetching the resumed training is identical to an uninterrupted one.
+        """
+        state = training_state.load(path, self.device)
+
+        self.net.load_state_dict(state['net'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.grad_scaler.load_state_dict(state['grad_scaler'])
+        self.micro_batch_size = state['micro_batch_size']
+
+        self.training_metrics.values = state['training_metrics']
+        self.training_summary = state['training_summary']
+        self.best_dice = state['best']['dice']
+        self.best_loss = state['best']['loss']
+        self.best_ged = state['best']['ged']
+        self.best_ncc = state['best']['ncc']
+
+        data.train.set_state(state['batch_provider'])
+        training_state.set_rng_state(state['rng'])
+
+        self.iteration = state['iteration']
+        self.start_iteration = state['iteration'] + 1
+        self.logger.info('Loaded the training state of iteration {} from {}'.format(self.iteration, path))
+
+    def _autocast(self):
+        """
+        Autocast region of the forward passes, a no-op unless use_mixed_precision is set in the experiment config
+        """
+        return torch.autocast(self.device.type, dtype=self.mixed_precision_dtype, enabled=self.mixed_precision)
+
     def validate(self, data):
         self.net.eval()
         with torch.no_grad():
@@ -150,100 +360,40 @@ class UNetModel:
             ged_list = []
             dice_list = []
             ncc_list = []
-            elbo_list = []
-            kl_list = []
-            recon_list = []
+
+            elbo_sum = 0
+            kl_sum = 0
+            recon_sum = 0
 
             time_ = time.time()
 
             validation_set_size = data.validation.images.shape[0]\
                 if self.exp_config.num_validation_images == 'all' else self.exp_config.num_validation_images
 
-            for ii in range(validation_set_size):
+            for ii, n_images, results in self._evaluate_in_passes(data.validation, validation_set_size,
+                                                                   self.exp_config.validation_samples,
+                                                                   compute_loss=True):
 
-                s_gt_arr = data.validation.labels[ii, ...]
+                # the losses are means over all samples of a pass, weight them by the number of images
+                elbo_sum += n_images * results['elbo']
+                kl_sum += n_images * results['kl']
+                recon_sum += n_images * results['recon']
 
-                # from HW to NCHW
-                x_b = data.validation.images[ii, ...]
-                patch = torch.tensor(x_b, dtype=torch.float32).to(self.device)
-                val_patch = patch.unsqueeze(dim=0).unsqueeze(dim=1)
-
-                s_b = s_gt_arr[:, :, np.random.choice(self.exp_config.annotator_range)]
-                mask = torch.tensor(s_b, dtype=torch.float32).to(self.device)
-                val_mask = mask.unsqueeze(dim=0).unsqueeze(dim=1)
-                val_masks = torch.tensor(s_gt_arr, dtype=torch.float32).to(self.device)  # HWC
-                val_masks = val_masks.transpose(0, 2).transpose(1, 2)  # CHW
-
-                patch_arrangement = val_patch.repeat((self.exp_config.validation_samples, 1, 1, 1))
-
-                mask_arrangement = val_mask.repeat((self.exp_config.validation_samples, 1, 1, 1))
-
-                self.mask = mask_arrangement
-                self.patch = patch_arrangement
-
-                # training=True for constructing posterior as well
-                s_out_eval_list = self.net.forward(patch_arrangement, mask_arrangement, training=False)
-                s_prediction_softmax_arrangement = self.net.accumulate_output(s_out_eval_list, use_softmax=True)
+                dice_list.append(results['dice'])
+                ged_list.append(results['ged'])
+                ncc_list.append(results['ncc'])
 
-                # sample N times
-                self.val_loss = self.net.loss(mask_arrangement)
-                elbo = self.val_loss
-                kl = self.net.kl_divergence_loss
-                recon = self.net.reconstruction_loss
-
-                s_prediction_softmax_mean = torch.mean(s_prediction_softmax_arrangement, axis=0)
-                s_prediction_arrangement = torch.argmax(s_prediction_softmax_arrangement, dim=1)
-
-                ground_truth_arrangement = val_masks  # nlabels, H, W
-                ged = utils.generalised_energy_distance(s_prediction_arrangement, ground_truth_arrangement,
-                                                        nlabels=self.exp_config.n_classes - 1,
-                                                        label_range=range(1, self.exp_config.n_classes))
-
-                # num_gts, nlabels, H, W
-                s_gt_arr_r = val_masks.unsqueeze(dim=1)
-                ground_truth_arrangement_one_hot = utils.convert_batch_to_onehot(s_gt_arr_r, nlabels=self.exp_config.n_classes)
-                ncc = utils.variance_ncc_dist(s_prediction_softmax_arrangement, ground_truth_arrangement_one_hot)
-
-                s_ = torch.argmax(s_prediction_softmax_mean, dim=0) # HW
-                s = val_mask.view(val_mask.shape[-2], val_mask.shape[-1]) #HW
-
-                # Write losses to list
-                per_lbl_dice = []
-                for lbl in range(self.exp_config.n_classes):
-                    binary_pred = (s_ == lbl) * 1
-                    binary_gt = (s == lbl) * 1
-
-                    if torch.sum(binary_gt) == 0 and torch.sum(binary_pred) == 0:
-                        per_lbl_dice.append(1.0)
-                    elif torch.sum(binary_pred) > 0 and torch.sum(binary_gt) == 0 or torch.sum(binary_pred) == 0 and torch.sum(
-                            binary_gt) > 0:
-                        per_lbl_dice.append(0.0)
-                    else:
-                        per_lbl_dice.append(dc(binary_pred.detach().cpu().numpy(), binary_gt.detach().cpu().numpy()))
-
-                dice_list.append(per_lbl_dice)
-                elbo_list.append(elbo)
-                kl_list.append(kl)
-                recon_list.append(recon)
-
-                ged_list.append(ged)
-                ncc_list.append(ncc)
-
-            dice_tensor = torch.tensor(dice_list)
+            dice_tensor = torch.cat(dice_list).cpu()
             per_structure_dice = dice_tensor.mean(dim=0)
 
-            elbo_tensor = torch.tensor(elbo_list)
-            kl_tensor = torch.tensor(kl_list)
-            recon_tensor = torch.tensor(recon_list)
-
-            ged_tensor = torch.tensor(ged_list)
-            ncc_tensor = torch.tensor(ncc_list)
+            ged_tensor = torch.cat(ged_list).cpu()
+            ncc_tensor = torch.cat(ncc_list).cpu()
 
             self.avg_dice = torch.mean(dice_tensor)
             self.foreground_dice = torch.mean(dice_tensor, dim=0)[1]
-            self.val_elbo = torch.mean(elbo_tensor)
-            self.val_recon_loss = torch.mean(recon_tensor)
-            self.val_kl_loss = torch.mean(kl_tensor)
+            self.val_elbo = elbo_sum / validation_set_size
+            self.val_recon_loss = recon_sum / validation_set_size
+            self.val_kl_loss = kl_sum / validation_set_size
 
             self.avg_ged = torch.mean(ged_tensor)
             self.avg_ncc = torch.mean(ncc_tensor)
@@ -270,10 +420,135 @@ class UNetModel:
                 self.logger.info('New best NCC score! (%.3f)' % self.best_ncc)
                 self.save_model(savename='best_ncc')
 
-            self.logger.info('Validation took {} seconds'.format(time.time()-time_))
+            validation_time = time.time() - time_
+            self.logger.info('Validation took {} seconds ({:.2f} images/sec)'.format(
+                validation_time, validation_set_size / validation_time))
 
         self.net.train()
 
+    def _validation_images_per_pass(self):
+        """
+        Number of validation images whose samples are packed into one forward pass. Set validation_images_per_pass
+        in the experiment config to fix it, otherwise it is estimated from the free GPU memory after a probe pass
+        with a single image and reduced again if a pass runs out of memory.
+        """
+        if self.validation_images_per_pass is not None:
+            return self.validation_images_per_pass
+
+        configured = getattr(self.exp_config, 'validation_images_per_pass', 'auto')
+        if configured != 'auto':
+            self.validation_images_per_pass = configured
+        elif self.device.type != 'cuda':
+            self.validation_images_per_pass = DEFAULT_CPU_VALIDATION_IMAGES_PER_PASS
+        elif self.validation_memory_per_image is None:
+            # probe pass, measures the memory needed for the samples of one image
+            return 1
+        else:
+            free_memory, _ = torch.cuda.mem_get_info(self.device)
+            self.validation_images_per_pass = max(1, int(0.8 * free_memory / self.validation_memory_per_image))
+            self.logger.info('Packing {} validation images per pass'.format(self.validation_images_per_pass))
+
+        return self.validation_images_per_pass
+
+    def _evaluate_in_passes(self, data_split, num_images, n_samples, compute_loss=False):
+        """
+        Generator over the first num_images images of data_split, evaluated with _evaluate_images in passes of
+        _validation_images_per_pass() images. Yields the index of the first image, the number of images and
+        the results of each pass.
+        """
+        ii = 0
+        while ii < num_images:
+
+            n_images = min(self._validation_images_per_pass(), num_images - ii)
+
+            try:
+                results = self._evaluate_images(data_split.images[ii:ii + n_images, ...],
+                                                data_split.labels[ii:ii + n_images, ...],
+                                                n_samples,
+                                                compute_loss=compute_loss)
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or n_images == 1:
+                    raise
+                self.validation_images_per_pass = max(1, n_images // 2)
+                self.logger.info('Out of memory during evaluation, reducing the number of images per pass '
+                                 'to {}'.format(self.validation_images_per_pass))
+                torch.cuda.empty_cache()
+                continue
+
+            yield ii, n_images, results
+
+            ii += n_images
+
+    def _evaluate_images(self, images, labels, n_samples, compute_loss=False):
+        """
+        Predicts n_samples segmentations for each image in one forward pass and computes GED, NCC and Dice
+        for all images at once.
+        :param images: numpy array of shape K x H x W
+        :param labels: numpy array of annotations of shape K x H x W x num_annotators
+        :return: dict with per image tensors 'ged' (K), 'ncc' (K), 'dice' (K x n_classes), the sampled
+                 'prediction' (K x n_samples x H x W) and, if compute_loss, the mean 'elbo', 'kl' and 'recon'
+        """
+        n_images = images.shape[0]
+        n_classes = self.exp_config.n_classes
+
+        if self.device.type == 'cuda' and self.validation_memory_per_image is None:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            memory_before = torch.cuda.memory_allocated(self.device)
+
+        # one random annotator per image for the mask that is fed to the posterior and the dice score
+        annotators = [np.random.choice(self.exp_config.annotator_range) for _ in range(n_images)]
+
+        patch = torch.tensor(images, dtype=torch.float32).to(self.device).unsqueeze(dim=1)  # K1HW
+        val_masks = torch.tensor(labels, dtype=torch.float32).to(self.device).permute(0, 3, 1, 2)  # KMHW
+        val_mask = val_masks[torch.arange(n_images, device=self.device),
+                             torch.tensor(annotators, device=self.device)].unsqueeze(dim=1)  # K1HW
+
+        patch_arrangement = patch.repeat_interleave(n_samples, dim=0)
+        mask_arrangement = val_mask.repeat_interleave(n_samples, dim=0)
+
+        self.mask = mask_arrangement
+        self.patch = patch_arrangement
+
+        with self._autocast():
+            if hasattr(self.net, 'sample_n'):
+                # the posterior is only needed for the loss
+                s_out_eval_list = self.net.sample_n(patch, n_samples, mask=val_mask if compute_loss else None)
+            else:
+                s_out_eval_list = self.net.forward(patch_arrangement, mask_arrangement, training=False)
+            s_prediction_softmax_arrangement = self.net.accumulate_output(s_out_eval_list, use_softmax=True).float()
+
+            results = {}
+            if compute_loss:
+                results['elbo'] = self.net.loss(mask_arrangement).item()
+                results['kl'] = float(self.net.kl_divergence_loss)
+                results['recon'] = float(self.net.reconstruction_loss)
+
+        # K x S x C x H x W
+        s_prediction_softmax_arrangement = s_prediction_softmax_arrangement.view(
+            (n_images, n_samples) + s_prediction_softmax_arrangement.shape[1:])
+        s_prediction_softmax_mean = torch.mean(s_prediction_softmax_arrangement, dim=1)
+        s_prediction_arrangement = torch.argmax(s_prediction_softmax_arrangement, dim=2)
+
+        results['prediction'] = s_prediction_arrangement
+        results['ged'] = utils.generalised_energy_distance(s_prediction_arrangement, val_masks,
+                                                           nlabels=n_classes - 1,
+                                                           label_range=range(1, n_classes))
+
+        # K x num_gts x nlabels x H x W
+        ground_truth_arrangement_one_hot = torch.nn.functional.one_hot(val_masks.long(), n_classes)
+        ground_truth_arrangement_one_hot = ground_truth_arrangement_one_hot.permute(0, 1, 4, 2, 3)
+        results['ncc'] = utils.variance_ncc_dist(s_prediction_softmax_arrangement, ground_truth_arrangement_one_hot)
+
+        s_ = torch.argmax(s_prediction_softmax_mean, dim=1)  # KHW
+        s = val_mask.squeeze(dim=1)  # KHW
+        results['dice'] = utils.per_label_dice(s_, s, n_classes)
+
+        if self.device.type == 'cuda' and self.validation_memory_per_image is None:
+            self.validation_memory_per_image = \
+                (torch.cuda.max_memory_allocated(self.device) - memory_before) / n_images
+
+        return results
+
     def train_brats(self, trainDataLoader):
         epoch = 1
         while epoch < 100:
@@ -299,10 +574,13 @@ class UNetModel:
     def _create_tensorboard_summary(self, end_of_epoch=False):
         self.net.eval()
         with torch.no_grad():
-            # calculate the means since the last validation
-            self.training_writer.add_scalar('Mean_loss', self.tot_loss/self.exp_config.validation_frequency, global_step=self.iteration)
-            self.training_writer.add_scalar('KL_Divergence_loss', self.kl_loss/self.exp_config.validation_frequency, global_step=self.iteration)
-            self.training_writer.add_scalar('Reconstruction_loss', self.reconstruction_loss/self.exp_config.validation_frequency, global_step=self.iteration)
+            # the means since the last logging
+            self.training_writer.add_scalar('Mean_loss', self.training_summary['loss']['mean'], global_step=self.iteration)
+            self.training_writer.add_scalar('KL_Divergence_loss', self.training_summary['kl_divergence_loss']['mean'], global_step=self.iteration)
+            self.training_writer.add_scalar('Reconstruction_loss', self.training_summary['reconstruction_loss']['mean'], global_step=self.iteration)
+            for name, summary in self.training_summary.items():
+                if '_lvl' in name:
+                    self.training_writer.add_scalar('Levels/' + name, summary['mean'], global_step=self.iteration)
 
             self.validation_writer.add_scalar('Dice_score_of_last_validation', self.foreground_dice, global_step=self.iteration)
             self.validation_writer.add_scalar('GED_score_of_last_validation', self.avg_ged, global_step=self.iteration)
@@ -365,78 +643,22 @@ class UNetModel:
                 self.logger.info('Doing iteration {}'.format(i))
                 n_samples = 10
 
-                for ii in range(data.test.images.shape[0]):
-
-                    s_gt_arr = data.test.labels[ii, ...]
-
-                    # from HW to NCHW
-                    x_b = data.test.images[ii, ...]
-                    patch = torch.tensor(x_b, dtype=torch.float32).to(self.device)
-                    val_patch = patch.unsqueeze(dim=0).unsqueeze(dim=1)
+                for ii, n_images, results in self._evaluate_in_passes(data.test, data.test.images.shape[0],
+                                                                       n_samples):
 
-                    s_b = s_gt_arr[:, :, np.random.choice(self.exp_config.annotator_range)]
-                    mask = torch.tensor(s_b, dtype=torch.float32).to(self.device)
-                    val_mask = mask.unsqueeze(dim=0).unsqueeze(dim=1)
-                    val_masks = torch.tensor(s_gt_arr, dtype=torch.float32).to(self.device)  # HWC
-                    val_masks = val_masks.transpose(0, 2).transpose(1, 2)  # CHW
+                    dice_list.append(results['dice'])
+                    ged_list.append(results['ged'])
+                    ncc_list.append(results['ncc'])
 
-                    patch_arrangement = val_patch.repeat((n_samples, 1, 1, 1))
+                    # log every 100 images
+                    if (ii + n_images - 1) // 100 > (ii - 1) // 100:
+                        self.logger.info(' - Mean GED: %.4f' % torch.mean(torch.cat(ged_list)))
+                        self.logger.info(' - Mean NCC: %.4f' % torch.mean(torch.cat(ncc_list)))
 
-                    mask_arrangement = val_mask.repeat((n_samples, 1, 1, 1))
+                dice_tensor = torch.cat(dice_list).cpu()
 
-                    self.mask = mask_arrangement
-                    self.patch = patch_arrangement
-
-                    # training=True for constructing posterior as well
-                    s_out_eval_list = self.net.forward(patch_arrangement, mask_arrangement, training=False)
-                    s_prediction_softmax_arrangement = self.net.accumulate_output(s_out_eval_list, use_softmax=True)
-
-                    s_prediction_softmax_mean = torch.mean(s_prediction_softmax_arrangement, axis=0)
-                    s_prediction_arrangement = torch.argmax(s_prediction_softmax_arrangement, dim=1)
-
-                    ground_truth_arrangement = val_masks  # nlabels, H, W
-                    ged = utils.generalised_energy_distance(s_prediction_arrangement, ground_truth_arrangement,
-                                                            nlabels=self.exp_config.n_classes - 1,
-                                                            label_range=range(1, self.exp_config.n_classes))
-
-                    # num_gts, nlabels, H, W
-                    s_gt_arr_r = val_masks.unsqueeze(dim=1)
-                    ground_truth_arrangement_one_hot = utils.convert_batch_to_onehot(s_gt_arr_r,
-                                                                                     nlabels=self.exp_config.n_classes)
-                    ncc = utils.variance_ncc_dist(s_prediction_softmax_arrangement, ground_truth_arrangement_one_hot)
-
-                    s_ = torch.argmax(s_prediction_softmax_mean, dim=0)  # HW
-                    s = val_mask.view(val_mask.shape[-2], val_mask.shape[-1])  # HW
-
-                    # Write losses to list
-                    per_lbl_dice = []
-                    for lbl in range(self.exp_config.n_classes):
-                        binary_pred = (s_ == lbl) * 1
-                        binary_gt = (s == lbl) * 1
-
-                        if torch.sum(binary_gt) == 0 and torch.sum(binary_pred) == 0:
-                            per_lbl_dice.append(1.0)
-                        elif torch.sum(binary_pred) > 0 and torch.sum(binary_gt) == 0 or torch.sum(
-                                binary_pred) == 0 and torch.sum(
-                                binary_gt) > 0:
-                            per_lbl_dice.append(0.0)
-                        else:
-                            per_lbl_dice.append(dc(binary_pred.detach().cpu().numpy(), binary_gt.detach().cpu().numpy()))
-                    dice_list.append(per_lbl_dice)
-
-                    ged_list.append(ged)
-                    ncc_list.append(ncc)
-
-                    if ii % 100 == 0:
-                        self.logger.info(' - Mean GED: %.4f' % torch.mean(torch.tensor(ged_list)))
-                        self.logger.info(' - Mean NCC: %.4f' % torch.mean(torch.tensor(ncc_list)))
-
-
-                dice_tensor = torch.tensor(dice_list)
-                per_structure_dice = dice_tensor.mean(dim=0)
-
-                ged_tensor = torch.tensor(ged_list)
-                ncc_tensor = torch.tensor(ncc_list)
+                ged_tensor = torch.cat(ged_list).cpu()
+                ncc_tensor = torch.cat(ncc_list).cpu()
 
                 model_path = os.path.join(
                     sys_config.log_root,
@@ -518,15 +740,13 @@ class UNetModel:
                 val_masks = torch.tensor(s_gt_arr, dtype=torch.float32).to(self.device)  # HWC
                 val_masks = val_masks.transpose(0, 2).transpose(1, 2)  # CHW
 
-                patch_arrangement = val_patch.repeat((n_samples, 1, 1, 1))
+                self.mask = val_mask.repeat((n_samples, 1, 1, 1))
+                self.patch = val_patch.repeat((n_samples, 1, 1, 1))
 
-                mask_arrangement = val_mask.repeat((n_samples, 1, 1, 1))
-
-                self.mask = mask_arrangement
-                self.patch = patch_arrangement
-
-                # training=True for constructing posterior as well
-                s_out_eval_list = self.net.forward(patch_arrangement, mask_arrangement, training=False)
+                if hasattr(self.net, 'sample_n'):
+                    s_out_eval_list = self.net.sample_n(val_patch, n_samples)
+                else:
+                    s_out_eval_list = self.net.forward(self.patch, self.mask, training=False)
                 s_prediction_softmax_arrangement = self.net.accumulate_output(s_out_eval_list, use_softmax=True)
                 s_ = torch.argmax(s_prediction_softmax_arrangement, dim=1)
                 self.logger.info('s_.shape{}'.format(s_.shape))
@@ -569,6 +789,8 @@ if __name__ == '__main__':
     parser.add_argument("EXP_PATH", type=str, help="Path to experiment config file")
     parser.add_argument("LOCAL", type=str, help="Is this script run on the local machine or the BIWI cluster?")
     parser.add_argument("dummy", type=str, help="Is the module run with dummy training?")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the training from the training state checkpoint in the log directory")
     args = parser.parse_args()
 
     config_file = args.EXP_PATH
@@ -598,18 +820,22 @@ if __name__ == '__main__':
     basic_logger.info(' *** Running Experiment: %s', exp_config.experiment_name)
     basic_logger.info('**************************************************************')
 
-    model = UNetModel(exp_config, logger=basic_logger)
+    model = UNetModel(exp_config, logger=basic_logger, log_dir=log_dir)
     transform = None
     #
     # trainset = bratsDataset.BratsDataset(sys_config.brats_root, exp_config, mode="train", randomCrop=None)
     # trainloader = torch.utils.data.DataLoader(trainset, batch_size=1, shuffle=True, pin_memory=True,
-    #                                           num_workers=1)
+    #                                           num_workers=exp_config.DATASET_WORKERS,
+    #                                           worker_init_fn=bratsDataset.worker_init_fn)
     #
     # model.train_brats(trainloader)
 
     # this loads either lidc or uzh data
     data = exp_config.data_loader(sys_config=sys_config, exp_config=exp_config)
 
+    if args.resume:
+        model.load_training_state(model.training_state_path(), data)
+
     model.train(data)
 
     model.save_model('last')
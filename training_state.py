@@ -0,0 +1,94 @@
+"""Full training state checkpoints, written in a background thread"""
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+import logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+
+def snapshot(value):
+    """
+    Copy of a (nested) state with all tensors copied to the CPU, so that it can be written while the training
+    continues to change the original tensors in place
+    """
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if isinstance(value, dict):
+        return type(value)((key, snapshot(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+def get_rng_state():
+    return {'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            'numpy': np.random.get_state(),
+            'random': random.getstate()}
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
+def load(path, device):
+    # the state contains numpy arrays and random states besides tensors
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+class AsyncCheckpointWriter():
+    """
+    Writes checkpoints with torch.save in a background thread. A checkpoint is first written to a temporary file
+    which then replaces the previous one, so an interrupted write never leaves a truncated checkpoint behind. At most
+    one checkpoint waits for the thread, write() blocks if the previous one is not written yet.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, name='AsyncCheckpointWriter', daemon=True)
+        self.thread.start()
+
+    def write(self, state, path):
+        """
+        Queues state (see snapshot) to be written to path. Raises the error of a previous write, if any.
+        """
+        self._raise_error()
+        self.queue.put((state, path))
+
+    def close(self):
+        """
+        Waits until all queued checkpoints are written
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            state, path = item
+            try:
+                torch.save(state, path + '.tmp')
+                os.replace(path + '.tmp', path)
+            except Exception as e:
+                logging.error('Writing the checkpoint {} failed: {}'.format(path, e))
+                self.error = e
@@ -2,12 +2,13 @@ import torch
 import torch.nn as nn
 from torch.autograd import Variable
 import torch.nn.functional as F
-from medpy.metric import jc
 import logging
 import nibabel as nib
 
 import numpy as np
 import os
+import functools
+from collections import OrderedDict
 
 try:
     import cv2
@@ -101,6 +102,75 @@ def l2_regularisation(m):
     return l2_reg
 
 
+def in_float32(function):
+    '''
+    Decorator for the numerically sensitive parts of the models (KL divergences, likelihoods, sigma heads). Inside an
+    autocast region (mixed precision training) the floating point tensor arguments are cast to float32 and the function
+    runs with autocast disabled, outside of it the function is called unchanged.
+    '''
+
+    def to_float32(value):
+        return value.float() if torch.is_tensor(value) and value.is_floating_point() else value
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        tensors = [value for value in list(args) + list(kwargs.values()) if torch.is_tensor(value)]
+        device_type = tensors[0].device.type if tensors else 'cpu'
+        if not torch.is_autocast_enabled(device_type):
+            return function(*args, **kwargs)
+        with torch.autocast(device_type, enabled=False):
+            return function(*[to_float32(value) for value in args],
+                            **{key: to_float32(value) for key, value in kwargs.items()})
+
+    return wrapper
+
+
+class MetricsAccumulator():
+    """
+    Collects scalar metrics (e.g. the loss terms of every training step) as detached tensors on the device they were
+    computed on, so that recording a value neither keeps its autograd graph alive nor waits for the GPU. The values
+    are only copied to the host, all at once, when summary() is called.
+    """
+
+    def __init__(self, percentiles=(5, 50, 95)):
+        self.percentiles = percentiles
+        self.values = OrderedDict()
+
+    def add(self, name, value):
+        value = value.detach() if torch.is_tensor(value) else torch.tensor(float(value))
+        self.values.setdefault(name, []).append(value.float().reshape(()))
+
+    def add_dict(self, values, prefix=''):
+        for name, value in values.items():
+            self.add(prefix + name, value)
+
+    def __len__(self):
+        return max([len(values) for values in self.values.values()], default=0)
+
+    def summary(self):
+        """
+        Returns an OrderedDict with the mean and the percentiles (keys 'mean', 'p5', 'p50', ...) of every metric
+        recorded since the last reset
+        """
+        if not self.values:
+            return OrderedDict()
+
+        device = next(iter(self.values.values()))[0].device
+        host_values = torch.cat([torch.stack(values).to(device) for values in self.values.values()]).cpu().numpy()
+
+        summary = OrderedDict()
+        start = 0
+        for name, values in self.values.items():
+            metric = host_values[start:start + len(values)]
+            start += len(values)
+            summary[name] = OrderedDict([('mean', float(np.mean(metric)))] +
+                                        [('p%g' % q, float(np.percentile(metric, q))) for q in self.percentiles])
+        return summary
+
+    def reset(self):
+        self.values = OrderedDict()
+
+
 def normalise_image(image):
     '''
     make image zero mean and unit standard deviation
@@ -145,106 +215,119 @@ def ncc(a,v, zero_norm=True):
     return np.correlate(a, v)
 
 
-def generalised_energy_distance(sample_arr, gt_arr, nlabels=1, **kwargs):
-
-    def dist_fct(m1, m2):
+def pairwise_iou_distance(label_maps, label_range, nlabels):
+    """
+    Computes 1 - mean IoU between every pair of the K label maps.
+    Empty-vs-empty masks count as an IoU of 1 and empty-vs-non-empty masks as an IoU of 0, like in the
+    per-pair implementation based on medpy.
+    :param label_maps: integer label maps of shape ... x K x X x Y
+    :param label_range: labels that are taken into account for the IoU
+    :param nlabels: number the summed IoU is divided by
+    :return: distance matrix of shape ... x K x K (float64)
+    """
 
-        label_range = kwargs.get('label_range', range(nlabels))
+    labels = torch.as_tensor(list(label_range), device=label_maps.device)
 
-        per_label_iou = []
-        for lbl in label_range:
+    # ... x K x L x P binary masks, P being the number of pixels
+    masks = label_maps.flatten(start_dim=-2).unsqueeze(-2) == labels.view(-1, 1)
+    masks = masks.float()
 
-            # assert not lbl == 0  # tmp check
-            m1_bin = (m1 == lbl)*1
-            m2_bin = (m2 == lbl)*1
+    # counts of at most X*Y are represented exactly in float32, so the division below matches medpy's jc
+    intersection = torch.einsum('...ilp,...jlp->...ijl', masks, masks).double()
+    area = masks.sum(dim=-1).double()
+    union = area.unsqueeze(-2) + area.unsqueeze(-3) - intersection
 
-            if torch.sum(m1_bin) == 0 and torch.sum(m2_bin) == 0:
-                per_label_iou.append(1)
-            elif torch.sum(m1_bin) > 0 and torch.sum(m2_bin) == 0 or torch.sum(m1_bin) == 0 and torch.sum(m2_bin) > 0:
-                per_label_iou.append(0)
-            else:
-                per_label_iou.append(jc(m1_bin.detach().cpu().numpy(), m2_bin.detach().cpu().numpy()))
+    iou = torch.where(union > 0, intersection / union.clamp(min=1), torch.ones_like(union))
 
-        # print(1-(sum(per_label_iou) / nlabels))
+    return 1 - iou.sum(dim=-1) / nlabels
 
-        return 1-(sum(per_label_iou) / nlabels)
 
+def generalised_energy_distance(sample_arr, gt_arr, nlabels=1, **kwargs):
     """
-    :param sample_arr: expected shape N x X x Y 
-    :param gt_arr: M x X x Y
-    :return: 
+    Squared generalised energy distance between the predicted samples and the ground truth annotations using
+    1 - IoU as distance. All N x M, N x N and M x M distances are computed in one batch on the device of the inputs.
+    :param sample_arr: expected shape N x X x Y, or B x N x X x Y for a batch of images
+    :param gt_arr: M x X x Y, or B x M x X x Y for a batch of images
+    :return: GED as float, or as tensor of shape B for batched inputs
     """
 
-    N = sample_arr.shape[0]
-    M = gt_arr.shape[0]
+    label_range = kwargs.get('label_range', range(nlabels))
 
-    d_sy = []
-    d_ss = []
-    d_yy = []
+    batched = sample_arr.dim() == 4
+    if not batched:
+        sample_arr = sample_arr.unsqueeze(0)
+        gt_arr = gt_arr.unsqueeze(0)
 
-    for i in range(N):
-        for j in range(M):
-            # print(dist_fct(sample_arr[i,...], gt_arr[j,...]))
-            d_sy.append(dist_fct(sample_arr[i,...], gt_arr[j,...]))
+    N = sample_arr.shape[1]
+    M = gt_arr.shape[1]
 
-    for i in range(N):
-        for j in range(N):
-            # print(dist_fct(sample_arr[i,...], sample_arr[j,...]))
-            d_ss.append(dist_fct(sample_arr[i,...], sample_arr[j,...]))
+    label_maps = torch.cat([sample_arr.long(), gt_arr.to(sample_arr.device).long()], dim=1)
+    dist = pairwise_iou_distance(label_maps, label_range, nlabels)
 
-    for i in range(M):
-        for j in range(M):
-            # print(dist_fct(gt_arr[i,...], gt_arr[j,...]))
-            d_yy.append(dist_fct(gt_arr[i,...], gt_arr[j,...]))
+    d_sy = dist[:, :N, N:].sum(dim=(1, 2))
+    d_ss = dist[:, :N, :N].sum(dim=(1, 2))
+    d_yy = dist[:, N:, N:].sum(dim=(1, 2))
 
-    return (2./(N*M))*sum(d_sy) - (1./N**2)*sum(d_ss) - (1./M**2)*sum(d_yy)
+    ged = (2./(N*M))*d_sy - (1./N**2)*d_ss - (1./M**2)*d_yy
 
-def variance_ncc_dist(sample_arr, gt_arr):
+    if not batched:
+        return ged.item()
+    return ged
 
-    def pixel_wise_xent(m_samp, m_gt, eps=1e-8):
+def per_label_dice(prediction, ground_truth, nlabels):
+    """
+    Dice score per label between predicted and ground truth label maps. A label that is absent in both maps
+    scores 1 and a label that is absent in only one of them scores 0, like the medpy based evaluation.
+    :param prediction: integer label maps of shape B x X x Y
+    :param ground_truth: label maps of shape B x X x Y
+    :return: tensor of shape B x nlabels (float64)
+    """
 
-        log_samples = np.log(m_samp + eps)
+    labels = torch.arange(nlabels, device=prediction.device).view(1, -1, 1)
 
-        return -1.0*np.sum(m_gt*log_samples, axis=0)
+    pred = prediction.flatten(start_dim=1).long().unsqueeze(1) == labels
+    gt = ground_truth.to(prediction.device).flatten(start_dim=1).long().unsqueeze(1) == labels
 
-    """
-    :param sample_arr: expected shape N x X x Y 
-    :param gt_arr: M x X x Y
-    :return: 
-    """
-    sample_arr = sample_arr.detach().cpu().numpy()
-    gt_arr = gt_arr.detach().cpu().numpy()
+    intersection = (pred & gt).sum(dim=-1).double()
+    size_sum = (pred.sum(dim=-1) + gt.sum(dim=-1)).double()
 
-    mean_seg = np.mean(sample_arr, axis=0)
+    return torch.where(size_sum > 0, 2. * intersection / size_sum.clamp(min=1), torch.ones_like(size_sum))
 
-    N = sample_arr.shape[0]
-    M = gt_arr.shape[0]
 
-    sX = sample_arr.shape[2]
-    sY = sample_arr.shape[3]
+def variance_ncc_dist(sample_arr, gt_arr):
+    """
+    Normalised cross correlation between the expected pixel-wise cross entropy of the samples w.r.t. their mean
+    (E_ss) and the expected cross entropy w.r.t. each annotation (E_sy), averaged over the annotations.
+    Since the cross entropy is linear in the target, both maps only need the sample mean of log(s), which is
+    computed once instead of once per sample/annotator pair. Runs on the device of the inputs.
+    :param sample_arr: softmax predictions of shape N x C x X x Y, or B x N x C x X x Y for a batch of images
+    :param gt_arr: one-hot annotations of shape M x C x X x Y, or B x M x C x X x Y for a batch of images
+    :return: tensor of shape 1, or B for batched inputs
+    """
 
-    E_ss_arr = np.zeros((N,sX,sY))
-    for i in range(N):
-        E_ss_arr[i,...] = pixel_wise_xent(sample_arr[i,...], mean_seg)
-        # print('pixel wise xent')
-        # plt.imshow( E_ss_arr[i,...])
-        # plt.show()
+    if sample_arr.dim() == 4:
+        sample_arr = sample_arr.unsqueeze(0)
+        gt_arr = gt_arr.unsqueeze(0)
 
-    E_ss = np.mean(E_ss_arr, axis=0)
+    if not sample_arr.is_floating_point():
+        sample_arr = sample_arr.float()
+    gt_arr = gt_arr.to(device=sample_arr.device, dtype=sample_arr.dtype)
 
-    E_sy_arr = np.zeros((M,N, sX, sY))
-    for j in range(M):
-        for i in range(N):
-            E_sy_arr[j,i, ...] = pixel_wise_xent(sample_arr[i,...], gt_arr[j,...])
+    eps = 1e-8
+    mean_seg = torch.mean(sample_arr, dim=1)  # B x C x X x Y
+    mean_log_samples = torch.mean(torch.log(sample_arr + eps), dim=1)  # B x C x X x Y
 
-    E_sy = np.mean(E_sy_arr, axis=1)
+    E_ss = -1.0*torch.sum(mean_seg*mean_log_samples, dim=1)  # B x X x Y
+    E_sy = -1.0*torch.einsum('bmcxy,bcxy->bmxy', gt_arr, mean_log_samples)  # B x M x X x Y
 
-    ncc_list = []
-    for j in range(M):
+    E_ss = E_ss.flatten(start_dim=1)
+    E_sy = E_sy.flatten(start_dim=2)
 
-        ncc_list.append(ncc(E_ss, E_sy[j,...]))
+    # zero normalised cross correlation with population std, like utils.ncc
+    a = (E_ss - E_ss.mean(dim=1, keepdim=True)) / (E_ss.std(dim=1, unbiased=False, keepdim=True) * E_ss.shape[1])
+    v = (E_sy - E_sy.mean(dim=2, keepdim=True)) / E_sy.std(dim=2, unbiased=False, keepdim=True)
 
-    return (1/M)*sum(ncc_list)
+    return torch.einsum('bp,bmp->bm', a, v).mean(dim=1)
 
 
 def show_tensor(tensor):
@@ -323,6 +406,14 @@ def makefolder(folder):
     return False
 
 
+def file_signature(path):
+    '''
+    Size and modification time of a file, used to detect that a file derived from it is out of date
+    '''
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
 def convert_nhwc_to_nchw(tensor):
     result = tensor.transpose(1, 3).transpose(2, 3)
     return result
@@ -353,7 +444,8 @@ def load_nii(img_path):
     '''
 
     nimg = nib.load(img_path)
-    return nimg.get_data(), nimg.affine, nimg.header
+    # same array as get_data(), which newer nibabel versions removed
+    return np.asanyarray(nimg.dataobj), nimg.affine, nimg.header
 
 def save_nii(img_path, data, affine, header):
     '''